@@ -0,0 +1,92 @@
+"""
+Compares the legacy single threaded code hashing with the hashing engine used by update_code_hash
+on a synthetic tree (50k files by default).
+
+    python benchmarks/code_hash.py [--files 50000] [--size 4096]
+"""
+import argparse
+import hashlib
+import importlib.util
+import os
+import random
+import tempfile
+import time
+from glob import glob
+
+from krules_dev.sane_utils.hashing import FileDigestIndex, combine_digests
+from krules_dev.sane_utils.walker import Walker, expand_globs
+
+
+def make_tree(root: str, files: int, size: int, fanout: int = 100):
+    rnd = random.Random(0)
+    for i in range(files):
+        d = os.path.join(root, "src", f"pkg{i // fanout // fanout}", f"mod{i // fanout}")
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"f{i}.py"), "wb") as f:
+            f.write(rnd.randbytes(rnd.randint(size // 2, size * 2)))
+
+
+def legacy_hash(globs: list) -> str:
+    # update_code_hash as it was before the hashing engine
+    def _update_hash_within_dir(dir_path):
+        for filename in os.listdir(dir_path):
+            f = os.path.join(dir_path, filename)
+            if os.path.isfile(f):
+                code_hash.update(open(f, "rb").read())
+            else:
+                _update_hash_within_dir(f)
+
+    files = []
+    for file in globs:
+        files.extend(glob(file, recursive=True))
+    code_hash = hashlib.md5()
+    for path in files:
+        if os.path.isfile(path):
+            code_hash.update(open(path, "rb").read())
+        else:
+            _update_hash_within_dir(path)
+    return code_hash.hexdigest()
+
+
+def engine_hash(globs: list, index_file: str, algorithm: str, verify: bool, workers: int = None) -> FileDigestIndex:
+    walker = Walker()
+    files = [f for path in expand_globs(globs, walker=walker) for f in walker.walk(path)]
+    index = FileDigestIndex(index_file, algorithm=algorithm, verify=verify, workers=workers)
+    combine_digests(index.digest_many(files), algorithm)
+    index.save()
+    return index
+
+
+def timed(label: str, fn):
+    start = time.perf_counter()
+    fn()
+    print(f"{label:<40} {time.perf_counter() - start:8.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--size", type=int, default=4096, help="average file size in bytes")
+    args = parser.parse_args()
+
+    algorithms = ["md5", "blake2b"]
+    if importlib.util.find_spec("xxhash") is not None:
+        algorithms.append("xxh3_128")
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.files, args.size)
+        os.chdir(root)
+        globs = ["src"]
+        print(f"{args.files} files, ~{args.size} bytes each")
+        timed("legacy (md5, single thread)", lambda: legacy_hash(globs))
+        timed("engine (md5, single thread)", lambda: engine_hash(globs, ".index", "md5", True, workers=1))
+        for algorithm in algorithms:
+            timed(f"engine ({algorithm}, thread pool)", lambda: engine_hash(globs, ".index", algorithm, True))
+        engine_hash(globs, ".index", "md5", True)
+        # let the index become older than the files it describes
+        time.sleep(0.1)
+        timed("engine (md5, warm stat index)", lambda: engine_hash(globs, ".index", "md5", False))
+
+
+if __name__ == "__main__":
+    main()
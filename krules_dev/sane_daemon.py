@@ -0,0 +1,230 @@
+"""
+Warm daemon for make.py invocations.
+
+The daemon imports krules_dev.sane_utils (and its heavy dependencies) once and serves each
+invocation in a forked child, so that only make.py itself has to run:
+
+    python -m krules_dev.sane_daemon serve &
+    python -m krules_dev.sane_daemon run ./make.py build
+
+The client forwards argv, cwd, environment and its stdin/stdout/stderr to the daemon (SANE_DAEMON_SOCKET,
+default $XDG_RUNTIME_DIR/krules-sane-<uid>/daemon.sock) and falls back to running make.py in-process when no daemon
+answers. The socket runs arbitrary make.py files with the caller environment: it is created in a private (0700)
+directory, and both sides check that the other one is the same user.
+This module must stay cheap to import: it does not import sane_utils on the client side
+"""
+import json
+import os
+import runpy
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+# modules holding per-invocation state (recipe graph, root_dir, bound targets), imported afresh by each child
+_PER_RUN_MODULES = ("krules_dev.sane_utils", "sane")
+
+
+def get_socket_path() -> str:
+    return os.environ.get(
+        "SANE_DAEMON_SOCKET",
+        os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), f"krules-sane-{os.getuid()}", "daemon.sock")
+    )
+
+
+def _private_dir(path: str):
+    # the directory may be predictable (eg: in /tmp): it must be ours and not accessible to anyone else
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path) or st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a directory owned by the current user")
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+def _owned(socket_path: str) -> bool:
+    try:
+        return os.stat(socket_path).st_uid == os.getuid()
+    except FileNotFoundError:
+        return False
+
+
+def _peer_uid(conn: socket.socket) -> int | None:
+    if not hasattr(socket, "SO_PEERCRED"):
+        # not on linux: the private directory is all we have
+        return None
+    _, uid, _ = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+
+def run_make_file(make_file: str, argv: list) -> int:
+    """
+    Runs make_file as __main__ with argv in the current process, returning its exit code
+    """
+    make_file = os.path.abspath(make_file)
+    os.environ["SANE_MAKE_FILE"] = make_file
+    sys.argv = [make_file, *argv]
+    sys.path.insert(0, os.path.dirname(make_file))
+    try:
+        runpy.run_path(make_file, run_name="__main__")
+    except SystemExit as ex:
+        if ex.code is None:
+            return 0
+        if isinstance(ex.code, int):
+            return ex.code
+        print(ex.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+def _purge_modules():
+    import krules_dev
+
+    for name in list(sys.modules):
+        if any(name == m or name.startswith(f"{m}.") for m in _PER_RUN_MODULES):
+            del sys.modules[name]
+    # or "from krules_dev import sane_utils" would get the preloaded module back (see nested.run_make_in_process)
+    if hasattr(krules_dev, "sane_utils"):
+        del krules_dev.sane_utils
+
+
+def _serve_request(conn: socket.socket):
+    header, fds, _, _ = socket.recv_fds(conn, 4, 3)
+    size = struct.unpack("!i", header)[0]
+    msg = b""
+    while len(msg) < size:
+        chunk = conn.recv(size - len(msg))
+        if not chunk:
+            os._exit(1)
+        msg += chunk
+    request = json.loads(msg)
+    for target_fd, fd in enumerate(fds):
+        os.dup2(fd, target_fd)
+        os.close(fd)
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    code = 1
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        _purge_modules()
+        code = run_make_file(request["make_file"], request["argv"])
+    except BaseException:
+        # to the client stderr, as it would be printed running make.py directly
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(struct.pack("!i", code))
+            conn.close()
+        except OSError:
+            # the client is gone
+            pass
+        os._exit(code)
+
+
+def serve(socket_path: str = None):
+    """
+    Preloads sane_utils and serves make.py invocations on a unix socket, one forked child each
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    import krules_dev.sane_utils  # noqa: F401 (preload)
+
+    _private_dir(os.path.dirname(os.path.abspath(socket_path)))
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # no window in which the socket is accessible to others
+    umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(64)
+    # children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print(f"sane daemon listening on {socket_path}", file=sys.stderr)
+    try:
+        while True:
+            conn, _ = server.accept()
+            peer_uid = _peer_uid(conn)
+            if peer_uid is not None and peer_uid != os.getuid():
+                print(f"sane daemon: connection refused to uid {peer_uid}", file=sys.stderr)
+                conn.close()
+                continue
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _serve_request(conn)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def run_in_daemon(make_file: str, argv: list, env: dict = None, cwd: str = None,
+                  fds: tuple = (0, 1, 2), socket_path: str = None) -> int | None:
+    """
+    Runs make_file with argv in the daemon. Returns its exit code, None when no daemon is available.
+    Once the request is delivered make_file may have run, at least in part: a daemon child dying without
+    an exit code is a failure (1), not a reason to run make_file again
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    if not _owned(socket_path):
+        # the environment (credentials included) is sent to whoever listens
+        return None
+    request = json.dumps({
+        "make_file": os.path.abspath(make_file),
+        "argv": list(argv),
+        "cwd": cwd or os.getcwd(),
+        "env": dict(os.environ if env is None else env),
+    }).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+            socket.send_fds(client, [struct.pack("!i", len(request))], list(fds))
+            client.sendall(request)
+            client.shutdown(socket.SHUT_WR)
+        except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError, FileNotFoundError):
+            return None
+        data = b""
+        try:
+            while len(data) < 4:
+                chunk = client.recv(4 - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except ConnectionResetError:
+            pass
+    if len(data) < 4:
+        print("sane daemon: the make.py run ended without an exit code", file=sys.stderr)
+        return 1
+    return struct.unpack("!i", data)[0]
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        serve(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) >= 3 and sys.argv[1] == "run":
+        make_file, argv = sys.argv[2], sys.argv[3:]
+        code = run_in_daemon(make_file, argv)
+        if code is None:
+            code = run_make_file(make_file, argv)
+        sys.exit(code)
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import json
+import os
+import shutil
+import sys
+import typing
+
+import sh
+import structlog
+
+from krules_dev.sane_utils.nested import get_child_env
+from krules_dev.sane_utils.templating import write_if_changed
+from krules_dev.sane_utils.walker import Walker
+from krules_dev.sane_utils.watch import WatchRule
+
+log = structlog.get_logger()
+
+MANIFEST_FILE = ".context.json"
+
+
+def write_manifest(app_dir: str, out_dir: str, inputs: typing.Iterable[str]):
+    """
+    Records the inputs (absolute paths or globs) an app is built from, in <out_dir>/.context.json,
+    so that the affected apps can be found without running every make.py (see get_affected_apps)
+    """
+    out_dir = os.path.join(app_dir, out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    write_if_changed(os.path.join(out_dir, MANIFEST_FILE), json.dumps({
+        "app_dir": app_dir,
+        "inputs": sorted({os.path.normpath(os.path.join(app_dir, i)) for i in inputs}),
+    }, indent=1))
+
+
+def find_apps(project_dir: str) -> list[str]:
+    """
+    Directories of the apps (the ones with a make.py) within project_dir
+    """
+    return sorted(os.path.dirname(os.path.join(project_dir, f))
+                  for f in Walker().glob("**/make.py", project_dir) if os.path.dirname(f))
+
+
+def load_manifest(app_dir: str, out_dir: str = ".build", discover: bool = True) -> dict | None:
+    manifest_file = os.path.join(app_dir, out_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file) and discover:
+        # registering the recipes is enough to write the manifest
+        log.debug("Discovering app inputs", app_dir=app_dir)
+        try:
+            sh.Command(sys.executable)(os.path.join(app_dir, "make.py"), "--list", _cwd=app_dir,
+                                       _env=get_child_env())
+        except sh.ErrorReturnCode as ex:
+            log.debug("Cannot list recipes", app_dir=app_dir, ex=ex.stderr.decode())
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def build_reverse_index(project_dir: str, out_dir: str = ".build") -> dict[str, list[str]]:
+    """
+    Maps each input (path or glob) to the apps built from it. Every app depends on its own directory too
+    """
+    index: dict[str, list[str]] = {}
+    for app_dir in find_apps(project_dir):
+        manifest = load_manifest(app_dir, out_dir)
+        inputs = [app_dir, *(manifest["inputs"] if manifest is not None else [])]
+        if manifest is None:
+            log.warning("No inputs declared, assuming the app depends only on its own directory", app_dir=app_dir)
+        for i in inputs:
+            index.setdefault(i, []).append(app_dir)
+    return index
+
+
+def get_changed_files(since: str, base_dir: str) -> list[str]:
+    """
+    Files changed since the since revision (committed or not, untracked included), as absolute paths
+    """
+    git = sh.Command(shutil.which("git")).bake("--no-pager", _cwd=base_dir, _tty_out=False)
+    toplevel = str(git("rev-parse", "--show-toplevel")).strip()
+    changed = str(git("diff", "--name-only", since)).split("\n")
+    changed += str(git("ls-files", "--others", "--exclude-standard", "--full-name")).split("\n")
+    return sorted({os.path.join(toplevel, f) for f in changed if f})
+
+
+def get_affected_apps(changed_files: typing.Iterable[str], index: dict[str, list[str]]) -> list[str]:
+    changed_files = [os.path.abspath(f) for f in changed_files]
+    affected = set()
+    for input_path, apps in index.items():
+        if affected.issuperset(apps):
+            continue
+        rule = WatchRule([input_path])
+        if any(rule.matches(f) for f in changed_files):
+            affected.update(apps)
+    return sorted(affected)
@@ -4,21 +4,40 @@ import re
 import sys
 import os
 import inspect
+import json
 
 import shutil
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from pathlib import Path
 from typing import Callable
 
 from dotenv import load_dotenv
 from sane import recipe as base_recipe
+from sane import sane_run as base_sane_run
 from sane import _Help as Help
 import sh
 
 import logging
 
 from krules_dev import sane_utils
+from krules_dev.sane_utils.hashing import get_fingerprint, combine_digests
+from krules_dev.sane_utils.walker import Walker, expand_globs
+from krules_dev.sane_utils.context import BuildContext, sync_tree, normalize_context
+from krules_dev.sane_utils.cache import CacheSpec, ImageDigestCache, get_cache_dir, run_cached
+from krules_dev.sane_utils.remote_cache import get_remote_cache, image_entry_name
+from krules_dev.sane_utils import executor
+from krules_dev.sane_utils.nested import run_nested_make, get_child_env
+from krules_dev.sane_utils.scheduler import ImageBuildSpec, BuildFailed, build_images
+from krules_dev.sane_utils.affected import write_manifest, build_reverse_index, get_changed_files, get_affected_apps
+from krules_dev.sane_utils.watch import add_watch, get_watch_rules, get_watcher, wait_changes
+from krules_dev.sane_utils.registry import find_image, find_pushed_image, parse_push_digest, parse_image, \
+    get_registry_client, copy_image, get_platform, get_base_images, RegistryError
+from krules_dev.sane_utils.requirements import MERGED_REQUIREMENTS, MergedRequirementsDigest, \
+    write_merged_requirements
+from krules_dev.sane_utils.templating import get_template, get_render_ledger, template_fingerprint, write_if_changed
 
 # from krules_dev.sane_utils import root_dir
 # from krules_dev.sane_utils.google import root_dir
@@ -34,14 +53,31 @@ from structlog.contextvars import bind_contextvars, unbind_contextvars
 
 log = structlog.get_logger()
 
-abs_path = os.path.abspath(inspect.stack()[-1].filename)
+# SANE_MAKE_FILE is set when make.py does not run as the main script (eg: within the daemon, see sane_daemon).
+# It is consumed here so that nested make.py processes do not inherit it
+abs_path = os.path.abspath(os.environ.pop("SANE_MAKE_FILE", None) or inspect.stack()[-1].filename)
 root_dir = os.path.dirname(abs_path)
 
+executor.install()
+
+# base images resolved by this make.py (see get_buildable_image)
+BASE_IMAGES_FILE = ".base_images.json"
+_resolved_base_images: list[str] = []
+
+# out_dir of each make_render_resource_recipes call, resources rendered in a build context subdirectory
+# (eg: k8s manifests) are not part of the context (see make_prepare_build_context_recipes)
+_render_out_dirs: set[str] = set()
+
+# BuildContext of each out_dir prepared by make_prepare_build_context_recipes, see make_build_recipe
+_build_contexts: dict[str, BuildContext] = {}
+
 
 def recipe(*args, name=None, hooks=[], recipe_deps=[],
-           hook_deps=[], conditions=[], info=None, **kwargs):
+           hook_deps=[], conditions=[], info=None, cache: CacheSpec = None, **kwargs):
     """
-    Wraps sane_utils recipe to always have a name
+    Wraps sane_utils recipe to always have a name.
+    When cache is given, the recipe body is skipped and its outputs are restored from the local
+    content addressed cache (see cache.run_cached) if its declared inputs are unchanged
     """
 
     # frame = inspect.stack(context=3)[-1]
@@ -81,7 +117,10 @@ def recipe(*args, name=None, hooks=[], recipe_deps=[],
             bind_contextvars(
                 recipe=name,
             )
-            fn()
+            if cache is not None:
+                run_cached(name, fn, cache, root_dir)
+            else:
+                fn()
             unbind_contextvars("recipe")
 
         __wrapped__.__name__ = fn.__name__
@@ -183,6 +222,11 @@ def get_buildable_image(location: str,
                         push_cmd: str = "push",
                         digest_file: str = ".digest",
                         target: str = os.environ.get("TARGET", "default")):
+    """
+    Returns the image built and pushed by the make.py in location/dir_name, running its push_cmd recipe.
+    The digest is kept in a persistent cache (see cache.ImageDigestCache, SANE_IMAGE_CACHE=0 to disable)
+    keyed by the image inputs, registry and platform, so the recipe runs again only when they change
+    """
     if environ_override is not None and environ_override in os.environ:
         return os.environ[environ_override]
     if use_release_version and 'RELEASE_VERSION' in os.environ:
@@ -192,20 +236,64 @@ def get_buildable_image(location: str,
             name = f'krules-{dir_name}'
         return f'{docker_registry}/{name}:{os.environ["RELEASE_VERSION"]}'
     build_dir = os.path.join(location, dir_name)
+    _resolved_base_images.append(os.path.abspath(build_dir))
+    # the parent build, if any, learns which base images this one depends on
+    base_images_file = os.path.join(root_dir, out_dir, BASE_IMAGES_FILE)
+    os.makedirs(os.path.dirname(base_images_file), exist_ok=True)
+    write_if_changed(base_images_file, json.dumps(sorted(set(_resolved_base_images))))
+
+    use_cache = bool(int(os.environ.get("SANE_IMAGE_CACHE", "1")))
+    image_cache = ImageDigestCache()
+    key_args = _image_cache_key_args(target, push_cmd, docker_registry)
+
+    def _is_valid(base_dir):
+        base_key = ImageDigestCache.key(base_dir, out_dir, *key_args)
+        return base_key is not None and image_cache.contains(base_key, _is_valid)
+
+    key = use_cache and ImageDigestCache.key(build_dir, out_dir, *key_args) or None
+    if key is not None:
+        digest = image_cache.lookup(key, _is_valid)
+        if digest is not None:
+            log.debug("Image digest from cache", dir_name=dir_name, digest=digest)
+            return digest
+
     log.debug("Checking digest file", out_dir=out_dir, digest_file=digest_file, dir_name=dir_name)
     # log.debug(f"Ensuring {os.path.join(out_dir, digest_file)} in {dir_name}")
-    make = sh.Command(
-        check_cmd("python"),
-    ).bake(os.path.join(build_dir, "make.py"))
-    try:
-        env = os.environ.copy()
-        env.pop("IMAGE_NAME", None)
-        make(push_cmd, _env=env)
-    except sh.ErrorReturnCode as ex:
-        log.error(ex.stderr.decode())
+    env = get_child_env()
+    child_base_images_file = os.path.join(build_dir, out_dir, BASE_IMAGES_FILE)
+    if os.path.exists(child_base_images_file):
+        os.unlink(child_base_images_file)
+    exit_code = run_nested_make(os.path.join(build_dir, "make.py"), [push_cmd], env=env)
+    if exit_code != 0:
+        log.error("Nested make failed", build_dir=build_dir, exit_code=exit_code)
         sys.exit(-1)
     with open(os.path.join(build_dir, out_dir, digest_file), "r") as f:
-        return f.read().strip()
+        digest = f.read().strip()
+    if use_cache:
+        _store_image_digest(image_cache, build_dir, out_dir, digest, key_args)
+    return digest
+
+
+def _image_cache_key_args(target: str, push_cmd: str, docker_registry: str = None) -> tuple:
+    # registry, platform and salt of ImageDigestCache.key
+    return (
+        docker_registry or get_var_for_target("DOCKER_REGISTRY", target=target),
+        get_var_for_target("BUILD_PLATFORM", target=target, default="amd64"),
+        f"{target}:{push_cmd}",
+    )
+
+
+def _store_image_digest(image_cache: ImageDigestCache, build_dir: str, out_dir: str, digest: str, key_args: tuple):
+    # inputs are known once the image has been built
+    key = ImageDigestCache.key(build_dir, out_dir, *key_args)
+    if key is None:
+        return
+    try:
+        with open(os.path.join(build_dir, out_dir, BASE_IMAGES_FILE)) as f:
+            requires = json.load(f)
+    except FileNotFoundError:
+        requires = []
+    image_cache.store(key, build_dir, digest, requires)
 
 
 def get_image(image, environ_override: typing.Optional[str] = None):
@@ -256,29 +344,43 @@ def get_project_base(location):
 
 def update_code_hash(globs: list,
                      out_dir: str = ".build",
-                     output_file: str = ".code.digest"):
-    def _update_hash_within_dir(dir_path):
-        for filename in os.listdir(dir_path):
-            f = os.path.join(dir_path, filename)
-            if os.path.isfile(f):
-                code_hash.update(open(f, "rb").read())
-            else:
-                _update_hash_within_dir(f)
-
+                     output_file: str = ".code.digest",
+                     index_file: str = ".code.index",
+                     verify: bool = None,
+                     fingerprint: str = None,
+                     algorithm: str = None,
+                     base_dir: str = None):
+    """
+    Computes the code digest of the files matched by globs (directories are walked recursively).
+    Junk files and the ones excluded by .dockerignore/.gitignore files are skipped (see Walker).
+    Per-file digests are kept in a stat-keyed index within out_dir so that only changed files are read again.
+    Within a git checkout tracked files use their blob id from the git index (fingerprint "auto" or "git",
+    use "stat" or SANE_CODE_FINGERPRINT=stat to always hash from disk).
+    Set verify (or SANE_CODE_HASH_VERIFY=1) to ignore the index and rebuild it from scratch.
+    Files are hashed in parallel with algorithm (or SANE_CODE_HASH_ALGORITHM, eg: blake2b or xxh3_128), default md5.
+    Relative globs and out_dir are resolved against base_dir (default: root_dir)
+    """
+    if verify is None:
+        verify = bool(int(os.environ.get("SANE_CODE_HASH_VERIFY", "0")))
+    if fingerprint is None:
+        fingerprint = os.environ.get("SANE_CODE_FINGERPRINT", "auto")
+    if algorithm is None:
+        algorithm = os.environ.get("SANE_CODE_HASH_ALGORITHM", "md5")
+
+    if base_dir is None:
+        base_dir = root_dir
+    out_dir = os.path.join(base_dir, out_dir)
     Path(out_dir).mkdir(parents=True, exist_ok=True)
 
-    files = []
-    with pushd(root_dir):
-        for file in globs:
-            files.extend(glob(file, recursive=True))
+    walker = Walker()
+    files = [f for path in expand_globs(globs, base_dir, walker) for f in walker.walk(os.path.join(base_dir, path))]
 
-        code_hash = hashlib.md5()
-        for path in files:
-            if os.path.isfile(path):
-                code_hash.update(open(path, "rb").read())
-            else:
-                _update_hash_within_dir(path)
-        open(os.path.join(out_dir, output_file), "w").write(code_hash.hexdigest())
+    index = get_fingerprint(os.path.join(out_dir, index_file), fingerprint, verify=verify, base_dir=base_dir,
+                            algorithm=algorithm)
+    code_digest = combine_digests(index.digest_many(files), algorithm)
+    index.save()
+    with open(os.path.join(out_dir, output_file), "w") as f:
+        f.write(code_digest)
 
 
 def make_render_resource_recipes(globs: list,
@@ -286,16 +388,50 @@ def make_render_resource_recipes(globs: list,
                                  context_vars: typing.Union[dict, typing.Callable[[], dict]] = {},
                                  run_before: typing.Sequence[typing.Callable] = (),
                                  skip_unchanged=False,
+                                 batch: bool = None,
+                                 workers: int = None,
                                  **recipe_kwargs):
+    """
+    Registers a recipe rendering each jinja template matched by globs in out_dir.
+    Templates share a project Environment (see templating.get_jinja_env), so they can
+    {% import %} or {% include %} macros from the project or from $KRULES_PROJECT_DIR/base/templates.
+    Rendering is skipped when neither the template nor the context changed since the last render
+    (see <out_dir>/.render.ledger) and outputs are (atomically) written only when their content changes.
+    In batch mode (default from SANE_RENDER_BATCH) a single recipe renders all the templates
+    in a pool of workers (default from SANE_RENDER_WORKERS) sharing the same context
+    """
+    if batch is None:
+        batch = bool(int(os.environ.get("SANE_RENDER_BATCH", "0")))
+    _render_out_dirs.add(os.path.join(root_dir, out_dir))
+
+    from krules_dev.sane_utils import LOG_LEVEL
+
     def _context_vars():
         nonlocal context_vars
         if callable(context_vars):
             context_vars = context_vars()
         return context_vars
 
+    def _resource_file(j2_template):
+        return os.path.join(out_dir, os.path.split(j2_template)[1].split(".j2")[0])
+
+    def _render(j2_template, resource_file, context):
+        ledger = get_render_ledger(os.path.dirname(resource_file))
+        fingerprint = template_fingerprint(j2_template, root_dir, context)
+        if ledger.is_fresh(resource_file, fingerprint):
+            log.debug(f"Template and context unchanged, skip rendering", out_file=resource_file)
+            return
+        log.debug(f"Rendering...", out_file=resource_file)
+        tmpl = get_template(j2_template, root_dir).render(
+            context
+        )
+        if not write_if_changed(resource_file, tmpl):
+            log.debug(f"Rendered content unchanged", out_file=resource_file)
+        ledger.record(resource_file, fingerprint, tmpl)
+
     def _make_render_resource_recipe(j2_template):
 
-        resource_file = os.path.join(out_dir, os.path.split(j2_template)[1].split(".j2")[0])
+        resource_file = _resource_file(j2_template)
         resource_older_than_template = (
             Help.file_condition(
                 sources=[os.path.join(root_dir, j2_template)],
@@ -303,8 +439,6 @@ def make_render_resource_recipes(globs: list,
             )
         )
 
-        from krules_dev.sane_utils import LOG_LEVEL
-
         # show recipe to render template only if SANE_LOG_LEVEL < 20
         if LOG_LEVEL < logging.INFO:
             recipe_kwargs['info'] = "Render '{template}'".format(template=j2_template)
@@ -317,31 +451,164 @@ def make_render_resource_recipes(globs: list,
         if skip_unchanged:
             recipe_kwargs['conditions'].append(resource_older_than_template)
         recipe_kwargs['name'] = resource_file
+        add_watch([j2_template], [resource_file], base_dir=root_dir)
 
         @recipe(**recipe_kwargs)
         def render_resource():
-            with pushd(root_dir):
-                Path(out_dir).mkdir(parents=True, exist_ok=True)
-                for func in run_before:
-                    func()
-                from jinja2 import Template
-                log.debug(f"Rendering...", out_file=resource_file)
-                tmpl = Template(open(j2_template).read(), trim_blocks=True, lstrip_blocks=True, ).render(
-                    _context_vars()
-                )
-                open(resource_file, 'w').write(tmpl)
+            Path(root_dir, out_dir).mkdir(parents=True, exist_ok=True)
+            for func in run_before:
+                func()
+            _render(j2_template, os.path.join(root_dir, resource_file), _context_vars())
+
+    def _make_render_batch_recipe(j2_templates):
 
-    with pushd(root_dir):
+        if LOG_LEVEL < logging.INFO:
+            recipe_kwargs['info'] = f"Render {len(j2_templates)} templates in '{out_dir}'"
+        else:
+            recipe_kwargs.pop("info", None)
+        recipe_kwargs['name'] = f"render {', '.join(globs)} -> {out_dir}"
+        add_watch(j2_templates, [recipe_kwargs['name']], base_dir=root_dir)
 
-        j2_templates = []
+        @recipe(**recipe_kwargs)
+        def render_resources():
+            Path(root_dir, out_dir).mkdir(parents=True, exist_ok=True)
+            for func in run_before:
+                func()
+            # the context is computed once and shared (read only) by all the workers
+            context = _context_vars()
+
+            todo = []
+            for j2_template in j2_templates:
+                template_file = os.path.join(root_dir, j2_template)
+                resource_file = os.path.join(root_dir, _resource_file(j2_template))
+                if skip_unchanged and os.path.exists(resource_file) and \
+                        os.path.getmtime(resource_file) >= os.path.getmtime(template_file):
+                    continue
+                todo.append((j2_template, resource_file))
+
+            def _timed_render(args):
+                start = time.perf_counter()
+                _render(*args, context)
+                log.debug("Rendered", template=args[0], elapsed=f"{time.perf_counter() - start:.3f}s")
+
+            n_workers = workers or int(os.environ.get("SANE_RENDER_WORKERS", "0")) or min(8, (os.cpu_count() or 1) + 4)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                list(pool.map(_timed_render, todo))
+            log.debug("Templates rendered", out_dir=out_dir, rendered=len(todo),
+                      skipped=len(j2_templates) - len(todo), elapsed=f"{time.perf_counter() - start:.3f}s")
+
+    j2_templates = []
+
+    for file in globs:
+        j2_templates.extend(glob(file, root_dir=root_dir))
+
+    if batch:
+        if j2_templates:
+            _make_render_batch_recipe(j2_templates)
+        return
+
+    for template in j2_templates:
+        _make_render_resource_recipe(
+            template
+        )
 
-        for file in globs:
-            j2_templates.extend(glob(file))
 
-        for template in j2_templates:
-            _make_render_resource_recipe(
-                template
-            )
+def get_build_cache_args(target_image: str, target: str = None) -> list[str]:
+    """
+    docker buildx layer cache options from BUILD_CACHE (see get_var_for_target): "registry" keeps the cache
+    in <image>:buildcache (or BUILD_CACHE_REF), "local" in BUILD_CACHE_DIR (default <cache dir>/buildx/<image>),
+    "inline" within the pushed image itself. Registry and local caches are exported with mode=max
+    (intermediate layers too), they need a docker-container builder (eg: selected by BUILDX_BUILDER).
+    Empty or "0" (default) disables the cache
+    """
+    mode = get_var_for_target("BUILD_CACHE", target=target, default="0").lower()
+    if mode in ("", "0", "false", "no"):
+        return []
+    # drop the tag, if any
+    repository = target_image.rsplit(":", 1)[0] if ":" in target_image.rsplit("/", 1)[-1] else target_image
+    if mode == "registry":
+        ref = get_var_for_target("BUILD_CACHE_REF", target=target, default=f"{repository}:buildcache")
+        return ["--cache-from", f"type=registry,ref={ref}", "--cache-to", f"type=registry,ref={ref},mode=max"]
+    if mode == "local":
+        cache_dir = get_var_for_target(
+            "BUILD_CACHE_DIR", target=target,
+            default=os.path.join(get_cache_dir(), "buildx", re.sub(r"[^\w.-]", "_", repository))
+        )
+        return ["--cache-from", f"type=local,src={cache_dir}", "--cache-to", f"type=local,dest={cache_dir},mode=max"]
+    if mode == "inline":
+        return ["--cache-from", f"type=registry,ref={repository}", "--cache-to", "type=inline"]
+    log.error("Unknown build cache", build_cache=mode, supported="registry, local, inline")
+    sys.exit(-1)
+
+
+def get_source_date_epoch(target: str = None) -> int | None:
+    """
+    With REPRODUCIBLE_BUILD set (see get_var_for_target), the timestamp of every file in build contexts and image
+    layers: SOURCE_DATE_EPOCH, default 1980-01-01 (the oldest a zip archive can hold). None otherwise
+    """
+    if get_var_for_target("REPRODUCIBLE_BUILD", target=target, default="0").lower() in ("", "0", "false", "no"):
+        return None
+    return int(get_var_for_target("SOURCE_DATE_EPOCH", target=target, default="315532800"))
+
+
+def get_reproducible_build_args(target: str = None) -> list[str]:
+    """
+    docker buildx options for reproducible builds (see get_source_date_epoch): image and layer timestamps are
+    clamped to SOURCE_DATE_EPOCH (rewrite-timestamp needs buildx >= 0.13), the image is loaded as with --load
+    """
+    epoch = get_source_date_epoch(target)
+    if epoch is None:
+        return []
+    return ["--build-arg", f"SOURCE_DATE_EPOCH={epoch}", "--output", "type=docker,rewrite-timestamp=true"]
+
+
+def get_content_tag(code_digest_file: str, target: str = None, platform: str = "amd64", build_args: dict = None,
+                    dockerfile: str = None) -> str | None:
+    """
+    Image tag naming what the image is built from, when CONTENT_TAGS is set (see get_var_for_target):
+    code-<digest> of the code digest (see update_code_hash), the platform, the build args and the rendered dockerfile.
+    The same inputs get the same tag for every target
+    """
+    if not int(get_var_for_target("CONTENT_TAGS", target=target, default="0")):
+        return None
+    try:
+        with open(code_digest_file) as f:
+            code_digest = f.read().strip()
+    except FileNotFoundError:
+        return None
+    if not code_digest:
+        return None
+    dockerfile_digest = ""
+    if dockerfile is not None and os.path.exists(dockerfile):
+        with open(dockerfile, "rb") as f:
+            dockerfile_digest = hashlib.sha256(f.read()).hexdigest()
+    key = json.dumps([
+        code_digest,
+        "/".join(get_platform(platform)),
+        sorted((k, str(v)) for k, v in (build_args or {}).items()),
+        dockerfile_digest,
+    ])
+    return f"code-{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def find_content_image(image_name: str, content_tag: str, target: str = None) -> str | None:
+    """
+    "<repository>@<digest>" of image_name with content_tag in the target registry (DOCKER_REGISTRY)
+    or else in the shared one (SHARED_DOCKER_REGISTRY, if any), None if neither holds it
+    """
+    registries = [get_var_for_target("DOCKER_REGISTRY", target=target),
+                  get_var_for_target("SHARED_DOCKER_REGISTRY", target=target)]
+    for registry in filter(None, registries):
+        image = f"{registry}/{image_name}:{content_tag}".lower()
+        try:
+            found = find_image(image)
+        except Exception as ex:
+            log.debug("Cannot check the registry", image=image, ex=str(ex))
+            continue
+        if found is not None:
+            return found
+    return None
 
 
 def make_build_recipe(image_name: str = None,
@@ -352,8 +619,19 @@ def make_build_recipe(image_name: str = None,
                       success_file: str = None,
                       build_args: dict = {},
                       target: str = os.environ.get("TARGET", "default"),
+                      context: BuildContext = None,
+                      context_dir: str = None,
                       **recipe_kwargs):
-    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    """
+    When a context is given (see make_prepare_build_context_recipes) it is streamed
+    as a tar archive to `docker build -` instead of building from the out_dir copy.
+    Otherwise out_dir is the build context, as the COPY instructions of the Dockerfile templates
+    (see macros.j2) expect; context_dir="." builds from root_dir as before, for Dockerfiles copying root_dir paths.
+    With a layer cache configured (see get_build_cache_args) the image is built by `docker buildx build --load`,
+    the same for reproducible builds (see get_reproducible_build_args), which also normalize the files of the
+    out_dir context (see context.normalize_context) or the streamed ones
+    """
+    Path(root_dir, out_dir).mkdir(parents=True, exist_ok=True)
 
     if image_name is None:
         image_name = check_env('IMAGE_NAME')
@@ -363,6 +641,14 @@ def make_build_recipe(image_name: str = None,
     docker_cmd = check_cmd("docker")
     if success_file is None:
         success_file = f".{recipe_kwargs['name']}.success"
+    # local image id (config digest), see make_push_recipe
+    iid_file = os.path.join(root_dir, out_dir, f".{recipe_kwargs['name']}.iid")
+    # image with the same content tag found in the target registry, see make_push_recipe
+    content_file = os.path.join(root_dir, out_dir, f".{recipe_kwargs['name']}.content")
+    # name of the remote cache entry of the image, see make_push_recipe
+    remote_entry_file = os.path.join(root_dir, out_dir, f".{recipe_kwargs['name']}.remote")
+    # content tag of the image (see get_content_tag), see make_push_recipe
+    content_tag_file = os.path.join(root_dir, out_dir, f".{recipe_kwargs['name']}.tag")
     if 'info' not in recipe_kwargs:
         recipe_kwargs['info'] = "Build the docker image as {image_name}"
     recipe_kwargs['info'] = recipe_kwargs['info'].format(image_name=image_name)
@@ -385,41 +671,132 @@ def make_build_recipe(image_name: str = None,
             log.debug(f"..executing run_before", func=func.__name__)
             func()
 
-        with pushd(root_dir):
-            # _build_args = " ".join([f"--build-arg {v[0]}={v[1]}" for v in build_args.items()])
+        build_platform = get_var_for_target("BUILD_PLATFORM", target=target, default="amd64")
+
+        content_tag = get_content_tag(code_digest_file, target, build_platform, build_args,
+                                      os.path.join(root_dir, out_dir, dockerfile))
+        # the push recipe does not know the build inputs
+        if content_tag is not None:
+            with open(content_tag_file, "w") as f:
+                f.write(content_tag)
+        elif os.path.exists(content_tag_file):
+            os.unlink(content_tag_file)
+
+        remote_cache = get_remote_cache()
+        if remote_cache is not None and os.path.exists(code_digest_file):
+            code_digest = open(code_digest_file, "r").read()
+            built_dockerfile = os.path.join(root_dir, out_dir, dockerfile)
+            entry_name = image_entry_name(target_image, code_digest, build_platform, build_args, built_dockerfile,
+                                          get_base_images(built_dockerfile) if os.path.exists(built_dockerfile) else ())
+            # the push recipe does not know the build args
+            with open(remote_entry_file, "w") as f:
+                f.write(entry_name)
+            entry = remote_cache.get_json(entry_name)
+            if entry is not None:
+                with open(success_file, "w") as f:
+                    f.write(code_digest)
+                log.info("Image already built and pushed from the same code, skip building",
+                         target_image=target_image, repo_digest=entry["repo_digest"])
+                return
+
+        docker = sh.Command(docker_cmd).bake(_cwd=root_dir)
+
+        if os.path.exists(content_file):
+            os.unlink(content_file)
+        if content_tag is not None:
+            found = find_content_image(image_name, content_tag, target)
+            if found is not None:
+                if found.startswith(f"{target_image}@"):
+                    with open(content_file, "w") as f:
+                        json.dump({"content_tag": content_tag, "repo_digest": found}, f)
+                else:
+                    # from the shared registry, pushed as usual
+                    docker.pull(found)
+                    docker.tag(found, target_image)
+                    docker.tag(found, f"{target_image}:{content_tag}")
+                    if os.path.exists(iid_file):
+                        os.unlink(iid_file)
+                with open(success_file, "w") as f:
+                    f.write(open(code_digest_file).read())
+                log.info("Image with the same content found, skip building", content_tag=content_tag, image=found)
+                return
 
-            build_platform = get_var_for_target("BUILD_PLATFORM", target=target, default="amd64")
+        # _build_args = " ".join([f"--build-arg {v[0]}={v[1]}" for v in build_args.items()])
 
-            docker = sh.Command(docker_cmd)
+        source_date_epoch = get_source_date_epoch(target)
+        if context is not None:
+            context_args = {"_in": context.iter_tar(mtime=source_date_epoch)}
+            dockerfile_path = dockerfile
+            context_path = "-"
+        else:
+            if source_date_epoch is not None and context_dir is None:
+                context_path = os.path.join(root_dir, out_dir)
+                normalize_context(_build_contexts.get(context_path) or
+                                  BuildContext(artifacts_dir=context_path, exclude=_render_out_dirs),
+                                  context_path, source_date_epoch)
+            context_args = {}
+            dockerfile_path = os.path.join(out_dir, dockerfile)
+            context_path = out_dir if context_dir is None else context_dir
+
+        cache_args = get_build_cache_args(target_image, target)
+        reproducible_args = get_reproducible_build_args(target)
+        if cache_args or reproducible_args:
+            log.debug("Building with buildx", cache=cache_args, reproducible=bool(reproducible_args))
+            build_cmd = docker.buildx.build.bake(*cache_args, *(reproducible_args or ["--load"]))
+        else:
+            build_cmd = docker.build
 
+        try:
             try:
+                build_cmd(
+                    "--platform", build_platform,
+                    "--iidfile", iid_file,
+                    "-t", target_image,
+                    *(["-t", f"{target_image}:{content_tag}"] if content_tag is not None else []),
+                    "-f", dockerfile_path,
+                    *[item for row in [("--build-arg", f"{v[0]}={v[1]}") for v in build_args.items()] for item in
+                      row],
+                    context_path,
+                    _tee='err',
+                    **context_args,
+                )
+            except sh.ErrorReturnCode as ex:
+                log.error(ex.stderr.decode())
+                sys.exit(ex.exit_code)
+
+            with open(success_file, "w") as f:
                 try:
-                    docker.build(
-                        "--platform", build_platform,
-                        "-t", target_image, "-f", os.path.join(out_dir, dockerfile),
-                        *[item for row in [("--build-arg", f"{v[0]}={v[1]}") for v in build_args.items()] for item in
-                          row],
-                        ".",
-                        _tee='err',
-                    )
-                except sh.ErrorReturnCode as ex:
-                    log.error(ex.stderr.decode())
-                    sys.exit(ex.exit_code)
+                    code_digest = open(code_digest_file, "r").read()
+                except FileNotFoundError:
+                    code_digest = ""
+                f.write(code_digest)
 
-                with open(success_file, "w") as f:
-                    try:
-                        code_digest = open(code_digest_file, "r").read()
-                    except FileNotFoundError:
-                        code_digest = ""
-                    f.write(code_digest)
+            log.info("Built image", target_image=target_image)
 
-                log.info("Built image", target_image=target_image)
+        except sh.ErrorReturnCode as ex:
+            if os.path.exists(success_file):
+                os.unlink(success_file)
+            log.error(f"Unable to build image", target_image=target_image)
+            raise ex
 
-            except sh.ErrorReturnCode as ex:
-                if os.path.exists(success_file):
-                    os.unlink(success_file)
-                log.error(f"Unable to build image", target_image=target_image)
-                raise ex
+
+def _find_pushed_digest(docker, target_image: str, tag: str, build_recipe: str, out_dir: str, target: str) -> str | None:
+    # "<repository>@<digest>" when the registry already holds the local image under tag
+    iid_file = os.path.join(root_dir, out_dir, f".{build_recipe}.iid")
+    try:
+        image_id = open(iid_file).read().strip()
+    except FileNotFoundError:
+        try:
+            image_id = str(docker.image.inspect("--format={{.Id}}", tag)).strip()
+        except sh.ErrorReturnCode:
+            return None
+    platform = get_var_for_target("BUILD_PLATFORM", target=target, default="amd64")
+    try:
+        digest = find_pushed_image(tag, image_id, platform)
+    except Exception as ex:
+        log.debug("Cannot check the registry, pushing", image=tag, ex=str(ex))
+        return None
+    return digest and f"{target_image}@{digest}"
 
 
 def make_push_recipe(target: str,
@@ -430,7 +807,7 @@ def make_push_recipe(target: str,
                      run_before: typing.Sequence[typing.Callable] = (),
                      dependent_build_recipe: str = "build",
                      **recipe_kwargs):
-    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    Path(root_dir, out_dir).mkdir(parents=True, exist_ok=True)
 
     if 'name' not in recipe_kwargs:
         recipe_kwargs['name'] = "push"
@@ -471,21 +848,147 @@ def make_push_recipe(target: str,
 
         log.debug(f'Pushing...', tag=_tag)
 
-        with pushd(root_dir):
-            docker = sh.Command(check_cmd("docker"))
+        remote_cache = get_remote_cache()
+        entry = None
+        try:
+            code_digest = open(os.path.join(root_dir, out_dir, f".{dependent_build_recipe}.success")).read()
+        except FileNotFoundError:
+            code_digest = ""
+        try:
+            entry_name = open(os.path.join(root_dir, out_dir, f".{dependent_build_recipe}.remote")).read()
+        except FileNotFoundError:
+            entry_name = None
+        if remote_cache is not None and code_digest and entry_name:
+            entry = remote_cache.get_json(entry_name)
+
+        of = os.path.join(root_dir, out_dir, digest_file)
+        docker = sh.Command(check_cmd("docker")).bake(_cwd=root_dir)
+        if entry is not None:
+            if not tag or tag in entry["tags"]:
+                with open(of, "w") as f:
+                    f.write(entry["digest_file"])
+                log.info("Image already pushed from the same code, skip pushing", repo_digest=entry["repo_digest"])
+                return
+            try:
+                docker.image.inspect(target_image, _out=os.devnull)
+            except sh.ErrorReturnCode:
+                # the build was skipped on a remote cache hit
+                docker.pull(entry["repo_digest"])
+                docker.tag(entry["repo_digest"], target_image)
+        try:
+            content_tag = open(os.path.join(root_dir, out_dir, f".{dependent_build_recipe}.tag")).read() or None
+        except FileNotFoundError:
+            content_tag = None
+        try:
+            with open(os.path.join(root_dir, out_dir, f".{dependent_build_recipe}.content")) as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            content = None
+        if content_tag is not None and content is not None and content["content_tag"] == content_tag:
+            # the image is already in the registry, at most it needs the release tag
             if tag:
-                docker.tag(
-                    target_image, tag
-                )
-            docker.push(_tag)
-            of = os.path.join(out_dir, digest_file)
-            with open(of, "wb") as f:
-                docker.inspect(
-                    f'--format="{{{{index .RepoDigests 0}}}}"',
-                    _tag,
-                    _out=f,
-                )
+                host, repository, _ = parse_image(target_image)
+                get_registry_client(host).tag(repository, content["repo_digest"].split("@")[1], tag)
+            with open(of, "w") as f:
+                f.write(f'"{content["repo_digest"]}"\n')
+            log.info("Image with the same content already pushed, skip pushing",
+                     repo_digest=content["repo_digest"], tag=tag)
+            return
+
+        if tag:
+            docker.tag(target_image, _tag)
+
+        # the digest file holds the quoted "<repository>@<digest>", as docker inspect formats it
+        repo_digest = None
+        if bool(int(os.environ.get("SANE_REGISTRY_CHECK", "1"))):
+            repo_digest = _find_pushed_digest(docker, target_image, _tag, dependent_build_recipe, out_dir, target)
+        if repo_digest is not None:
+            with open(of, "w") as f:
+                f.write(f'"{repo_digest}"\n')
+            log.info("Image already in the registry, skip pushing", repo_digest=repo_digest)
+        else:
+            pushed = docker.push(_tag)
+            digest = parse_push_digest(str(pushed))
+            if digest is not None:
+                with open(of, "w") as f:
+                    f.write(f'"{target_image}@{digest}"\n')
+            else:
+                with open(of, "wb") as f:
+                    docker.inspect(
+                        f'--format="{{{{index .RepoDigests 0}}}}"',
+                        _tag,
+                        _out=f,
+                    )
             log.info("Pushed", digest=open(of, "r").read())
+        if content_tag is not None:
+            # so that other targets find it (see make_build_recipe)
+            repo_digest = open(of, "r").read().strip().strip('"')
+            host, repository, _ = parse_image(target_image)
+            try:
+                get_registry_client(host).tag(repository, repo_digest.split("@")[1], content_tag)
+            except Exception as ex:
+                log.debug("Cannot tag in the registry, pushing the content tag", ex=str(ex))
+                docker.tag(target_image, f"{target_image}:{content_tag}")
+                docker.push(f"{target_image}:{content_tag}")
+        if remote_cache is not None and code_digest and entry_name:
+            tags = set(entry["tags"] if entry is not None else [])
+            if tag:
+                tags.add(tag)
+            remote_cache.put_json(entry_name, {
+                "digest_file": open(of, "r").read(),
+                "repo_digest": open(of, "r").read().strip().strip('"'),
+                "tags": sorted(tags),
+            })
+
+
+def make_promote_recipe(target: str,
+                        source_target: str = None,
+                        digest_file: str = ".digest",
+                        out_dir: str = ".build",
+                        tag: str = os.environ.get("RELEASE_VERSION"),
+                        image_name: str = None,
+                        **recipe_kwargs):
+    """
+    Registers a recipe copying an already pushed image from the registry of source_target (or from the image
+    reference in PROMOTE_FROM, or PROMOTE_FROM_TARGET's registry) to the registry of target, through the registry
+    API: nothing is built nor pulled and the digest stays the same, so that what is deployed is exactly what
+    was tested. The digest file is written as the push recipe does
+    """
+    Path(root_dir, out_dir).mkdir(parents=True, exist_ok=True)
+
+    if 'name' not in recipe_kwargs:
+        recipe_kwargs['name'] = "promote"
+
+    if image_name is None:
+        image_name = check_env('IMAGE_NAME')
+
+    docker_registry = get_var_for_target('DOCKER_REGISTRY', target=target, mandatory=True)
+    target_image = f"{docker_registry}/{image_name}".lower()
+    _tag = f'{target_image}:{tag or "latest"}'
+
+    if 'info' not in recipe_kwargs:
+        recipe_kwargs['info'] = f"Promote image to {_tag}"
+
+    @recipe(**recipe_kwargs)
+    def promote():
+        source_image = os.environ.get("PROMOTE_FROM")
+        if source_image is None:
+            _source_target = source_target or os.environ.get("PROMOTE_FROM_TARGET")
+            if _source_target is None:
+                log.error("One of PROMOTE_FROM or PROMOTE_FROM_TARGET needed", image=image_name)
+                sys.exit(-1)
+            source_registry = get_var_for_target('DOCKER_REGISTRY', target=_source_target, mandatory=True)
+            source_image = f"{source_registry}/{image_name}:{tag or 'latest'}".lower()
+
+        log.debug("Promoting...", source=source_image, destination=_tag)
+        try:
+            digest = copy_image(source_image, _tag)
+        except RegistryError as ex:
+            log.error("Unable to promote image", source=source_image, destination=_tag, ex=str(ex))
+            sys.exit(-1)
+        with open(os.path.join(root_dir, out_dir, digest_file), "w") as f:
+            f.write(f'"{target_image}@{digest}"\n')
+        log.info("Promoted", source=source_image, repo_digest=f"{target_image}@{digest}")
 
 
 def make_apply_recipe(globs: typing.Iterable[str], run_before: typing.Iterable[typing.Callable] = (),
@@ -500,13 +1003,12 @@ def make_apply_recipe(globs: typing.Iterable[str], run_before: typing.Iterable[t
         kubectl = get_cmd_from_env("kubectl")
         for func in run_before:
             func()
-        with pushd(root_dir):
-            k8s_files = []
-            for file in globs:
-                k8s_files.extend(glob(file))
-            for file in sorted(k8s_files):
-                log.info(f"Applying {file}..")
-                kubectl.apply("-f", file)
+        k8s_files = []
+        for file in globs:
+            k8s_files.extend(glob(file, root_dir=root_dir))
+        for file in sorted(k8s_files):
+            log.info(f"Applying {file}..")
+            kubectl.apply("-f", file, _cwd=root_dir)
 
 
 def make_apply_k8s_templates_recipe(
@@ -555,22 +1057,28 @@ def make_clean_recipe(globs, on_completed=lambda: None, **recipe_kwargs):
 
     @recipe(**recipe_kwargs)
     def clean():
-        with pushd(root_dir):
-            files = [*glob("sane.py")]
-            for file in globs:
-                files.extend(glob(file))
-            for f in files:
-                if os.path.isdir(f):
-                    log.debug(f"Cleaning...", directory=f)
-                    shutil.rmtree(f)
-                else:
-                    log.debug(f"Cleaning...", file=f)
-                    os.unlink(f)
-            on_completed()
+        files = [*glob("sane.py", root_dir=root_dir)]
+        for file in globs:
+            files.extend(glob(file, root_dir=root_dir))
+        for f in files:
+            path = os.path.join(root_dir, f)
+            if os.path.isdir(path):
+                log.debug(f"Cleaning...", directory=f)
+                shutil.rmtree(path)
+            else:
+                log.debug(f"Cleaning...", file=f)
+                os.unlink(path)
+        on_completed()
 
 
 @contextlib.contextmanager
 def pushd(new_dir):
+    """
+    Kept for make.py files using it: sane_utils itself resolves paths against explicit base directories.
+    The working directory is process wide, recipes running in parallel (see executor) would see each other's
+    """
+    if executor.get_jobs() > 1:
+        log.warning("pushd is not safe while recipes run in parallel, use explicit paths", new_dir=new_dir)
     old_dir = os.getcwd()
     os.chdir(new_dir)
     try:
@@ -579,11 +1087,37 @@ def pushd(new_dir):
         os.chdir(old_dir)
 
 
+def sane_run(default=None, cli=True):
+    """
+    sane.sane_run accepting also -j/--jobs N to run up to N independent recipes at a time
+    (same as --threads N, default from SANE_JOBS)
+    """
+    if cli:
+        argv = sys.argv[1:]
+        for i, arg in enumerate(argv):
+            if arg in ("-j", "--jobs"):
+                argv[i] = "--threads"
+            elif arg.startswith("-j") and arg[2:].isdigit():
+                argv[i:i + 1] = ["--threads", arg[2:]]
+                break
+            elif arg.startswith("--jobs="):
+                argv[i] = f"--threads={arg[len('--jobs='):]}"
+        sys.argv[1:] = argv
+    base_sane_run(default, cli)
+
+
 def copy_resources(src: typing.Iterable[str], dst: str,
                    override: bool = True,
                    # make_recipes_before: typing.Iterable = (),
                    make_recipes_hooks: typing.Iterable = (),
-                   workdir: str = None):
+                   workdir: str = None,
+                   sync: bool = None):
+    """
+    Copies src files and directories within dst.
+    In sync mode (default, SANE_SYNC_CONTEXT=0 to disable) destinations are updated incrementally:
+    only changed files are copied (or linked, see SANE_SYNC_LINK), stale ones are removed
+    and unchanged files keep their mtime (SOURCE_DATE_EPOCH for reproducible builds, see get_source_date_epoch)
+    """
     # for recipe in make_recipes_before:
     #     for f in src:
     #         fname=os.path.basename(f)
@@ -597,16 +1131,24 @@ def copy_resources(src: typing.Iterable[str], dst: str,
     if workdir is None:
         workdir = os.path.abspath(inspect.stack()[1].filename)
     dest_dir = os.path.dirname(workdir)
-
-    with pushd(dest_dir):
-        os.makedirs(dst, exist_ok=True)
-        for p in src:
-            if p.endswith("/"):
-                p = p[:-1]
-            basename = os.path.basename(p)
-            if basename in ("", "."):
-                continue
-            to_path = os.path.join(dst, basename)
+    if sync is None:
+        sync = bool(int(os.environ.get("SANE_SYNC_CONTEXT", "1")))
+
+    walker = Walker()
+    dst = os.path.join(dest_dir, dst)
+    os.makedirs(dst, exist_ok=True)
+    for p in src:
+        if p.endswith("/"):
+            p = p[:-1]
+        p = os.path.join(dest_dir, p)
+        basename = os.path.basename(p)
+        if basename in ("", "."):
+            continue
+        to_path = os.path.join(dst, basename)
+        if sync and override:
+            log.debug("Syncing...", path=p, to_path=to_path)
+            sync_tree(p, to_path, walker, mtime=get_source_date_epoch())
+        else:
             if os.path.exists(to_path):
                 if override:
                     if os.path.isdir(to_path):
@@ -620,16 +1162,22 @@ def copy_resources(src: typing.Iterable[str], dst: str,
                     sys.exit(-1)
             if os.path.isdir(p):
                 log.debug("Copying...", directory=p, to_path=to_path, override=override)
-                shutil.copytree(p, to_path)
+                for f in walker.walk(p):
+                    dest_file = os.path.join(to_path, os.path.relpath(f, p))
+                    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+                    shutil.copy2(f, dest_file)
+                os.makedirs(to_path, exist_ok=True)
             else:
                 log.debug("Copying...", file=p, to_path=to_path, override=override)
                 shutil.copyfile(p, to_path)
-            for recipe in make_recipes_hooks:
-                make_py = os.path.join(to_path, "make.py")
-                log.debug("Hook recipe", make=make_py, hooked=recipe)
-                if os.path.exists(make_py):
-                    make = sh.Command("python").bake(make_py)
-                    make(recipe)
+        for recipe in make_recipes_hooks:
+            make_py = os.path.join(to_path, "make.py")
+            log.debug("Hook recipe", make=make_py, hooked=recipe)
+            if os.path.exists(make_py):
+                exit_code = run_nested_make(make_py, [recipe], cwd=dest_dir)
+                if exit_code != 0:
+                    log.error("Hook recipe failed", make=make_py, hooked=recipe, exit_code=exit_code)
+                    sys.exit(-1)
 
 
 def copy_source(src: typing.Union[typing.Iterable[str], str],
@@ -669,6 +1217,7 @@ def make_copy_source_recipe(location: str,
     src = list(map(lambda x: os.path.join(location, x), src))
     if workdir is None:
         workdir = os.path.abspath(inspect.stack()[1].filename)
+    add_watch(src, [recipe_kwargs.get("name", "_recipe")], base_dir=os.path.dirname(workdir))
 
     @recipe(**recipe_kwargs)
     def _recipe():
@@ -728,11 +1277,30 @@ def make_run_terraform_recipe(manifests_dir="terraform", init_params=(), **recip
     @recipe(info="Apply terraform manifests", **recipe_kwargs)
     def run_terraform():
         terraform = get_cmd_from_env("terraform")
-        with pushd(manifests_dir):
-            log.info("Applying terraform manifests...")
-            terraform.init("--upgrade", *init_params, _fg=True)
-            terraform.plan("-out=terraform.tfplan", _fg=True)
-            terraform.apply("-auto-approve", "terraform.tfplan", _fg=True)
+        cwd = os.path.join(root_dir, manifests_dir)
+        log.info("Applying terraform manifests...")
+        terraform.init("--upgrade", *init_params, _fg=True, _cwd=cwd)
+        terraform.plan("-out=terraform.tfplan", _fg=True, _cwd=cwd)
+        terraform.apply("-auto-approve", "terraform.tfplan", _fg=True, _cwd=cwd)
+
+
+def make_merge_requirements_recipe(requirements_files: typing.Sequence[str], out_dir: str = ".build",
+                                   **recipe_kwargs) -> MergedRequirementsDigest:
+    """
+    Registers the recipe merging requirements_files (relative to root_dir) in <out_dir>/requirements.merged.txt
+    (see requirements.merge_requirements), run again whenever any of them changes (see make_watch_recipe).
+    Returns the digest of the merged file, for the templates (requirements_digest)
+    """
+    if 'name' not in recipe_kwargs:
+        recipe_kwargs['name'] = 'prepare_requirements'
+    add_watch(requirements_files, [recipe_kwargs['name']], base_dir=root_dir)
+
+    @recipe(**recipe_kwargs)
+    def merge_requirements():
+        write_merged_requirements(os.path.join(root_dir, out_dir),
+                                  [os.path.join(root_dir, r) for r in requirements_files])
+
+    return MergedRequirementsDigest(os.path.join(root_dir, out_dir))
 
 
 def make_prepare_build_context_recipes(
@@ -742,9 +1310,20 @@ def make_prepare_build_context_recipes(
         sources: list | tuple = (),
         out_dir: str = ".build",
         context_vars: dict = None,
+        stream_context: bool = None,
+        requirements: list | tuple = ("requirements.txt",),
         **recipe_kwargs,
 
-):
+) -> BuildContext:
+    """
+    Registers the recipes preparing the docker build context (sources, base libraries and Dockerfile) in out_dir.
+    Returns the same context as a BuildContext: with stream_context (or STREAM_CONTEXT=1) sources and libraries
+    are not copied at all and the returned context is meant to be streamed by make_build_recipe.
+    The app requirements files (relative to root_dir) and the requirements.txt of each base library are merged
+    in requirements.merged.txt (merged, not pinned) by their own recipe (see make_merge_requirements_recipe),
+    Dockerfile.j2 gets its name (requirements_file) and digest (requirements_digest)
+    to install dependencies in their own layer (see the install_requirements macro in macros.j2)
+    """
     target, _ = sane_utils.get_targets_info()
 
     bind_contextvars(
@@ -778,25 +1357,49 @@ def make_prepare_build_context_recipes(
             )
             origins.append(source[0])
 
-    sane_utils.make_copy_source_recipe(
-        name="prepare_source_files",
-        # info="Copy the source files within the designated context to prepare for the container build.",
-        location=root_dir,
-        src=origins,
-        dst="",
-        out_dir=os.path.join(root_dir, out_dir),
+    if stream_context is None:
+        stream_context = bool(int(sane_utils.get_var_for_target("STREAM_CONTEXT", target, default="0")))
+
+    baselibs_dir = os.path.join(sane_utils.check_env("KRULES_PROJECT_DIR"), "base", "libs")
+
+    # same layout produced by the copy recipes, plus the Dockerfile and whatever else is generated in out_dir
+    build_context = BuildContext(artifacts_dir=os.path.join(root_dir, out_dir), exclude=_render_out_dirs)
+    _build_contexts[os.path.join(root_dir, out_dir)] = build_context
+    for origin in origins:
+        build_context.add(os.path.join(root_dir, origin), os.path.basename(origin.rstrip("/")))
+    for baselib in baselibs:
+        build_context.add(os.path.join(baselibs_dir, baselib), f".user-baselibs/{os.path.basename(baselib.rstrip('/'))}")
+    requirements_digest = make_merge_requirements_recipe(
+        [*requirements, *[os.path.join(baselibs_dir, b, "requirements.txt") for b in baselibs]],
+        out_dir=out_dir,
         hooks=["prepare_context"],
     )
 
-    sane_utils.make_copy_source_recipe(
-        name="prepare_user_baselibs",
-        # info="Copy base libraries within the designated context to prepare for the container build.",
-        location=os.path.join(sane_utils.check_env("KRULES_PROJECT_DIR"), "base", "libs"),
-        src=baselibs,
-        dst=".user-baselibs",
-        out_dir=os.path.join(root_dir, out_dir),
-        hooks=["prepare_context"],
-    )
+    write_manifest(root_dir, out_dir, [*origins, *[os.path.join(baselibs_dir, b) for b in baselibs]])
+
+    if stream_context:
+        # nothing to copy, changes are picked up by the build itself (see make_watch_recipe)
+        add_watch([*[os.path.join(root_dir, o) for o in origins], *[os.path.join(baselibs_dir, b) for b in baselibs]])
+    else:
+        sane_utils.make_copy_source_recipe(
+            name="prepare_source_files",
+            # info="Copy the source files within the designated context to prepare for the container build.",
+            location=root_dir,
+            src=origins,
+            dst="",
+            out_dir=os.path.join(root_dir, out_dir),
+            hooks=["prepare_context"],
+        )
+
+        sane_utils.make_copy_source_recipe(
+            name="prepare_user_baselibs",
+            # info="Copy base libraries within the designated context to prepare for the container build.",
+            location=baselibs_dir,
+            src=baselibs,
+            dst=".user-baselibs",
+            out_dir=os.path.join(root_dir, out_dir),
+            hooks=["prepare_context"],
+        )
 
     sane_utils.make_render_resource_recipes(
         globs=[
@@ -810,14 +1413,159 @@ def make_prepare_build_context_recipes(
             "project_id": project_id,
             "target": target,
             "sources": sources_ext,
+            "requirements_file": MERGED_REQUIREMENTS,
+            "requirements_digest": requirements_digest,
             **context_vars
         },
-        hook_deps=[
-            'prepare_context'
-        ],
-        **recipe_kwargs,
+        # when streaming nothing is copied, the Dockerfile itself prepares the context
+        **({"hooks": ["prepare_context"]} if stream_context else {"hook_deps": ["prepare_context"]}),
+        **{**recipe_kwargs, "recipe_deps": [*recipe_kwargs.get("recipe_deps", []), "prepare_requirements"]},
     )
 
+    return build_context
+
+
+def make_watch_recipe(run: typing.Sequence[str] = (), debounce: float = None, **recipe_kwargs):
+    """
+    Registers a recipe watching the inputs declared by the other recipes (sources, base libraries, templates, ...)
+    and, on changes, running only the affected recipes (each with its own dependencies) followed by the run ones.
+    Bursts of changes are collected until nothing changes for debounce seconds (default from SANE_WATCH_DEBOUNCE).
+    The process stays alive across iterations so file indexes and the jinja environment stay warm
+    """
+    if debounce is None:
+        debounce = float(os.environ.get("SANE_WATCH_DEBOUNCE", "0.3"))
+    if 'name' not in recipe_kwargs:
+        recipe_kwargs['name'] = 'watch'
+    if 'info' not in recipe_kwargs:
+        recipe_kwargs['info'] = "Watch for changes and re-run the affected recipes"
+
+    @recipe(**recipe_kwargs)
+    def watch():
+        from sane import _stateful
+
+        rules = get_watch_rules()
+        watcher = get_watcher(root for rule in rules for root in rule.roots())
+        log.info("Watching for changes...", rules=len(rules))
+        try:
+            while True:
+                changed = wait_changes(watcher, debounce)
+                affected = [rule for rule in rules if any(rule.matches(p) for p in changed)]
+                if not affected:
+                    continue
+                log.info("Changes detected", files=len(changed))
+                recipes = []
+                try:
+                    for rule in affected:
+                        for func in rule.before:
+                            func()
+                        recipes.extend(r for r in rule.recipes if r not in recipes)
+                except SystemExit as ex:
+                    log.error("Preparing the recipes failed, waiting for changes", exit_code=ex.code)
+                    continue
+                except Exception as ex:
+                    log.exception("Preparing the recipes failed, waiting for changes", ex=str(ex))
+                    continue
+                recipes.extend(r for r in run if r not in recipes)
+                start = time.perf_counter()
+                for name in recipes:
+                    try:
+                        _stateful.run_recipe_graph(name)
+                    except SystemExit as ex:
+                        log.error("Recipe failed, waiting for changes", failed=name, exit_code=ex.code)
+                        break
+                    except Exception as ex:
+                        # eg: sh.ErrorReturnCode from docker or kubectl, the watcher must survive it
+                        log.exception("Recipe failed, waiting for changes", failed=name, ex=str(ex))
+                        break
+                else:
+                    log.info("Up to date", recipes=recipes, elapsed=f"{time.perf_counter() - start:.3f}s")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+
+def make_affected_apps_recipe(project_dir: str = None,
+                              run: typing.Sequence[str] = None,
+                              out_dir: str = ".build",
+                              **recipe_kwargs):
+    """
+    Registers a (project level) recipe printing the apps affected by a change, through the inputs they
+    declare (see affected.write_manifest) and the base libraries they share. Changes are either files
+    listed in AFFECTED_FILES or the git changes since AFFECTED_SINCE (default HEAD).
+    With run (or AFFECTED_RUN, eg: "build,push") those recipes are run in each affected app
+    """
+    if 'name' not in recipe_kwargs:
+        recipe_kwargs['name'] = 'affected'
+    if 'info' not in recipe_kwargs:
+        recipe_kwargs['info'] = "List (or build) the apps affected by the current changes"
+
+    @recipe(**recipe_kwargs)
+    def affected():
+        _project_dir = project_dir or os.environ.get("KRULES_PROJECT_DIR", root_dir)
+        if "AFFECTED_FILES" in os.environ:
+            changed = [os.path.join(_project_dir, f) for f in re.split(" |,|;|\n", os.environ["AFFECTED_FILES"]) if f]
+        else:
+            changed = get_changed_files(os.environ.get("AFFECTED_SINCE", "HEAD"), _project_dir)
+        apps = get_affected_apps(changed, build_reverse_index(_project_dir, out_dir))
+        log.debug("Affected apps", changed=len(changed), apps=len(apps))
+        for app_dir in apps:
+            print(os.path.relpath(app_dir, _project_dir))
+
+        _run = run
+        if _run is None:
+            _run = [r for r in re.split(" |,|;", os.environ.get("AFFECTED_RUN", "")) if r]
+        from krules_dev.sane_daemon import run_in_daemon
+        for app_dir in apps:
+            make_file = os.path.join(app_dir, "make.py")
+            for recipe_name in _run:
+                log.info("Running", app=os.path.relpath(app_dir, _project_dir), recipe=recipe_name)
+                exit_code = run_in_daemon(make_file, [recipe_name], cwd=app_dir)
+                if exit_code is None:
+                    try:
+                        sh.Command(check_cmd("python"))(make_file, recipe_name, _cwd=app_dir, _fg=True)
+                        exit_code = 0
+                    except sh.ErrorReturnCode as ex:
+                        exit_code = ex.exit_code
+                if exit_code != 0:
+                    log.error("Recipe failed", app=app_dir, recipe=recipe_name, exit_code=exit_code)
+                    sys.exit(-1)
+
+
+def make_build_images_recipe(images: typing.Union[typing.Sequence[ImageBuildSpec],
+                                                  typing.Callable[[], typing.Sequence[ImageBuildSpec]]],
+                             jobs: int = None,
+                             **recipe_kwargs):
+    """
+    Registers a (project level) recipe building many images concurrently, each after its base images
+    (see scheduler.build_images). Built digests are recorded in the image digest cache, so that
+    get_buildable_image does not build them again
+    """
+    if 'name' not in recipe_kwargs:
+        recipe_kwargs['name'] = 'build_images'
+    if 'info' not in recipe_kwargs:
+        recipe_kwargs['info'] = "Build the project images concurrently"
+
+    @recipe(**recipe_kwargs)
+    def build_images_():
+        image_cache = ImageDigestCache()
+        use_cache = bool(int(os.environ.get("SANE_IMAGE_CACHE", "1")))
+        target = os.environ.get("TARGET", "default")
+
+        def _on_built(spec, digest):
+            if use_cache:
+                _store_image_digest(image_cache, spec.build_dir, spec.out_dir, digest,
+                                    _image_cache_key_args(target, spec.recipe))
+
+        _images = images() if callable(images) else images
+        try:
+            digests = build_images(_images, jobs=jobs, on_built=_on_built)
+        except BuildFailed as ex:
+            log.error("Images build failed", failed=list(ex.failed), skipped=ex.skipped)
+            sys.exit(-1)
+        for name, digest in digests.items():
+            print(f"{name}: {digest}")
+
 
 def get_kubectl_ctx(fmt="{project_name}-{target}", project_name=None, target=None):
     if project_name is None:
@@ -0,0 +1,336 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import typing
+
+import structlog
+
+from krules_dev.sane_utils.context import place_file, _remove
+from krules_dev.sane_utils.hashing import get_fingerprint, file_digest
+from krules_dev.sane_utils.remote_cache import RemoteCache, get_remote_cache
+from krules_dev.sane_utils.walker import Walker, expand_globs
+
+log = structlog.get_logger()
+
+CACHE_VERSION = 1
+
+
+def get_cache_dir() -> str:
+    return os.environ.get(
+        "KRULES_CACHE_DIR",
+        os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "krules-dev")
+    )
+
+
+class CacheSpec:
+    """
+    Declares what a recipe result depends on and what it produces:
+    inputs are globs of files, env the names of environment variables,
+    digests the upstream digests (paths of files holding them, or callables returning them)
+    and outputs the files or directories it produces. Relative paths are resolved against base_dir.
+    The digests of the input files are indexed in out_dir (see hashing.get_fingerprint)
+    """
+
+    def __init__(self,
+                 inputs: typing.Sequence[str] = (),
+                 env: typing.Sequence[str] = (),
+                 digests: typing.Sequence[typing.Union[str, typing.Callable[[], str]]] = (),
+                 outputs: typing.Sequence[str] = (),
+                 base_dir: str = None,
+                 salt: str = "",
+                 out_dir: str = ".build"):
+        self.inputs = list(inputs)
+        self.env = list(env)
+        self.digests = list(digests)
+        self.outputs = list(outputs)
+        self.base_dir = base_dir
+        self.salt = salt
+        self.out_dir = out_dir
+
+    def key(self, name: str, base_dir: str) -> str | None:
+        """
+        Input key of the recipe: changes whenever any declared input changes.
+        None when an upstream digest file is missing (not produced yet): the result cannot be keyed
+        """
+        base_dir = self.base_dir or base_dir
+        digests = []
+        for digest in self.digests:
+            if callable(digest):
+                digests.append(digest())
+                continue
+            try:
+                with open(os.path.join(base_dir, digest)) as f:
+                    digests.append(f.read().strip())
+            except FileNotFoundError:
+                log.debug("Declared digest missing", recipe=name, digest=digest)
+                return None
+        walker = Walker()
+        files = sorted({f for path in expand_globs(self.inputs, base_dir, walker)
+                        for f in walker.walk(os.path.join(base_dir, path))})
+        out_dir = os.path.join(base_dir, self.out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        index = get_fingerprint(os.path.join(out_dir, ".cache.index"), fingerprint="stat")
+        inputs = [[os.path.relpath(f, base_dir), d] for f, d in zip(files, index.digest_many(files))]
+        index.save()
+        h = hashlib.sha256(json.dumps({
+            "version": CACHE_VERSION,
+            "name": name,
+            "salt": self.salt,
+            "inputs": inputs,
+            "env": {var: os.environ.get(var) for var in self.env},
+            "digests": digests,
+            "outputs": self.outputs,
+        }, sort_keys=True).encode())
+        return h.hexdigest()
+
+
+class LocalCache:
+    """
+    Content addressed store of recipe outputs: objects/ holds file contents by sha256,
+    keys/ holds, for each input key, the manifest of the outputs produced.
+    When a remote cache is configured (see remote_cache.get_remote_cache) local misses are looked up
+    remotely and stored entries are uploaded, with the same layout
+    """
+
+    def __init__(self, cache_dir: str = None, remote: RemoteCache = None):
+        self.cache_dir = cache_dir or get_cache_dir()
+        self.remote = remote if remote is not None else get_remote_cache()
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "keys", key[:2], f"{key}.json")
+
+    @staticmethod
+    def _atomic_write(path: str, write: typing.Callable[[typing.BinaryIO], None]):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _fetch(self, key: str) -> dict | None:
+        manifest = self.remote.get_json(f"keys/{key}.json")
+        if manifest is None:
+            return None
+        for files in manifest["outputs"].values():
+            for entry in files:
+                obj_path = self._object_path(entry["digest"])
+                if os.path.exists(obj_path):
+                    continue
+                data = self.remote.get(f"objects/{entry['digest']}")
+                if data is None or hashlib.sha256(data).hexdigest() != entry["digest"]:
+                    log.debug("Incomplete remote cache entry", key=key, missing=entry["path"])
+                    return None
+                self._atomic_write(obj_path, lambda f: f.write(data))
+        self._atomic_write(self._manifest_path(key), lambda f: f.write(json.dumps(manifest).encode()))
+        log.debug("Fetched from remote cache", key=key)
+        return manifest
+
+    def lookup(self, key: str) -> dict | None:
+        try:
+            with open(self._manifest_path(key)) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            manifest = None
+        if manifest is not None:
+            for files in manifest["outputs"].values():
+                for entry in files:
+                    if not os.path.exists(self._object_path(entry["digest"])):
+                        log.debug("Incomplete cache entry", key=key, missing=entry["path"])
+                        manifest = None
+                        break
+                if manifest is None:
+                    break
+        if manifest is None and self.remote is not None:
+            manifest = self._fetch(key)
+        return manifest
+
+    def restore(self, manifest: dict, base_dir: str):
+        now = time.time()
+        for output, files in manifest["outputs"].items():
+            out_path = os.path.join(base_dir, output)
+            if manifest["kinds"][output] == "dir":
+                if os.path.lexists(out_path):
+                    _remove(out_path)
+                os.makedirs(out_path)
+            for entry in files:
+                dst = os.path.join(base_dir, entry["path"])
+                if os.path.lexists(dst):
+                    if os.path.isfile(dst) and file_digest(dst, "sha256") == entry["digest"]:
+                        continue
+                    _remove(dst)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                place_file(self._object_path(entry["digest"]), dst, "auto")
+                os.chmod(dst, entry["mode"])
+                # restored outputs are as fresh as just produced ones (see file conditions)
+                os.utime(dst, (now, now))
+
+    def store(self, key: str, base_dir: str, outputs: typing.Sequence[str]) -> dict | None:
+        manifest = {"version": CACHE_VERSION, "outputs": {}, "kinds": {}}
+        walker = Walker(excludes=(), ignore_files=())
+        for output in outputs:
+            out_path = os.path.join(base_dir, output)
+            if not os.path.exists(out_path):
+                log.warning("Declared output missing, not caching", output=output)
+                return None
+            manifest["kinds"][output] = "dir" if os.path.isdir(out_path) else "file"
+            files = []
+            for f in walker.walk(out_path):
+                digest = file_digest(f, "sha256")
+                obj_path = self._object_path(digest)
+                if not os.path.exists(obj_path):
+                    with open(f, "rb") as fsrc:
+                        self._atomic_write(obj_path, lambda fdst: shutil.copyfileobj(fsrc, fdst))
+                files.append({
+                    "path": os.path.relpath(f, base_dir),
+                    "digest": digest,
+                    "mode": os.stat(f).st_mode & 0o7777,
+                })
+            manifest["outputs"][output] = files
+        self._atomic_write(self._manifest_path(key), lambda f: f.write(json.dumps(manifest).encode()))
+        if self.remote is not None:
+            for files in manifest["outputs"].values():
+                for entry in files:
+                    name = f"objects/{entry['digest']}"
+                    if not self.remote.exists(name):
+                        with open(self._object_path(entry["digest"]), "rb") as f:
+                            self.remote.put(name, f.read())
+            self.remote.put_json(f"keys/{key}.json", manifest)
+        return manifest
+
+
+def run_cached(name: str, fn: typing.Callable, spec: CacheSpec, base_dir: str, cache: LocalCache = None):
+    """
+    Runs fn unless outputs produced from the same inputs are in the cache, in which case they are restored
+    """
+    if not int(os.environ.get("SANE_RECIPE_CACHE", "1")):
+        return fn()
+    if cache is None:
+        cache = LocalCache()
+    base_dir = spec.base_dir or base_dir
+    key = spec.key(name, base_dir)
+    if key is None:
+        log.debug("Cache miss, not cacheable yet", recipe=name)
+        return fn()
+    manifest = cache.lookup(key)
+    if manifest is not None:
+        cache.restore(manifest, base_dir)
+        log.info("Restored from cache", key=key[:12], outputs=spec.outputs)
+        return
+    log.debug("Cache miss", key=key[:12])
+    fn()
+    if cache.store(key, base_dir, spec.outputs) is not None:
+        log.debug("Outputs cached", key=key[:12], outputs=spec.outputs)
+
+
+class ImageDigestCache:
+    """
+    Persistent map (<cache dir>/images.json) from the inputs of a buildable image (see get_buildable_image)
+    to the repo digest last pushed from them, with hit/miss counters.
+    An entry also lists the base images the build resolved in turn (requires), it is valid only while they are
+    """
+
+    def __init__(self, cache_file: str = None):
+        self.cache_file = cache_file or os.path.join(get_cache_dir(), "images.json")
+
+    def _load(self) -> dict:
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = None
+        if data is None or data.get("version") != CACHE_VERSION:
+            data = {"version": CACHE_VERSION, "entries": {}, "stats": {"hits": 0, "misses": 0}}
+        return data
+
+    @contextlib.contextmanager
+    def _update(self):
+        import fcntl
+
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(f"{self.cache_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._load()
+            yield data
+            LocalCache._atomic_write(self.cache_file, lambda f: f.write(json.dumps(data, indent=1).encode()))
+
+    @staticmethod
+    def key(build_dir: str, out_dir: str, registry: str | None, platform: str, salt: str = "",
+            dockerfile: str = "Dockerfile") -> str | None:
+        """
+        Key of the image built in build_dir: its files and the inputs it declares (see affected.write_manifest,
+        discovered from its recipes when it was never built), the Dockerfile rendered in out_dir (templates
+        and macros outside build_dir included), registry and platform.
+        None when the inputs cannot be known (eg: the make.py does not prepare a build context), the image is
+        not cached then
+        """
+        from krules_dev.sane_utils.affected import load_manifest
+
+        manifest = load_manifest(build_dir, out_dir)
+        if manifest is None:
+            log.warning("Image inputs unknown, digest not cached", build_dir=build_dir, out_dir=out_dir)
+            return None
+        walker = Walker()
+        files = sorted({f for path in [build_dir, *manifest["inputs"]]
+                        for f in walker.walk(path)})
+        index = get_fingerprint(os.path.join(build_dir, out_dir, ".image.index"), base_dir=build_dir)
+        inputs = [[f, d] for f, d in zip(files, index.digest_many(files))]
+        index.save()
+        dockerfile = os.path.join(build_dir, out_dir, dockerfile)
+        return hashlib.sha256(json.dumps({
+            "version": CACHE_VERSION,
+            "build_dir": os.path.abspath(build_dir),
+            "inputs": inputs,
+            "dockerfile": file_digest(dockerfile, "sha256") if os.path.exists(dockerfile) else None,
+            "registry": registry,
+            "platform": platform,
+            "salt": salt,
+        }, sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, key: str, is_valid: typing.Callable[[str], bool] = lambda _: True) -> str | None:
+        """
+        The repo digest recorded for key, if any and all the required base images are still valid
+        """
+        entry = self._entry(key, is_valid)
+        with self._update() as data:
+            data["stats"]["hits" if entry is not None else "misses"] += 1
+            log.debug("Image digest cache", hit=entry is not None, **data["stats"])
+        return entry and entry["digest"]
+
+    def contains(self, key: str, is_valid: typing.Callable[[str], bool] = lambda _: True) -> bool:
+        return self._entry(key, is_valid) is not None
+
+    def _entry(self, key: str, is_valid: typing.Callable[[str], bool]) -> dict | None:
+        entry = self._load()["entries"].get(key)
+        if entry is not None and not all(is_valid(build_dir) for build_dir in entry["requires"]):
+            return None
+        return entry
+
+    def store(self, key: str, build_dir: str, digest: str, requires: typing.Sequence[str] = (), keep: int = 16):
+        build_dir = os.path.abspath(build_dir)
+        with self._update() as data:
+            entries = data["entries"]
+            entries[key] = {
+                "build_dir": build_dir,
+                "digest": digest,
+                "requires": list(requires),
+                "time": time.time(),
+            }
+            # only the most recent entries of each build directory are worth keeping
+            stale = sorted((k for k, e in entries.items() if e["build_dir"] == build_dir),
+                           key=lambda k: entries[k]["time"], reverse=True)[keep:]
+            for k in stale:
+                del entries[k]
+
+    def stats(self) -> dict:
+        return self._load()["stats"]
@@ -0,0 +1,328 @@
+import errno
+import io
+import os
+import shutil
+import stat
+import sys
+import tarfile
+import typing
+
+import structlog
+
+from krules_dev.sane_utils.walker import Walker
+
+log = structlog.get_logger()
+
+# linux ioctl to share the extents of a file (copy on write clone, eg: btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str):
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def place_file(src: str, dst: str, link: str = "auto") -> str:
+    """
+    Materializes src in dst using the cheapest available method:
+    "hardlink" shares the inode, "reflink" clones extents (copy on write), "copy" copies the bytes,
+    "auto" tries reflink and falls back to copy. Returns the method actually used
+    """
+    if link == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as ex:
+            log.debug("Cannot hardlink, copying", src=src, dst=dst, ex=str(ex))
+    elif link in ("reflink", "auto") and sys.platform == "linux":
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except OSError as ex:
+            if ex.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                raise
+            if os.path.exists(dst):
+                os.unlink(dst)
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _makedirs(path: str):
+    try:
+        os.makedirs(path, exist_ok=True)
+    except (FileExistsError, NotADirectoryError):
+        # a file in place of a directory
+        d = path
+        while not os.path.lexists(d):
+            d = os.path.dirname(d)
+        os.unlink(d)
+        os.makedirs(path, exist_ok=True)
+
+
+def _scan_dest(dst_dir: str, files: dict, dirs: list):
+    try:
+        with os.scandir(dst_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                    _scan_dest(entry.path, files, dirs)
+                else:
+                    files[entry.path] = entry
+    except FileNotFoundError:
+        pass
+
+
+def _normalized_mode(mode: int) -> int:
+    # umask and checkout independent: only the executable bit is kept
+    if stat.S_ISDIR(mode) or mode & stat.S_IXUSR:
+        return 0o755
+    return 0o644
+
+
+def normalize_file(path: str, mtime: int, st: os.stat_result = None) -> bool:
+    """
+    Sets the mtime and the normalized permissions of path, only if they differ (so that ctime is left alone).
+    Returns whether anything changed
+    """
+    if st is None:
+        st = os.lstat(path)
+    changed = False
+    if not stat.S_ISLNK(st.st_mode) and stat.S_IMODE(st.st_mode) != _normalized_mode(st.st_mode):
+        os.chmod(path, _normalized_mode(st.st_mode))
+        changed = True
+    if st.st_mtime_ns != mtime * 10 ** 9:
+        if not stat.S_ISLNK(st.st_mode):
+            os.utime(path, (mtime, mtime))
+        elif os.utime in os.supports_follow_symlinks:
+            os.utime(path, (mtime, mtime), follow_symlinks=False)
+        changed = True
+    return changed
+
+
+def normalize_tree(path: str, mtime: int) -> int:
+    """
+    Makes a build context on disk reproducible: __pycache__ directories are removed, files and directories
+    get mtime and normalized permissions (see normalize_file).
+    Hidden files directly within path are sane bookkeeping (.digest, .build.success, ...) and are left alone,
+    as recipe conditions compare their mtimes. Returns the number of entries changed
+    """
+    changed = 0
+    for dir_path, dirs, files in os.walk(path, topdown=False):
+        if os.path.basename(dir_path) == "__pycache__":
+            shutil.rmtree(dir_path)
+            changed += 1
+            continue
+        for name in files:
+            if dir_path == path and name.startswith("."):
+                continue
+            changed += normalize_file(os.path.join(dir_path, name), mtime)
+        for name in dirs:
+            # symlinks to directories are not walked
+            if os.path.islink(os.path.join(dir_path, name)):
+                changed += normalize_file(os.path.join(dir_path, name), mtime)
+        # children first: removing or creating entries changes the directory mtime
+        changed += normalize_file(dir_path, mtime)
+    log.debug("Normalized", path=path, mtime=mtime, changed=changed)
+    return changed
+
+
+def sync_tree(src: str, dst: str, walker: Walker = None, link: str = None, mtime: int = None) -> dict:
+    """
+    rsync-like mirror of src into dst: files whose size and mtime are unchanged are left alone,
+    changed ones are replaced (see place_file for link), stale ones are deleted.
+    Copies keep the source mtime, so unchanged files keep their mtime across runs.
+    With mtime (reproducible builds) copies get that mtime and normalized permissions instead (see
+    normalize_file): they are unchanged while the source is not modified after being copied (its mtime is not
+    newer than the copy ctime) and hardlinks are not used, as normalizing them would change the sources too
+    """
+    if walker is None:
+        walker = Walker()
+    if link is None:
+        link = os.environ.get("SANE_SYNC_LINK", "auto")
+    if mtime is not None and link == "hardlink":
+        link = "auto"
+    stats = {"unchanged": 0, "copy": 0, "reflink": 0, "hardlink": 0, "deleted": 0}
+
+    if os.path.isfile(src):
+        wanted = {dst: src}
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+    else:
+        wanted = {os.path.join(dst, os.path.relpath(f, src)): f for f in walker.walk(src)}
+        if os.path.exists(dst) and not os.path.isdir(dst):
+            _remove(dst)
+        os.makedirs(dst, exist_ok=True)
+
+    existing = {}
+    existing_dirs = []
+    if os.path.isdir(dst) and dst not in wanted:
+        _scan_dest(dst, existing, existing_dirs)
+    elif os.path.lexists(dst):
+        existing[dst] = None
+
+    needed_dirs = set()
+    for dst_file, src_file in wanted.items():
+        d = os.path.dirname(dst_file)
+        while d not in needed_dirs and d != dst and d.startswith(dst):
+            needed_dirs.add(d)
+            d = os.path.dirname(d)
+        if dst_file in existing:
+            st_src = os.stat(src_file)
+            st_dst = os.lstat(dst_file)
+            if mtime is None:
+                unchanged = st_src.st_mtime_ns == st_dst.st_mtime_ns
+            else:
+                unchanged = st_dst.st_mtime_ns == mtime * 10 ** 9 and st_src.st_mtime_ns <= st_dst.st_ctime_ns and \
+                    stat.S_IMODE(st_dst.st_mode) == _normalized_mode(st_src.st_mode)
+            if st_src.st_size == st_dst.st_size and unchanged:
+                stats["unchanged"] += 1
+                continue
+            os.unlink(dst_file)
+        elif os.path.lexists(dst_file):
+            # a directory in place of a file
+            _remove(dst_file)
+        _makedirs(os.path.dirname(dst_file))
+        stats[place_file(src_file, dst_file, link)] += 1
+        if mtime is not None:
+            normalize_file(dst_file, mtime)
+
+    for dst_file in existing:
+        # a file replaced by a wanted directory is gone already
+        if dst_file not in wanted and dst_file not in needed_dirs and os.path.lexists(dst_file):
+            os.unlink(dst_file)
+            stats["deleted"] += 1
+    for d in sorted(existing_dirs, reverse=True):
+        if d not in needed_dirs and os.path.isdir(d) and not os.listdir(d):
+            os.rmdir(d)
+
+    log.debug("Synced", src=src, dst=dst, **stats)
+    return stats
+
+
+class _ChunkBuffer(io.RawIOBase):
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class BuildContext:
+    """
+    Declared content of a docker build context as (source path, path within the context) entries.
+    It can be streamed as a tar archive (eg: to `docker build -`) without copying sources on disk.
+    Whatever else is in artifacts_dir (eg: the rendered Dockerfile and any file generated for it) is part of the
+    context too, except the hidden files and directories directly within it (sane bookkeeping, eg: .jinja-cache),
+    the top level paths the entries provide and the exclude directories (eg: k8s resources rendered in a subdirectory,
+    absolute or relative to artifacts_dir, read when the context is walked)
+    """
+
+    def __init__(self, entries: typing.Iterable[tuple[str, str]] = (), walker: Walker = None,
+                 artifacts_dir: str = None, exclude: typing.Iterable[str] = ()):
+        self.entries = list(entries)
+        self.walker = walker or Walker()
+        self.artifacts_dir = artifacts_dir and os.path.abspath(artifacts_dir)
+        self.exclude = exclude
+
+    def _artifacts(self) -> dict[str, str]:
+        artifacts = {}
+        if self.artifacts_dir is None:
+            return artifacts
+        # stale copies of the entries (eg: from a non streamed build) must not shadow them
+        provided = {arcname.split("/")[0] for _, arcname in self.entries}
+        excluded = {os.path.abspath(os.path.join(self.artifacts_dir, d)) for d in self.exclude} - {self.artifacts_dir}
+        for dir_path, dirs, files in os.walk(self.artifacts_dir):
+            top = dir_path == self.artifacts_dir
+            dirs[:] = [d for d in dirs if d != "__pycache__" and not (top and (d.startswith(".") or d in provided))
+                       and os.path.join(dir_path, d) not in excluded]
+            for name in files:
+                if top and (name.startswith(".") or name in provided):
+                    continue
+                path = os.path.join(dir_path, name)
+                artifacts[os.path.relpath(path, self.artifacts_dir)] = path
+        return artifacts
+
+    def add(self, src: str, arcname: str):
+        self.entries.append((os.path.abspath(src), arcname.strip("/")))
+
+    def members(self) -> list[tuple[str, str]]:
+        members = self._artifacts()
+        for src, arcname in self.entries:
+            if os.path.isdir(src):
+                for f in self.walker.walk(src):
+                    members[f"{arcname}/{os.path.relpath(f, src)}".lstrip("/")] = f
+            elif os.path.exists(src):
+                members[arcname] = src
+            else:
+                log.warning("Missing build context source", src=src)
+        return [(members[arcname], arcname) for arcname in sorted(members)]
+
+    def iter_tar(self, mtime: int = None):
+        """
+        Yields the tar archive of the context in chunks, one file at a time.
+        With mtime (reproducible builds) members get that mtime, normalized permissions and no owner
+        """
+
+        def _normalize(info: tarfile.TarInfo) -> tarfile.TarInfo:
+            info.mtime = mtime
+            if not info.issym():
+                info.mode = _normalized_mode(info.mode | (stat.S_IFDIR if info.isdir() else 0))
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            return info
+
+        buf = _ChunkBuffer()
+        with tarfile.open(fileobj=buf, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for src, arcname in self.members():
+                tar.add(src, arcname, recursive=False, filter=_normalize if mtime is not None else None)
+                yield buf.drain()
+        yield buf.drain()
+
+
+def normalize_context(context: BuildContext, context_dir: str, mtime: int) -> int:
+    """
+    Makes the on disk copy of context in context_dir (eg: the out_dir prepared by the copy recipes) reproducible:
+    its files and their directories get mtime and normalized permissions (see normalize_file) and __pycache__
+    directories are removed, whatever else is in context_dir (bookkeeping, other rendered resources) is left alone.
+    Returns the number of entries changed
+    """
+    changed = 0
+    dirs = {""}
+    for _, arcname in context.members():
+        path = os.path.join(context_dir, arcname)
+        if not os.path.lexists(path):
+            continue
+        changed += normalize_file(path, mtime)
+        parent = os.path.dirname(arcname)
+        while parent:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    for d in dirs:
+        if os.path.isdir(os.path.join(context_dir, d, "__pycache__")):
+            shutil.rmtree(os.path.join(context_dir, d, "__pycache__"))
+            changed += 1
+    # children first: removing entries changes the directory mtime
+    for d in sorted(dirs - {""}, reverse=True):
+        changed += normalize_file(os.path.join(context_dir, d), mtime)
+    log.debug("Normalized", path=context_dir, mtime=mtime, changed=changed)
+    return changed
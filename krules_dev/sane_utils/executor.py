@@ -0,0 +1,135 @@
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import sane
+import structlog
+
+log = structlog.get_logger()
+
+_Sane = sane._Sane
+
+
+def get_jobs() -> int:
+    return max(sane._stateful.threads, int(os.environ.get("SANE_JOBS", "1")))
+
+
+def _active_graph(state, root_unique_name: str):
+    """
+    Same activation rules as sane: a recipe runs when any of its conditions holds, when it has
+    neither dependencies nor conditions, or when it (transitively) depends on a recipe that runs.
+    Returns the active recipes in a topological order, with their nearest active recipe dependencies
+    """
+    active = {}
+    order = []
+    deps = {}
+    visiting = []
+
+    def _check(unique_name):
+        if unique_name in active:
+            return active[unique_name]
+        type_, name = _Sane.split_unique_name(unique_name)
+        exists = state.recipe_exists(name) if type_ == _Sane.Node.RECIPE else state.hook_exists(name)
+        if not exists:
+            visiting.append(unique_name)
+            state.report_unknown(
+                _Sane.split_unique_name(root_unique_name)[1], name,
+                " > ".join(_Sane.human_format_unique_name(x) for x in visiting)
+            )
+        if unique_name in visiting:
+            visiting.append(unique_name)
+            state.report_cyclic(
+                _Sane.split_unique_name(root_unique_name)[1],
+                " > ".join(_Sane.human_format_unique_name(x) for x in visiting)
+            )
+        node = state.graph[unique_name]
+        visiting.append(unique_name)
+        is_active = node.is_always_active() or state.force
+        for child in node.connections:
+            is_active |= _check(child)
+        visiting.pop()
+        active[unique_name] = is_active
+        if is_active and type_ == _Sane.Node.RECIPE:
+            order.append(unique_name)
+            deps[unique_name] = _nearest_recipes(node)
+        elif not is_active and type_ == _Sane.Node.RECIPE:
+            state.log(f'Skipping recipe \'{name}\'.', _Sane.VerboseLevel.VERBOSE)
+        return is_active
+
+    def _nearest_recipes(node) -> set:
+        found = set()
+        for child in node.connections:
+            if not active[child]:
+                continue
+            if _Sane.unique_name_is_recipe(child):
+                found.add(child)
+            else:
+                found |= _nearest_recipes(state.graph[child])
+        return found
+
+    _check(root_unique_name)
+    return order, deps
+
+
+def run_recipe_graph(state, recipe_name: str, jobs: int):
+    """
+    Runs the active recipes of the graph rooted in recipe_name as soon as their dependencies complete,
+    up to jobs at a time. Each recipe runs in a copy of the caller's context, so that
+    structlog bound variables (eg: target) are inherited and recipe bindings do not leak
+    """
+    order, deps = _active_graph(state, _Sane.get_unique_name(recipe_name, _Sane.Node.RECIPE))
+    if not order:
+        state.log(f'Nothing to do for \'{recipe_name}\'', _Sane.VerboseLevel.DEBUG)
+        return
+
+    waiting = {r: set(d) for r, d in deps.items()}
+    dependents = {r: [] for r in order}
+    for r, d in deps.items():
+        for dep in d:
+            dependents[dep].append(r)
+
+    log.debug("Running recipes", recipes=len(order), jobs=jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+
+        def _submit(unique_name):
+            fn = state.graph[unique_name].meta['fn']
+            name = _Sane.split_unique_name(unique_name)[1]
+            ctx = contextvars.copy_context()
+            futures[pool.submit(ctx.run, state.run_recipe, fn, name)] = unique_name
+
+        for r in order:
+            if not waiting[r]:
+                _submit(r)
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    unique_name = futures.pop(future)
+                    future.result()
+                    for r in dependents[unique_name]:
+                        waiting[r].discard(unique_name)
+                        if not waiting[r]:
+                            _submit(r)
+        except BaseException:
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def install():
+    """
+    Makes sane run recipe graphs through run_recipe_graph when more than one job is requested
+    (--threads/-j on the command line or SANE_JOBS), keeping sane's own sequential runner otherwise
+    """
+    state = sane._stateful
+    if getattr(state, "_sequential_run_recipe_graph", None) is not None:
+        return
+    state._sequential_run_recipe_graph = state.run_recipe_graph
+
+    def _run_recipe_graph(recipe_name):
+        jobs = get_jobs()
+        if jobs <= 1:
+            return state._sequential_run_recipe_graph(recipe_name)
+        return run_recipe_graph(state, recipe_name, jobs)
+
+    state.run_recipe_graph = _run_recipe_graph
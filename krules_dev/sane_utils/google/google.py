@@ -12,7 +12,7 @@ import yaml
 from structlog.contextvars import bind_contextvars, clear_contextvars
 
 from krules_dev import sane_utils
-from krules_dev.sane_utils.base import recipe
+from krules_dev.sane_utils.base import recipe, root_dir
 
 # logger = logging.getLogger("__sane__")
 
@@ -20,10 +20,6 @@ import structlog
 
 log = structlog.get_logger()
 
-abs_path = os.path.abspath(inspect.stack()[-1].filename)
-root_dir = os.path.dirname(abs_path)
-
-
 def make_enable_apis_recipe(google_apis, project_id=None, **recipe_kwargs):
     if "info" not in recipe_kwargs:
         recipe_kwargs["info"] = "Enable required Google API"
@@ -267,16 +263,25 @@ def make_target_deploy_recipe(
             )
             origins.append(source[0])
     # making changes to these files will result in a new build
-    sane_utils.update_code_hash(
-        globs=[
-            *origins,
-            *list(map(lambda x: f"{sane_utils.check_env('KRULES_PROJECT_DIR')}/base/libs/{x}/**/*.py", baselibs)),
-            os.path.join(root_dir, "k8s", "*.j2"),
-            os.path.join(root_dir, "*.j2"),
-        ],
-        out_dir=os.path.join(root_dir, out_dir),
-        output_file=".code.digest"
-    )
+    code_globs = [
+        *origins,
+        *list(map(lambda x: f"{sane_utils.check_env('KRULES_PROJECT_DIR')}/base/libs/{x}/**/*.py", baselibs)),
+        os.path.join(root_dir, "k8s", "*.j2"),
+        os.path.join(root_dir, "*.j2"),
+    ]
+
+    def _update_code_hash():
+        sane_utils.update_code_hash(
+            globs=code_globs,
+            out_dir=os.path.join(root_dir, out_dir),
+            output_file=".code.digest"
+        )
+
+    _update_code_hash()
+    sane_utils.write_manifest(root_dir, out_dir, [
+        *origins, *[os.path.join(sane_utils.check_env("KRULES_PROJECT_DIR"), "base", "libs", x) for x in baselibs]
+    ])
+    sane_utils.add_watch(code_globs, ["deploy"], before=[_update_code_hash], base_dir=root_dir)
 
     sane_utils.make_copy_source_recipe(
         name="prepare_source_files",
@@ -298,6 +303,16 @@ def make_target_deploy_recipe(
         hooks=["prepare_build"],
     )
 
+    requirements_digest = sane_utils.make_merge_requirements_recipe(
+        [
+            "requirements.txt",
+            *[os.path.join(sane_utils.check_env("KRULES_PROJECT_DIR"), "base", "libs", x, "requirements.txt")
+              for x in baselibs],
+        ],
+        out_dir=out_dir,
+        hooks=["prepare_build"],
+    )
+
     sane_utils.make_render_resource_recipes(
         globs=[
             "Dockerfile.j2"
@@ -310,10 +325,15 @@ def make_target_deploy_recipe(
             "project_id": project_id,
             "target": target,
             "sources": sources_ext,
+            "requirements_file": sane_utils.MERGED_REQUIREMENTS,
+            "requirements_digest": requirements_digest,
             **context_vars
         },
         hooks=[
             'prepare_build'
+        ],
+        recipe_deps=[
+            'prepare_requirements'
         ]
     )
 
@@ -360,8 +380,10 @@ def make_target_deploy_recipe(
 
     success_file = os.path.join(root_dir, out_dir, ".success")
     code_digest_file = os.path.join(root_dir, out_dir, ".code.digest")
-    code_changed = not os.path.exists(success_file) or os.path.exists(code_digest_file) and open(
-        success_file).read() != open(code_digest_file).read()
+
+    def code_changed():
+        return not os.path.exists(success_file) or os.path.exists(code_digest_file) and open(
+            success_file).read() != open(code_digest_file).read()
 
     @recipe(info="Deploy the artifact", hook_deps=["prepare_build"])
     def deploy():
@@ -370,7 +392,7 @@ def make_target_deploy_recipe(
             target=target
         )
 
-        if not code_changed:
+        if not code_changed():
             log.debug("No changes detected... Skip deploy")
             return
 
@@ -428,67 +450,68 @@ def make_target_deploy_recipe(
             repo_name = f"{region}-docker.pkg.dev/{project_id}/{artifact_registry}"
             log.debug("Using project artifact registry", value=repo_name)
 
-        with sane_utils.pushd(os.path.join(root_dir, out_dir)):
-            skaffold = sh.Command(
-                sane_utils.check_cmd("skaffold")
-            )
+        build_dir = os.path.join(root_dir, out_dir)
+        skaffold = sh.Command(
+            sane_utils.check_cmd("skaffold")
+        )
+
+        skaffold_config = {
+            "apiVersion": "skaffold/v3alpha1",
+            "kind": "Config",
+            "profiles": [{
+                "name": target,
+                "manifests": {
+                    "rawYaml": [
+                        f"k8s/{target}/*.yaml"
+                    ]
+                },
+                "build": {
+                    "artifacts": [{
+                        "image": app_name,
+                    }]
+                },
+                "deploy": {}
+            }]
+        }
 
-            skaffold_config = {
-                "apiVersion": "skaffold/v3alpha1",
-                "kind": "Config",
-                "profiles": [{
-                    "name": target,
-                    "manifests": {
-                        "rawYaml": [
-                            f"k8s/{target}/*.yaml"
-                        ]
-                    },
-                    "build": {
-                        "artifacts": [{
-                            "image": app_name,
-                        }]
-                    },
-                    "deploy": {}
-                }]
+        if use_cloudbuild:
+            skaffold_config["profiles"][0]["build"]["googleCloudBuild"] = {
+                "projectId": project_id
+            }
+        else:
+            skaffold_config["profiles"][0]["build"]["local"] = {
+                "useDockerCLI": bool(use_dockercli),
+                "useBuildkit": bool(use_buildkit)
             }
 
-            if use_cloudbuild:
-                skaffold_config["profiles"][0]["build"]["googleCloudBuild"] = {
-                    "projectId": project_id
-                }
-            else:
-                skaffold_config["profiles"][0]["build"]["local"] = {
-                    "useDockerCLI": bool(use_dockercli),
-                    "useBuildkit": bool(use_buildkit)
+        if use_cloudrun:
+            skaffold_config["profiles"][0]["deploy"]["cloudrun"] = {
+                "projectid": project_id,
+                "region": region,
+            }
+        else:
+            skaffold_config["profiles"][0]["deploy"]["kubeContext"] = kubectl_ctx
+            skaffold_config["profiles"][0]["deploy"]["kubectl"] = {
+                "defaultNamespace": namespace
+            }
+            if len(kubectl_opts):
+                skaffold_config["profiles"][0]["deploy"]["kubectl"]["flags"] = {
+                    "global": kubectl_opts
                 }
 
-            if use_cloudrun:
-                skaffold_config["profiles"][0]["deploy"]["cloudrun"] = {
-                    "projectid": project_id,
-                    "region": region,
-                }
-            else:
-                skaffold_config["profiles"][0]["deploy"]["kubeContext"] = kubectl_ctx
-                skaffold_config["profiles"][0]["deploy"]["kubectl"] = {
-                    "defaultNamespace": namespace
-                }
-                if len(kubectl_opts):
-                    skaffold_config["profiles"][0]["deploy"]["kubectl"]["flags"] = {
-                        "global": kubectl_opts
-                    }
-
-            log.debug("Running skaffold")
-            with open("skaffold.yaml", "w") as f:
-                dump = yaml.dump(skaffold_config)
-                log.debug(f"\n{dump}")
-                f.write(dump)
-            skaffold.run(
-                default_repo=repo_name,
-                profile=target,
-                platform=build_platform,
-                _fg=True,
-            )
-            log.info("Deployed")
+        log.debug("Running skaffold")
+        with open(os.path.join(build_dir, "skaffold.yaml"), "w") as f:
+            dump = yaml.dump(skaffold_config)
+            log.debug(f"\n{dump}")
+            f.write(dump)
+        skaffold.run(
+            default_repo=repo_name,
+            profile=target,
+            platform=build_platform,
+            _fg=True,
+            _cwd=build_dir,
+        )
+        log.info("Deployed")
 
 
 def make_ensure_gcs_bucket_recipe(bucket_name, project_id, location="EU", **recipe_kwargs):
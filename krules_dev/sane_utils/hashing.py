@@ -0,0 +1,272 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import sh
+import structlog
+
+log = structlog.get_logger()
+
+INDEX_VERSION = 1
+
+CHUNK_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+XXHASH_ALGORITHMS = ("xxh32", "xxh64", "xxh3_64", "xxh3_128", "xxh128")
+
+
+def new_hash(algorithm: str = "md5"):
+    """
+    Returns a hashlib-like object for any hashlib algorithm (md5, sha1, blake2b, blake2s, ...)
+    or, when the optional xxhash package is installed, for xxh32/xxh64/xxh3_64/xxh3_128
+    """
+    if algorithm in XXHASH_ALGORITHMS:
+        try:
+            import xxhash
+        except ImportError:
+            log.error("xxhash is required for the requested algorithm", algorithm=algorithm)
+            sys.exit(-1)
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def file_digest(path: str, algorithm: str = "md5") -> str:
+    """
+    Hashes a file without loading it in memory: small files are read in chunks, big files are mmapped.
+    The "git" algorithm yields the same id as `git hash-object`
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if algorithm == "git":
+            h = hashlib.sha1(b"blob %d\0" % size)
+        else:
+            h = new_hash(algorithm)
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        elif size > CHUNK_SIZE:
+            buf = bytearray(CHUNK_SIZE)
+            view = memoryview(buf)
+            while n := f.readinto(buf):
+                h.update(view[:n])
+        else:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def digest_files(paths: list, algorithm: str = "md5", workers: int = None) -> list[str]:
+    """
+    Hashes files in a thread pool (hashlib releases the GIL on large buffers),
+    returning digests in the same order as paths
+    """
+    if workers is None:
+        workers = int(os.environ.get("SANE_HASH_WORKERS", "0")) or min(32, (os.cpu_count() or 1) + 4)
+    if workers <= 1 or len(paths) < 2:
+        return [file_digest(p, algorithm) for p in paths]
+    # hand out batches rather than single files to keep the pool overhead low with many small files
+    batch_size = max(1, min(256, len(paths) // (workers * 4)))
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [
+            digest for batch in pool.map(lambda b: [file_digest(p, algorithm) for p in b], batches)
+            for digest in batch
+        ]
+
+
+def combine_digests(digests, algorithm: str = "md5") -> str:
+    """
+    Folds per-file digests, in the given order, into a single digest
+    """
+    h = new_hash(algorithm)
+    for digest in digests:
+        h.update(digest.encode())
+    return h.hexdigest()
+
+
+class FileDigestIndex:
+    """
+    Persistent index of per-file digests keyed by absolute path.
+    Each entry holds the file size, mtime_ns and inode observed before hashing, so a file
+    is read again only when its stat changes.
+    """
+
+    def __init__(self, index_file: str, algorithm: str = "md5", verify: bool = False, workers: int = None):
+        self.index_file = index_file
+        self.algorithm = algorithm
+        self.workers = workers
+        self.entries: dict[str, list] = {}
+        self.seen: dict[str, list] = {}
+        self.hits = 0
+        self.misses = 0
+        # unchanged but racy entries rehashed: the index must be written again to get a newer mtime
+        self.racy = 0
+        # entries modified at or after the index was written cannot be trusted (racy)
+        self._racy_ns = 0
+        if not verify:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_file, "r") as f:
+                data = json.load(f)
+            self._racy_ns = os.stat(self.index_file).st_mtime_ns
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get("version") != INDEX_VERSION or data.get("algorithm") != self.algorithm:
+            log.debug("Discarding code index", index_file=self.index_file)
+            return
+        self.entries = data.get("files", {})
+
+    def digest(self, path: str) -> str:
+        return self.digest_many([path])[0]
+
+    def digest_many(self, paths: list) -> list[str]:
+        keys = []
+        digests = []
+        stale = []
+        for path in paths:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            stat_key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = self.entries.get(path)
+            if entry is not None and entry[:3] == stat_key and st.st_mtime_ns < self._racy_ns:
+                self.hits += 1
+                digests.append(entry[3])
+            else:
+                if entry is not None and entry[:3] == stat_key:
+                    self.racy += 1
+                stale.append(len(digests))
+                digests.append(None)
+            keys.append((path, stat_key))
+        self.misses += len(stale)
+        for i, digest in zip(stale, digest_files([keys[i][0] for i in stale], self.algorithm, self.workers)):
+            digests[i] = digest
+        for (path, stat_key), digest in zip(keys, digests):
+            self.seen[path] = [*stat_key, digest]
+        return digests
+
+    def save(self):
+        if self.seen == self.entries and not self.racy:
+            log.debug("Code index unchanged", index_file=self.index_file, hits=self.hits)
+            return
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "algorithm": self.algorithm,
+                "files": self.seen,
+            }, f)
+        os.replace(tmp_file, self.index_file)
+        log.debug("Code index updated", index_file=self.index_file, hits=self.hits, misses=self.misses)
+
+
+class GitIndexFingerprint:
+    """
+    Takes the blob id of tracked, unmodified files straight from the git index.
+    Untracked, modified or out of tree files are hashed from disk as git blobs
+    (through a stat index), so both sources yield the same digest for the same content.
+    Paths are compared resolved (git reports the toplevel as a realpath).
+    When git converts the working tree content (core.autocrlf, filter/eol/text attributes) blob ids may differ
+    from the bytes on disk, and every file is hashed from disk instead
+    """
+
+    def __init__(self, toplevel: str, index: FileDigestIndex, verify: bool = False):
+        self.toplevel = os.path.realpath(toplevel)
+        self.index = index
+        self.blobs: dict[str, str] = {}
+        if verify:
+            return
+        git = sh.Command(shutil.which("git")).bake("--no-pager", _cwd=self.toplevel, _tty_out=False)
+        if _has_conversions(git, self.toplevel):
+            log.debug("Git converts the working tree content, hashing files", toplevel=self.toplevel)
+            return
+        for entry in str(git("ls-files", "-s", "-z")).split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, oid, stage = info.split(" ")
+            # skip conflicts, symlinks and submodules
+            if stage != "0" or mode in ("120000", "160000"):
+                continue
+            self.blobs[os.path.join(self.toplevel, path)] = oid
+        for path in str(git("ls-files", "-m", "-z")).split("\0"):
+            if path:
+                self.blobs.pop(os.path.join(self.toplevel, path), None)
+        log.debug("Using git index fingerprint", toplevel=self.toplevel, tracked=len(self.blobs))
+
+    def digest(self, path: str) -> str:
+        return self.digest_many([path])[0]
+
+    def digest_many(self, paths: list) -> list[str]:
+        digests = [self.blobs.get(os.path.realpath(p)) for p in paths] if self.blobs else [None] * len(paths)
+        missing = [i for i, d in enumerate(digests) if d is None]
+        for i, digest in zip(missing, self.index.digest_many([paths[i] for i in missing])):
+            digests[i] = digest
+        return digests
+
+    def save(self):
+        self.index.save()
+
+
+# attributes changing the content between the index and the working tree ("-text" and "text=false" do not)
+_CONVERTING_ATTRIBUTES = re.compile(r"(^|\s)(filter=|eol=|text(=(?!false)|\s|$)|working-tree-encoding=)", re.M)
+
+
+def _has_conversions(git, toplevel: str) -> bool:
+    try:
+        autocrlf = str(git.config("--get", "core.autocrlf")).strip().lower()
+    except sh.ErrorReturnCode:
+        autocrlf = ""
+    if autocrlf in ("true", "input", "yes", "on", "1"):
+        return True
+    attributes_files = [os.path.join(toplevel, path) for path in
+                        str(git("ls-files", "-z", "--cached", "--others", "--exclude-standard",
+                                ":(glob)**/.gitattributes")).split("\0") if path]
+    attributes_files.append(str(git("rev-parse", "--git-path", "info/attributes")).strip())
+    try:
+        attributes_files.append(os.path.expanduser(str(git.config("--get", "core.attributesFile")).strip()))
+    except sh.ErrorReturnCode:
+        pass
+    for attributes_file in attributes_files:
+        if not os.path.isabs(attributes_file):
+            attributes_file = os.path.join(toplevel, attributes_file)
+        try:
+            with open(attributes_file) as f:
+                if _CONVERTING_ATTRIBUTES.search(re.sub(r"#.*", "", f.read())):
+                    return True
+        except (FileNotFoundError, IsADirectoryError):
+            continue
+    return False
+
+
+def get_git_toplevel(base_dir: str) -> str | None:
+    git = shutil.which("git")
+    if git is None:
+        return None
+    try:
+        return str(sh.Command(git)("rev-parse", "--show-toplevel", _cwd=base_dir)).strip()
+    except sh.ErrorReturnCode:
+        return None
+
+
+def get_fingerprint(index_file: str, fingerprint: str = "auto", verify: bool = False, base_dir: str = None,
+                    algorithm: str = "md5", workers: int = None):
+    """
+    Returns the per-file fingerprint backend: "git" uses the git index when base_dir is within a repository,
+    "stat" always hashes files from disk with the given algorithm, "auto" picks git when available
+    """
+    if fingerprint in ("auto", "git"):
+        toplevel = get_git_toplevel(base_dir or os.getcwd())
+        if toplevel is not None:
+            return GitIndexFingerprint(
+                toplevel, FileDigestIndex(index_file, algorithm="git", verify=verify, workers=workers), verify=verify
+            )
+        if fingerprint == "git":
+            log.warning("Not a git repository, falling back to file hashing", base_dir=base_dir)
+    return FileDigestIndex(index_file, algorithm=algorithm, verify=verify, workers=workers)
+
@@ -0,0 +1,125 @@
+import os
+import site
+import sys
+import sysconfig
+import threading
+
+import sh
+import structlog
+from structlog.contextvars import get_contextvars, clear_contextvars, bind_contextvars
+
+from krules_dev.sane_daemon import run_make_file, run_in_daemon, _PER_RUN_MODULES
+
+log = structlog.get_logger()
+
+_lock = threading.RLock()
+
+# set by each app (its env files or make.py), they must not leak into the make.py files run from another app
+PER_APP_VARS = ("IMAGE_NAME", "APP_NAME", "SANE_MAKE_FILE")
+
+
+def get_child_env(env: dict = None) -> dict:
+    """
+    Environment for running another app's make.py: env (default os.environ) without PER_APP_VARS
+    """
+    env = dict(os.environ if env is None else env)
+    for name in PER_APP_VARS:
+        env.pop(name, None)
+    return env
+
+
+def _library_paths() -> tuple[str, ...]:
+    paths = {sysconfig.get_path(p) for p in ("stdlib", "platstdlib", "purelib", "platlib")}
+    paths.update(site.getsitepackages() if hasattr(site, "getsitepackages") else ())
+    paths.add(site.getusersitepackages())
+    return tuple(os.path.realpath(p) + os.sep for p in paths if p)
+
+
+def _is_per_run(name: str, module=None, library_paths: tuple = ()) -> bool:
+    """
+    Modules each make.py imports afresh: sane, sane_utils and the user helpers (anything not installed as
+    a library, eg: modules next to make.py), so that they do not leak between parent and child
+    """
+    if any(name == m or name.startswith(f"{m}.") for m in _PER_RUN_MODULES):
+        return True
+    if name == "__main__" or name == "krules_dev" or name.startswith("krules_dev."):
+        return False
+    module_file = getattr(module, "__file__", None)
+    if not module_file:
+        return False
+    return not os.path.realpath(module_file).startswith(library_paths)
+
+
+def run_make_in_process(make_file: str, argv: list, env: dict = None, cwd: str = None) -> int:
+    """
+    Runs another make.py in this process with a fresh recipe registry (sane, sane_utils and user modules are
+    imported afresh), the given environment and cwd, then restores modules, environment, cwd, argv and log context.
+    Environment and cwd are process wide: callers must make sure no other thread is running (see run_nested_make).
+    Returns the exit code
+    """
+    import krules_dev
+
+    library_paths = _library_paths()
+
+    def _per_run_modules():
+        return {name: mod for name, mod in list(sys.modules.items()) if _is_per_run(name, mod, library_paths)}
+
+    with _lock:
+        saved_modules = _per_run_modules()
+        saved_sane_utils = getattr(krules_dev, "sane_utils", None)
+        saved_environ = dict(os.environ)
+        saved_argv = list(sys.argv)
+        saved_path = list(sys.path)
+        saved_contextvars = get_contextvars()
+        saved_cwd = os.getcwd()
+        for name in saved_modules:
+            del sys.modules[name]
+        # or "from krules_dev import sane_utils" would get the parent's module back
+        if saved_sane_utils is not None:
+            del krules_dev.sane_utils
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+        clear_contextvars()
+        if cwd is not None:
+            os.chdir(cwd)
+        try:
+            return run_make_file(make_file, argv)
+        finally:
+            for name in _per_run_modules():
+                del sys.modules[name]
+            sys.modules.update(saved_modules)
+            if saved_sane_utils is not None:
+                krules_dev.sane_utils = saved_sane_utils
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            os.chdir(saved_cwd)
+            sys.argv[:] = saved_argv
+            sys.path[:] = saved_path
+            clear_contextvars()
+            bind_contextvars(**saved_contextvars)
+
+
+def run_nested_make(make_file: str, argv: list, env: dict = None, cwd: str = None) -> int:
+    """
+    Runs make_file with argv in the warm daemon when available, otherwise in a python subprocess.
+    With SANE_NESTED_IN_PROCESS=1 (default 0) it runs in this process instead (see run_make_in_process),
+    as long as no other thread is running
+    """
+    from krules_dev.sane_utils.executor import get_jobs
+
+    in_process = bool(int(os.environ.get("SANE_NESTED_IN_PROCESS", "0")))
+    # the in-process runner swaps process wide state (environment, cwd, modules), not safe with other threads
+    if in_process and get_jobs() <= 1 and threading.current_thread() is threading.main_thread() and \
+            threading.active_count() == 1:
+        log.debug("Running nested make in process", make_file=make_file, argv=argv)
+        return run_make_in_process(make_file, argv, env, cwd)
+    exit_code = run_in_daemon(make_file, argv, env=env, cwd=cwd, fds=(0, 2, 2))
+    if exit_code is not None:
+        return exit_code
+    try:
+        sh.Command(sys.executable)(make_file, *argv, _env=env if env is not None else os.environ.copy(), _cwd=cwd)
+    except sh.ErrorReturnCode as ex:
+        log.error(ex.stderr.decode())
+        return ex.exit_code
+    return 0
@@ -3,11 +3,37 @@ import os
 import pulumi
 import pulumi_docker as docker
 from pulumi import Output
+from pulumi.dynamic import ResourceProvider, Resource, CreateResult, DiffResult, UpdateResult
 from pulumi_gcp.artifactregistry import Repository
 
 from krules_dev import sane_utils
+from krules_dev.sane_utils.context import normalize_tree
+from krules_dev.sane_utils.registry import find_image, copy_image, parse_image
 from krules_dev.sane_utils.stdvars import inject
 
+
+def get_build_cache_kwargs(image_name: str | Output[str], args: dict) -> dict:
+    """
+    DockerBuildArgs cache options when BUILD_CACHE is set (see sane_utils.get_build_cache_args).
+    The provider cannot export a cache, so whatever the mode layers are cached inline (BUILDKIT_INLINE_CACHE)
+    in the pushed image, and the previous image is used as cache source
+    """
+    mode = sane_utils.get_var_for_target("BUILD_CACHE", default="0").lower()
+    if mode in ("", "0", "false", "no"):
+        return {"args": args}
+    return {
+        "args": {**args, "BUILDKIT_INLINE_CACHE": "1"},
+        "builder_version": docker.BuilderVersion.BUILDER_BUILD_KIT,
+        "cache_from": docker.CacheFromArgs(images=[image_name]),
+    }
+
+
+def _normalize_context(context: str, source_date_epoch: int | None):
+    # only when building: previews leave the context untouched
+    if source_date_epoch is not None and not pulumi.runtime.is_dry_run():
+        normalize_tree(context, source_date_epoch)
+
+
 class DockerImageBuilder(pulumi.ComponentResource):
     def __init__(self, resource_name: str,
                  image_name: str | Output[str],
@@ -31,8 +57,11 @@ class DockerImageBuilder(pulumi.ComponentResource):
         if args is None:
             args = {}
         self.platform = sane_utils.get_var_for_target("BUILD_PLATFORM", default="linux/amd64")
-        self.args = args
         context = os.path.abspath(context)
+        self.source_date_epoch = sane_utils.get_source_date_epoch()
+        if self.source_date_epoch is not None:
+            args = {**args, "SOURCE_DATE_EPOCH": str(self.source_date_epoch)}
+        self.args = args
         self.context = context
         if not os.path.isabs(dockerfile):
             dockerfile = os.path.join(context, dockerfile)
@@ -52,13 +81,14 @@ class DockerImageBuilder(pulumi.ComponentResource):
 
         # https://www.pulumi.com/registry/packages/docker/api-docs/image/
 
+        _normalize_context(self.context, self.source_date_epoch)
         return docker.Image(
             self.name,
             build=docker.DockerBuildArgs(
-                args=self.args,
                 context=self.context,
                 dockerfile=self.dockerfile,
                 platform=self.platform,
+                **get_build_cache_kwargs(self.image_name, self.args),
             ),
             image_name=self.image_name,
             skip_push=self.skip_push
@@ -87,76 +117,257 @@ class SaneDockerImage(pulumi.ComponentResource):
             dockerfile: str = "Dockerfile",
             skip_push: bool = False,
             opts: pulumi.ResourceOptions = None,
+            code_digest_file: str = ".code.digest",
     ) -> None:
+        """
+        With CONTENT_TAGS set the image is tagged code-<digest> after the code digest in context/code_digest_file,
+        the platform, the build args and the dockerfile (see sane_utils.get_content_tag). It is then built and pushed
+        by `docker buildx build` from a dynamic resource (self.image), which first looks for that tag in the
+        image_name (or gcp_repository) registry, then in the shared one (SHARED_DOCKER_REGISTRY, copied with its
+        digest): an image found is reused without building.
+        With REPRODUCIBLE_BUILD set SOURCE_DATE_EPOCH is passed as build arg and, when the image is built (not in
+        previews), the context is normalized (see sane_utils.get_source_date_epoch), so that unchanged code gets
+        the same digest and no diff
+        """
         super().__init__('sane:SaneDockerImage', resource_name, None, opts)
 
         if args is None:
             args = {}
         self.platform = sane_utils.get_var_for_target("BUILD_PLATFORM", default="linux/amd64")
-        self.args = args
         context = os.path.abspath(context)
-        self.context = context
         if not os.path.isabs(dockerfile):
             dockerfile = os.path.join(context, dockerfile)
+        content_tag = sane_utils.get_content_tag(os.path.join(context, code_digest_file), platform=self.platform,
+                                                 build_args=args, dockerfile=dockerfile)
+        source_date_epoch = sane_utils.get_source_date_epoch()
+        if source_date_epoch is not None:
+            args = {**args, "SOURCE_DATE_EPOCH": str(source_date_epoch)}
+        self.args = args
+        self.context = context
         self.dockerfile = dockerfile
         self.skip_push = skip_push
+        if skip_push:
+            # nothing to reuse from a registry
+            content_tag = None
 
         if gcp_repository is not None:
             if image_name is None:
                 image_name = resource_name
-            self.image = docker.Image(
-                resource_name,
-                build=docker.DockerBuildArgs(
-                    args=self.args,
-                    context=self.context,
-                    dockerfile=self.dockerfile,
-                    platform=self.platform,
-                ),
-                skip_push=skip_push,
-                # image_name=OutputProxy(
-                #     gcp_repository,
-                #     "location", "project", "repository_id"
-                # ).apply(
-                #     lambda args: f"{args[0]}-docker.pkg.dev/{args[1]}/{args[2]}/{image_name}"
-                # )
-                image_name=pulumi.Output.all(
-                    gcp_repository.location,
-                    gcp_repository.project,
-                    gcp_repository.repository_id
-                ).apply(
-                    lambda args: f"{args[0]}-docker.pkg.dev/{args[1]}/{args[2]}/{image_name}"
-                )
-                #image_name=gcp_repository.apply(
-                #    lambda r: _debug_r(r)
-                       # f"{r['location']}-docker.pkg.dev/{r['project']}/{r['repository_id']}/{image_name}"
-                )
-                # image_name=pulumi.Output.all(
-                #     location=gcp_repository.location,
-                #     project=gcp_repository.project,
-                #     repository_id=gcp_repository.repository_id
-                # ).apply(
-                #     lambda args:
-                #         f"{args['location']}-docker.pkg.dev/{args['project']}/{args['repository_id']}/{image_name}"
-                # )
-
+            shared_name = image_name
+            image_name = pulumi.Output.all(
+                gcp_repository.location,
+                gcp_repository.project,
+                gcp_repository.repository_id
+            ).apply(
+                lambda args: f"{args[0]}-docker.pkg.dev/{args[1]}/{args[2]}/{shared_name}"
+            )
         else:
+            shared_name = parse_image(image_name)[1]
+
+        if content_tag is None:
+            _normalize_context(self.context, source_date_epoch)
             self.image = docker.Image(
                 resource_name,
                 build=docker.DockerBuildArgs(
-                    args=self.args,
                     context=self.context,
                     dockerfile=self.dockerfile,
                     platform=self.platform,
+                    **get_build_cache_kwargs(image_name, self.args),
                 ),
                 skip_push=skip_push,
-                image_name=image_name
+                image_name=image_name,
+            )
+            self.repo_digest = pulumi.Output.all(
+                self.image.image_name,
+                self.image.repo_digest,
+            ).apply(
+                lambda args: f"{args[0]}@{args[1].split('@')[1]}"
+            )
+        else:
+            # the registry lookup happens in the provider, when the resource is created or updated
+            shared_registry = sane_utils.get_var_for_target("SHARED_DOCKER_REGISTRY")
+            cache_kwargs = get_build_cache_kwargs(image_name, self.args)
+            self.image = _ContentImageResource(resource_name, {
+                "image_name": image_name,
+                "content_tag": content_tag,
+                "shared_image": shared_registry and f"{shared_registry}/{shared_name}:{content_tag}".lower() or "",
+                "context": self.context,
+                "dockerfile": self.dockerfile,
+                "platform": self.platform,
+                "args": cache_kwargs["args"],
+                "inline_cache": "cache_from" in cache_kwargs,
+                "source_date_epoch": source_date_epoch,
+            }, opts=pulumi.ResourceOptions(parent=self))
+            self.repo_digest = self.image.repo_digest
+
+        self.register_outputs({})
+
+
+def _repo_digest(image: str, digest: str) -> str:
+    name = image.split("@")[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    return f"{name}@{digest}"
+
+
+class _ImageCopyProvider(ResourceProvider):
+    # runs in the pulumi engine: everything it needs is passed in the props
+
+    def _copy(self, props) -> dict:
+        digest = copy_image(props["source"], props["destination"])
+        return {**props, "digest": digest, "repo_digest": _repo_digest(props["destination"], digest)}
+
+    def create(self, props):
+        return CreateResult(id_=props["destination"], outs=self._copy(props))
+
+    def diff(self, _id, olds, news):
+        changes = olds.get("source") != news["source"] or olds.get("destination") != news["destination"]
+        if not changes:
+            # same references, the source tag may point to another image since
+            try:
+                found = find_image(news["source"])
+                changes = found is not None and found.split("@")[1] != olds.get("digest")
+            except Exception as ex:
+                pulumi.log.debug(f"Cannot check the registry for {news['source']}: {ex}")
+        return DiffResult(
+            changes=changes,
+            replaces=["destination"] if olds.get("destination") != news["destination"] else [],
+            delete_before_replace=False,
+        )
+
+    def update(self, _id, _olds, news):
+        return UpdateResult(outs=self._copy(news))
+
+    # nothing is deleted from the registry: the image may still be deployed elsewhere
+
+
+class _ContentImageProvider(ResourceProvider):
+    # runs in the pulumi engine: everything it needs is passed in the props
+
+    def _image(self, props) -> dict:
+        image = f"{props['image_name']}:{props['content_tag']}"
+        for candidate in filter(None, [image, props["shared_image"]]):
+            try:
+                found = find_image(candidate)
+                if found is not None and candidate != image:
+                    copy_image(found, image)
+            except Exception as ex:
+                pulumi.log.debug(f"Cannot reuse {candidate}: {ex}")
+                continue
+            if found is not None:
+                digest = found.split("@")[1]
+                return {**props, "built": False, "repo_digest": _repo_digest(props["image_name"], digest)}
+        digest = self._build(props, image)
+        return {**props, "built": True, "repo_digest": _repo_digest(props["image_name"], digest)}
+
+    def _build(self, props, image: str) -> str:
+        import json
+        import tempfile
+
+        import sh
+
+        epoch = props.get("source_date_epoch")
+        if epoch is not None:
+            normalize_tree(props["context"], int(epoch))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metadata_file = os.path.join(tmp_dir, "metadata.json")
+            sh.Command("docker").buildx.build(
+                "--platform", props["platform"],
+                "-f", props["dockerfile"],
+                "-t", image,
+                *[item for k, v in props["args"].items() for item in ("--build-arg", f"{k}={v}")],
+                *(["--cache-from", props["image_name"]] if props["inline_cache"] else []),
+                "--output", "type=registry" + (",rewrite-timestamp=true" if epoch is not None else ""),
+                "--metadata-file", metadata_file,
+                props["context"],
+            )
+            with open(metadata_file) as f:
+                return json.load(f)["containerimage.digest"]
+
+    def create(self, props):
+        outs = self._image(props)
+        return CreateResult(id_=f"{props['image_name']}:{props['content_tag']}", outs=outs)
+
+    def diff(self, _id, olds, news):
+        keys = ("image_name", "content_tag", "shared_image", "platform")
+        changes = any(olds.get(k) != news[k] for k in keys)
+        if not changes:
+            # same content tag, the image may have been removed from the registry since
+            try:
+                changes = find_image(f"{news['image_name']}:{news['content_tag']}") is None
+            except Exception as ex:
+                pulumi.log.debug(f"Cannot check the registry for {news['image_name']}: {ex}")
+        return DiffResult(changes=changes, replaces=[], delete_before_replace=False)
+
+    def update(self, _id, _olds, news):
+        return UpdateResult(outs=self._image(news))
+
+    # nothing is deleted from the registry: the image may still be deployed elsewhere
+
+
+class _ContentImageResource(Resource):
+    repo_digest: Output[str]
+    built: Output[bool]
+
+    def __init__(self, resource_name: str, props: dict, opts: pulumi.ResourceOptions = None):
+        super().__init__(_ContentImageProvider(), resource_name, {
+            **props,
+            "built": None,
+            "repo_digest": None,
+        }, opts)
+
+
+class _PromotedImageResource(Resource):
+    digest: Output[str]
+    repo_digest: Output[str]
+
+    def __init__(self, resource_name: str, source, destination, opts: pulumi.ResourceOptions = None):
+        super().__init__(_ImageCopyProvider(), resource_name, {
+            "source": source,
+            "destination": destination,
+            "digest": None,
+            "repo_digest": None,
+        }, opts)
+
+
+class PromotedImage(pulumi.ComponentResource):
+
+    def __init__(
+            self, resource_name: str,
+            source: str | Output[str],
+            destination: str | Output[str] = None,
+            gcp_repository: Repository = None,
+            image_name: str = None,
+            tag: str = None,
+            opts: pulumi.ResourceOptions = None,
+    ) -> None:
+        """
+        Copies the source image (a tag or a digest reference, eg: the repo_digest of a SaneDockerImage of another
+        stack) to destination, or to image_name in gcp_repository, through the registry API (see
+        sane_utils.registry.copy_image), without building or pulling anything.
+        The digest is preserved: repo_digest can be used wherever a SaneDockerImage's is
+        (eg: the image argument of the deploy components)
+        """
+        super().__init__('sane:PromotedImage', resource_name, None, opts)
+
+        if image_name is None:
+            image_name = resource_name
+        if tag is None:
+            tag = os.environ.get("RELEASE_VERSION", "latest")
+        if destination is None:
+            if gcp_repository is None:
+                raise ValueError("one of destination or gcp_repository is needed")
+            destination = pulumi.Output.all(
+                gcp_repository.location,
+                gcp_repository.project,
+                gcp_repository.repository_id
+            ).apply(
+                lambda args: f"{args[0]}-docker.pkg.dev/{args[1]}/{args[2]}/{image_name}:{tag}"
             )
 
-        self.repo_digest = pulumi.Output.all(
-            self.image.image_name,
-            self.image.repo_digest,
-        ).apply(
-            lambda args: f"{args[0]}@{args[1].split('@')[1]}"
+        self.image = _PromotedImageResource(
+            resource_name, source, destination, opts=pulumi.ResourceOptions(parent=self)
         )
+        self.repo_digest = self.image.repo_digest
 
         self.register_outputs({})
@@ -13,7 +13,7 @@ from pulumi_kubernetes.core.v1 import ServiceAccount, EnvVarArgs, ServiceSpecTyp
 from krules_dev import sane_utils
 from krules_dev.sane_utils import inject, get_hashed_resource_name
 from krules_dev.sane_utils.consts import PUBSUB_PULL_CE_SUBSCRIBER_IMAGE
-from krules_dev.sane_utils.pulumi.components import SaneDockerImage, GoogleServiceAccount
+from krules_dev.sane_utils.pulumi.components import SaneDockerImage, PromotedImage, GoogleServiceAccount
 
 
 class GkeStatefulSet(pulumi.ComponentResource):
@@ -48,19 +48,22 @@ class GkeStatefulSet(pulumi.ComponentResource):
                  app_container_pod_spec_kwargs: dict = None,
                  app_container_pvc_mounts: dict = None,
                  extra_containers: Sequence[kubernetes.core.v1.ContainerArgs] = None,
+                 image: SaneDockerImage | PromotedImage = None,
                  opts: pulumi.ResourceOptions = None) -> None:
 
         super().__init__('sane:gke:SetefulSet', resource_name, None, opts)
 
-        # BUILD AND PUSH IMAGE
-        self.image = SaneDockerImage(
-            resource_name,
-            gcp_repository=gcp_repository,
-            image_name=image_name,
-            args=build_args,
-            context=context,
-            dockerfile=dockerfile,
-        )
+        # BUILD AND PUSH IMAGE (unless an already built or promoted one is given)
+        if image is None:
+            image = SaneDockerImage(
+                resource_name,
+                gcp_repository=gcp_repository,
+                image_name=image_name,
+                args=build_args,
+                context=context,
+                dockerfile=dockerfile,
+            )
+        self.image = image
 
         # CREATE SERVICE ACCOUNT (if None)
         if ksa is None:
@@ -13,7 +13,7 @@ from pulumi_google_native.cloudresourcemanager import v1 as gcp_resourcemanager_
 
 from krules_dev import sane_utils
 from krules_dev.sane_utils import inject
-from krules_dev.sane_utils.pulumi.components import SaneDockerImage, GoogleServiceAccount
+from krules_dev.sane_utils.pulumi.components import SaneDockerImage, PromotedImage, GoogleServiceAccount
 
 
 class CloudRun(pulumi.ComponentResource):
@@ -41,19 +41,22 @@ class CloudRun(pulumi.ComponentResource):
                  service_template_kwargs: dict = None,
                  app_container_kwargs: dict = None,
                  extra_containers: Sequence[ServiceTemplateContainer] = None,
+                 image: SaneDockerImage | PromotedImage = None,
                  opts: pulumi.ResourceOptions = None) -> None:
 
         super().__init__('sane:gcp:CloudRun', resource_name, None, opts)
 
-        # BUILD AND PUSH IMAGE
-        self.image = SaneDockerImage(
-            resource_name,
-            gcp_repository=gcp_repository,
-            image_name=image_name,
-            args=build_args,
-            context=context,
-            dockerfile=dockerfile,
-        )
+        # BUILD AND PUSH IMAGE (unless an already built or promoted one is given)
+        if image is None:
+            image = SaneDockerImage(
+                resource_name,
+                gcp_repository=gcp_repository,
+                image_name=image_name,
+                args=build_args,
+                context=context,
+                dockerfile=dockerfile,
+            )
+        self.image = image
 
         # CREATE SERVICE ACCOUNT (if None)
         if sa is None:
@@ -159,7 +162,7 @@ class CloudRun(pulumi.ComponentResource):
             )
 
         app_container = ServiceTemplateContainer(
-            image=self.image.image.repo_digest,
+            image=self.image.repo_digest,
             name=resource_name,
             envs=app_container_env,
             **app_container_kwargs
@@ -0,0 +1,409 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import typing
+
+import sh
+import structlog
+
+log = structlog.get_logger()
+
+MANIFEST_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+INDEX_TYPES = MANIFEST_TYPES[:2]
+
+DOCKER_HUB = "registry-1.docker.io"
+
+
+def parse_image(image: str) -> tuple[str, str, str]:
+    """
+    Splits an image reference in registry host, repository and reference (tag or digest, default "latest")
+    """
+    name, reference = image, "latest"
+    if "@" in name:
+        name, reference = name.split("@", 1)
+    elif ":" in name.rsplit("/", 1)[-1]:
+        name, reference = name.rsplit(":", 1)
+    host, _, repository = name.partition("/")
+    if not repository or not ("." in host or ":" in host or host == "localhost"):
+        host, repository = DOCKER_HUB, name
+    if host in ("docker.io", "index.docker.io"):
+        host = DOCKER_HUB
+    if host == DOCKER_HUB and "/" not in repository:
+        repository = f"library/{repository}"
+    return host, repository, reference
+
+
+def get_platform(platform: str) -> tuple[str, str]:
+    # "amd64" or "linux/amd64" (variants are ignored)
+    parts = platform.split("/")
+    return ("linux", parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+
+
+def _docker_credentials(host: str) -> tuple[str, str] | None:
+    config_file = os.path.join(os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker")), "config.json")
+    try:
+        with open(config_file) as f:
+            config = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    helper = config.get("credHelpers", {}).get(host) or config.get("credsStore")
+    if helper:
+        helper_cmd = shutil.which(f"docker-credential-{helper}")
+        if helper_cmd is not None:
+            try:
+                creds = json.loads(str(sh.Command(helper_cmd)("get", _in=host)))
+                return creds["Username"], creds["Secret"]
+            except (sh.ErrorReturnCode, ValueError, KeyError):
+                log.debug("No credentials from helper", host=host, helper=helper)
+    for name, auth in config.get("auths", {}).items():
+        if re.sub(r"^https?://", "", name).split("/")[0] == host and auth.get("auth"):
+            user, _, password = base64.b64decode(auth["auth"]).decode().partition(":")
+            return user, password
+    return None
+
+
+def _content_digest(resp, content: bytes) -> str:
+    # Docker-Content-Digest is optional for registries, the digest is the sha256 of the manifest bytes anyway
+    return resp.headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+class RegistryError(Exception):
+    pass
+
+
+class RegistryClient:
+    """
+    Minimal client of the OCI distribution API (docker registry v2), authenticated with the docker
+    credentials of the host (config.json auths or credential helpers), anonymous otherwise.
+    Plain http is used for localhost and for the hosts in SANE_INSECURE_REGISTRIES (comma separated)
+    """
+
+    def __init__(self, host: str, insecure: bool = None):
+        import urllib3
+
+        self.host = host
+        if insecure is None:
+            insecure = host.split(":")[0] in ("localhost", "127.0.0.1") or \
+                host in os.environ.get("SANE_INSECURE_REGISTRIES", "").split(",")
+        self.base_url = f"{'http' if insecure else 'https'}://{host}/v2"
+        self.http = urllib3.PoolManager()
+        self._credentials = None
+        self._tokens: dict[str, str] = {}
+
+    def _basic_auth(self) -> dict:
+        if self._credentials is None:
+            self._credentials = _docker_credentials(self.host) or ()
+        if not self._credentials:
+            return {}
+        return {"Authorization": "Basic " + base64.b64encode(":".join(self._credentials).encode()).decode()}
+
+    def _token(self, challenge: str, scope: str) -> str | None:
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        fields = [("scope", s) for s in scope.split(" ")]
+        if "service" in params:
+            fields.append(("service", params["service"]))
+        resp = self.http.request("GET", params["realm"], fields=fields, headers=self._basic_auth())
+        if resp.status >= 300:
+            log.debug("Registry token refused", host=self.host, scope=scope, status=resp.status)
+            return None
+        data = json.loads(resp.data)
+        return data.get("token") or data.get("access_token")
+
+    def request(self, method: str, repository: str, path: str, actions: str = "pull", headers: dict = None,
+                body: bytes = None, scope: str = None, redirect: bool = True, preload_content: bool = True):
+        """
+        Request to /v2/<repository>/<path>, answering the authentication challenge if needed.
+        scope defaults to repository:<repository>:<actions>
+        """
+        if scope is None:
+            scope = f"repository:{repository}:{actions}"
+        url = path if path.startswith("http") else f"{self.base_url}/{repository}/{path}"
+        headers = dict(headers or {})
+
+        def _do():
+            token = self._tokens.get(scope)
+            auth = {"Authorization": f"Bearer {token}"} if token else {}
+            return self.http.request(method, url, headers={**headers, **auth}, body=body, redirect=redirect,
+                                     preload_content=preload_content)
+
+        resp = _do()
+        if resp.status == 401:
+            challenge = resp.headers.get("WWW-Authenticate", "")
+            if challenge.lower().startswith("bearer"):
+                token = self._token(challenge, scope)
+                if token is not None:
+                    self._tokens[scope] = token
+                    resp = _do()
+            elif challenge.lower().startswith("basic"):
+                resp = self.http.request(method, url, headers={**headers, **self._basic_auth()}, body=body,
+                                         redirect=redirect, preload_content=preload_content)
+        return resp
+
+    def get_manifest(self, repository: str, reference: str) -> tuple[str, dict] | None:
+        """
+        Digest and content of a manifest (or index), None if not found
+        """
+        found = self.get_raw_manifest(repository, reference)
+        if found is None:
+            return None
+        return found[0], json.loads(found[2])
+
+    def get_raw_manifest(self, repository: str, reference: str) -> tuple[str, str, bytes] | None:
+        """
+        Digest, media type and exact bytes of a manifest (the digest is computed over them when the registry
+        does not send it), None if not found
+        """
+        resp = self.request("GET", repository, f"manifests/{reference}", headers={"Accept": ", ".join(MANIFEST_TYPES)})
+        if resp.status == 404:
+            return None
+        if resp.status >= 300:
+            raise RegistryError(f"GET {repository}/manifests/{reference}: {resp.status}")
+        media_type = resp.headers.get("Content-Type") or json.loads(resp.data).get("mediaType")
+        return _content_digest(resp, resp.data), media_type, resp.data
+
+    def put_manifest(self, repository: str, reference: str, media_type: str, content: bytes) -> str:
+        resp = self.request("PUT", repository, f"manifests/{reference}", actions="pull,push",
+                            headers={"Content-Type": media_type}, body=content)
+        if resp.status >= 300:
+            raise RegistryError(f"PUT {repository}/manifests/{reference}: {resp.status} {resp.data[:200]!r}")
+        return _content_digest(resp, content)
+
+    def tag(self, repository: str, reference: str, tag: str) -> str:
+        """
+        Adds tag to the manifest reference points to, within the same repository (no blob is moved).
+        Returns the manifest digest
+        """
+        found = self.get_raw_manifest(repository, reference)
+        if found is None:
+            raise RegistryError(f"{repository}:{reference} not found")
+        digest, media_type, content = found
+        self.put_manifest(repository, tag, media_type, content)
+        return digest
+
+    def _url(self, location: str) -> str:
+        # upload locations can be relative to the registry
+        return location if location.startswith("http") else f"{self.base_url[:-len('/v2')]}{location}"
+
+    def blob_exists(self, repository: str, digest: str) -> bool:
+        return self.request("HEAD", repository, f"blobs/{digest}").status == 200
+
+    def mount_blob(self, repository: str, digest: str, from_repository: str) -> str | None:
+        """
+        Cross repository mount of a blob within this registry: no data is moved.
+        Returns None when mounted, otherwise the location of the upload session the registry opened instead
+        """
+        scope = f"repository:{repository}:pull,push repository:{from_repository}:pull"
+        resp = self.request("POST", repository, f"blobs/uploads/?mount={digest}&from={from_repository}", scope=scope)
+        if resp.status == 201:
+            return None
+        if resp.status == 202:
+            return self._url(resp.headers["Location"])
+        raise RegistryError(f"POST {repository}/blobs/uploads (mount {digest}): {resp.status}")
+
+    def upload_blob(self, repository: str, digest: str, chunks: typing.Iterable[bytes], location: str = None):
+        """
+        Uploads a blob in chunks (PATCH) within an upload session, opened when no location is given
+        """
+        if location is None:
+            resp = self.request("POST", repository, "blobs/uploads/", actions="pull,push")
+            if resp.status != 202:
+                raise RegistryError(f"POST {repository}/blobs/uploads: {resp.status}")
+            location = self._url(resp.headers["Location"])
+        offset = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            resp = self.request("PATCH", repository, location, actions="pull,push", body=chunk, headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"{offset}-{offset + len(chunk) - 1}",
+                "Content-Length": str(len(chunk)),
+            })
+            if resp.status != 202:
+                raise RegistryError(f"PATCH {repository}/blobs/uploads: {resp.status}")
+            location = self._url(resp.headers["Location"])
+            offset += len(chunk)
+        sep = "&" if "?" in location else "?"
+        resp = self.request("PUT", repository, f"{location}{sep}digest={digest}", actions="pull,push",
+                            headers={"Content-Length": "0"})
+        if resp.status != 201:
+            raise RegistryError(f"PUT {repository}/blobs/uploads ({digest}): {resp.status}")
+
+    def read_blob(self, repository: str, digest: str, chunk_size: int = 16 * 1024 * 1024) -> typing.Iterator[bytes]:
+        resp = self.request("GET", repository, f"blobs/{digest}", preload_content=False)
+        if resp.status >= 300:
+            raise RegistryError(f"GET {repository}/blobs/{digest}: {resp.status}")
+        try:
+            # one chunk per PATCH request
+            buffer = b""
+            for data in resp.stream(1024 * 1024):
+                buffer += data
+                if len(buffer) >= chunk_size:
+                    yield buffer
+                    buffer = b""
+            yield buffer
+        finally:
+            resp.release_conn()
+
+    def get_image_digests(self, repository: str, reference: str, platform: str = "linux/amd64") -> dict | None:
+        """
+        For the image in the registry: the digest of the manifest (index) the reference points to, and the
+        digest of the manifest and of the config of the given platform. None if not found
+        """
+        found = self.get_manifest(repository, reference)
+        if found is None:
+            return None
+        digest, manifest = found
+        platform_digest = digest
+        if manifest.get("mediaType") in INDEX_TYPES or "manifests" in manifest:
+            os_, arch = get_platform(platform)
+            for m in manifest.get("manifests", []):
+                p = m.get("platform", {})
+                if p.get("os") == os_ and p.get("architecture") == arch:
+                    platform_digest = m["digest"]
+                    break
+            else:
+                return {"digest": digest, "platform_digest": None, "config_digest": None}
+            found = self.get_manifest(repository, platform_digest)
+            if found is None:
+                return None
+            manifest = found[1]
+        return {
+            "digest": digest,
+            "platform_digest": platform_digest,
+            "config_digest": manifest.get("config", {}).get("digest"),
+        }
+
+
+_clients: dict[str, RegistryClient] = {}
+
+
+def get_registry_client(host: str) -> RegistryClient:
+    if host not in _clients:
+        _clients[host] = RegistryClient(host)
+    return _clients[host]
+
+
+def find_pushed_image(image: str, image_id: str, platform: str = "linux/amd64") -> str | None:
+    """
+    Digest of the manifest image (a tagged reference) points to in the registry, when it holds the image_id
+    local image (its config digest, or its manifest digest with the containerd image store). None otherwise
+    """
+    host, repository, reference = parse_image(image)
+    digests = get_registry_client(host).get_image_digests(repository, reference, platform)
+    if digests is None:
+        return None
+    if image_id in (digests["config_digest"], digests["platform_digest"], digests["digest"]):
+        return digests["digest"]
+    return None
+
+
+def find_image(image: str) -> str | None:
+    """
+    "<repository>@<digest>" of the image (tagged reference) in its registry, None if not found
+    """
+    host, repository, reference = parse_image(image)
+    found = get_registry_client(host).get_manifest(repository, reference)
+    if found is None:
+        return None
+    return f"{image.rsplit(':', 1)[0] if ':' in image.rsplit('/', 1)[-1] else image}@{found[0]}"
+
+
+def get_base_images(dockerfile: str) -> list[str]:
+    """
+    The images the stages of dockerfile are built FROM, as "<repository>@<digest>" of the manifest their tag
+    points to in the registry: the same dockerfile gets other base images when their tags move.
+    References that cannot be resolved (build args, registry not reachable) are returned as they are
+    """
+    with open(dockerfile) as f:
+        content = f.read()
+    stages, images = set(), []
+    for match in re.finditer(r"^\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?", content, re.I | re.M):
+        image, stage = match.groups()
+        if stage:
+            stages.add(stage.lower())
+        if image.lower() in stages or image == "scratch":
+            continue
+        if "@" not in image and "$" not in image:
+            try:
+                image = find_image(image) or image
+            except Exception as ex:
+                log.debug("Cannot resolve the base image", image=image, ex=str(ex))
+        images.append(image)
+    return images
+
+
+def _copy_blob(src: RegistryClient, src_repository: str, dst: RegistryClient, dst_repository: str, digest: str):
+    if dst.blob_exists(dst_repository, digest):
+        return
+    location = None
+    if src.host == dst.host:
+        location = dst.mount_blob(dst_repository, digest, src_repository)
+        if location is None:
+            log.debug("Blob mounted", digest=digest, repository=dst_repository, from_repository=src_repository)
+            return
+    log.debug("Copying blob", digest=digest, repository=dst_repository)
+    dst.upload_blob(dst_repository, digest, src.read_blob(src_repository, digest), location)
+
+
+def _copy_manifest(src: RegistryClient, src_repository: str, dst: RegistryClient, dst_repository: str,
+                   reference: str, dst_reference: str) -> str:
+    found = src.get_raw_manifest(src_repository, reference)
+    if found is None:
+        raise RegistryError(f"{src.host}/{src_repository}:{reference} not found")
+    digest, media_type, content = found
+    manifest = json.loads(content)
+    if "manifests" in manifest:
+        for child in manifest["manifests"]:
+            _copy_manifest(src, src_repository, dst, dst_repository, child["digest"], child["digest"])
+    else:
+        for blob in [manifest["config"], *manifest.get("layers", [])]:
+            if blob.get("urls"):
+                # foreign layer, not stored in registries
+                continue
+            _copy_blob(src, src_repository, dst, dst_repository, blob["digest"])
+    # the very same bytes, so the digest is preserved
+    dst.put_manifest(dst_repository, dst_reference, media_type, content)
+    return digest
+
+
+def copy_image(src_image: str, dst_image: str) -> str:
+    """
+    Copies an image (manifest or index, with its blobs) from a registry (or repository) to another through the
+    registry API, without any docker daemon. Blobs already in the destination are skipped and, within the same
+    registry, mounted from the source repository rather than transferred.
+    dst_image is tagged with its tag, if any. Returns the manifest digest, the same in both registries
+    """
+    src_host, src_repository, src_reference = parse_image(src_image)
+    dst_host, dst_repository, dst_reference = parse_image(dst_image)
+    if "@" in dst_image or ":" not in dst_image.rsplit("/", 1)[-1]:
+        # untagged destination, referenced by digest only
+        dst_reference = None
+    src, dst = get_registry_client(src_host), get_registry_client(dst_host)
+    found = src.get_raw_manifest(src_repository, src_reference)
+    if found is None:
+        raise RegistryError(f"{src_image} not found")
+    digest = found[0]
+    if dst_reference is not None:
+        existing = dst.get_raw_manifest(dst_repository, dst_reference)
+        if existing is not None and existing[0] == digest:
+            log.debug("Image already in place", dst=dst_image, digest=digest)
+            return digest
+    _copy_manifest(src, src_repository, dst, dst_repository, digest, dst_reference or digest)
+    log.debug("Image copied", src=src_image, dst=dst_image, digest=digest)
+    return digest
+
+
+def parse_push_digest(output: str) -> str | None:
+    """
+    Manifest digest from the docker push output ("<tag>: digest: sha256:... size: ...")
+    """
+    found = re.findall(r"digest: (sha256:[0-9a-f]{64})", output)
+    return found[-1] if found else None
@@ -0,0 +1,223 @@
+import abc
+import hashlib
+import json
+import os
+import tempfile
+import typing
+import urllib.parse
+
+import structlog
+
+log = structlog.get_logger()
+
+
+class RemoteCache(abc.ABC):
+    """
+    Minimal blob store shared across machines (eg: CI runners). Names are "/" separated paths
+    """
+
+    @abc.abstractmethod
+    def get(self, name: str) -> bytes | None:
+        ...
+
+    @abc.abstractmethod
+    def put(self, name: str, data: bytes):
+        ...
+
+    def exists(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def get_json(self, name: str) -> dict | None:
+        data = self.get(name)
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            log.warning("Corrupted remote cache entry", name=name)
+            return None
+
+    def put_json(self, name: str, obj: dict):
+        self.put(name, json.dumps(obj, sort_keys=True).encode())
+
+
+class DirectoryRemoteCache(RemoteCache):
+    """
+    Remote cache on a (possibly network mounted) directory, also handy in tests
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.path, *name.split("/"))
+
+    def get(self, name: str) -> bytes | None:
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, data: bytes):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp.")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+
+class HttpRemoteCache(RemoteCache):
+    """
+    Remote cache on any http server accepting GET and PUT (eg: nginx with webdav, bazel-remote)
+    """
+
+    def __init__(self, url: str, headers: dict = None):
+        import urllib3
+        self.url = url.rstrip("/")
+        self.headers = headers or {}
+        self.http = urllib3.PoolManager()
+
+    def get(self, name: str) -> bytes | None:
+        resp = self.http.request("GET", f"{self.url}/{name}", headers=self.headers)
+        if resp.status == 404:
+            return None
+        if resp.status >= 300:
+            log.warning("Remote cache error", name=name, status=resp.status)
+            return None
+        return resp.data
+
+    def put(self, name: str, data: bytes):
+        resp = self.http.request("PUT", f"{self.url}/{name}", body=data, headers=self.headers)
+        if resp.status >= 300:
+            log.warning("Cannot upload to remote cache", name=name, status=resp.status)
+
+    def exists(self, name: str) -> bool:
+        return self.http.request("HEAD", f"{self.url}/{name}", headers=self.headers).status < 300
+
+
+class GcsRemoteCache(RemoteCache):
+    """
+    Remote cache in a Google Cloud Storage bucket (through the JSON API, with application default credentials)
+    """
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        import google.auth
+        import urllib3
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.creds, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/devstorage.read_write"])
+        self.http = urllib3.PoolManager()
+
+    def _headers(self) -> dict:
+        import google.auth.transport.requests
+        if not self.creds.valid:
+            self.creds.refresh(google.auth.transport.requests.Request())
+        return {"Authorization": f"Bearer {self.creds.token}"}
+
+    def _object(self, name: str) -> str:
+        return urllib.parse.quote("/".join(filter(None, (self.prefix, name))), safe="")
+
+    def get(self, name: str) -> bytes | None:
+        resp = self.http.request(
+            "GET", f"https://storage.googleapis.com/storage/v1/b/{self.bucket}/o/{self._object(name)}?alt=media",
+            headers=self._headers()
+        )
+        if resp.status == 404:
+            return None
+        if resp.status >= 300:
+            log.warning("Remote cache error", name=name, status=resp.status)
+            return None
+        return resp.data
+
+    def put(self, name: str, data: bytes):
+        resp = self.http.request(
+            "POST",
+            f"https://storage.googleapis.com/upload/storage/v1/b/{self.bucket}/o"
+            f"?uploadType=media&name={self._object(name)}",
+            body=data, headers={**self._headers(), "Content-Type": "application/octet-stream"}
+        )
+        if resp.status >= 300:
+            log.warning("Cannot upload to remote cache", name=name, status=resp.status)
+
+    def exists(self, name: str) -> bool:
+        return self.http.request(
+            "GET", f"https://storage.googleapis.com/storage/v1/b/{self.bucket}/o/{self._object(name)}",
+            headers=self._headers()
+        ).status < 300
+
+
+class FailSafeRemoteCache(RemoteCache):
+    """
+    Wraps a remote cache so that it is optional: any failure (unreachable server, expired credentials, ...)
+    is logged as a warning and taken as a miss
+    """
+
+    def __init__(self, cache: RemoteCache):
+        self.cache = cache
+
+    def get(self, name: str) -> bytes | None:
+        try:
+            return self.cache.get(name)
+        except Exception as ex:
+            log.warning("Remote cache unavailable, taken as a miss", name=name, ex=str(ex))
+            return None
+
+    def put(self, name: str, data: bytes):
+        try:
+            self.cache.put(name, data)
+        except Exception as ex:
+            log.warning("Remote cache unavailable, entry not uploaded", name=name, ex=str(ex))
+
+    def exists(self, name: str) -> bool:
+        try:
+            return self.cache.exists(name)
+        except Exception as ex:
+            log.warning("Remote cache unavailable, taken as a miss", name=name, ex=str(ex))
+            return False
+
+
+def get_remote_cache(url: str = None) -> RemoteCache | None:
+    """
+    Remote cache from url (default from SANE_REMOTE_CACHE): gs://bucket/prefix, http(s)://..., file:///path or a path.
+    None when not configured or when it cannot be set up (eg: no credentials), see also FailSafeRemoteCache
+    """
+    if url is None:
+        url = os.environ.get("SANE_REMOTE_CACHE")
+    if not url:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    try:
+        if parsed.scheme == "gs":
+            cache = GcsRemoteCache(parsed.netloc, parsed.path)
+        elif parsed.scheme in ("http", "https"):
+            cache = HttpRemoteCache(url)
+        elif parsed.scheme in ("file", ""):
+            cache = DirectoryRemoteCache(parsed.path)
+        else:
+            raise ValueError(f"Unsupported remote cache: {url}")
+    except ValueError:
+        raise
+    except Exception as ex:
+        log.warning("Remote cache unavailable, not used", url=url, ex=str(ex))
+        return None
+    return FailSafeRemoteCache(cache)
+
+
+def image_entry_name(target_image: str, code_digest: str, platform: str = "", build_args: dict = None,
+                     dockerfile: str = None, base_images: typing.Sequence[str] = ()) -> str:
+    """
+    Name of the remote entry recording that target_image was built (for platform, with build_args, from the
+    dockerfile content and the base_images, see registry.get_base_images) and pushed from code_digest
+    """
+    dockerfile_digest = ""
+    if dockerfile is not None and os.path.exists(dockerfile):
+        with open(dockerfile, "rb") as f:
+            dockerfile_digest = hashlib.sha256(f.read()).hexdigest()
+    key = json.dumps([target_image, code_digest, platform, sorted((build_args or {}).items()),
+                      dockerfile_digest, list(base_images)])
+    return f"images/{hashlib.sha256(key.encode()).hexdigest()}.json"
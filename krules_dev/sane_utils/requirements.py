@@ -0,0 +1,124 @@
+import hashlib
+import os
+import re
+import typing
+
+import structlog
+
+from krules_dev.sane_utils.templating import write_if_changed
+
+log = structlog.get_logger()
+
+MERGED_REQUIREMENTS = "requirements.merged.txt"
+
+# options worth keeping in the merged file (the others are either includes or meaningless once merged)
+_KEPT_OPTIONS = ("--index-url", "-i", "--extra-index-url", "--find-links", "-f", "--pre", "--prefer-binary")
+
+
+def _logical_lines(path: str) -> typing.Iterator[str]:
+    with open(path) as f:
+        line = ""
+        for raw in f:
+            raw = raw.rstrip("\n")
+            if raw.endswith("\\"):
+                line += raw[:-1]
+                continue
+            line = re.sub(r"(^|\s)#.*$", "", line + raw).strip()
+            if line:
+                yield line
+            line = ""
+
+
+def read_requirements(path: str, _seen: set = None) -> tuple[list[str], list[str]]:
+    """
+    Options and requirements of a requirements file, following -r/-c includes.
+    Editable and local path requirements are skipped: they are part of the sources, not of the dependencies layer
+    """
+    if _seen is None:
+        _seen = set()
+    path = os.path.abspath(path)
+    if path in _seen:
+        return [], []
+    _seen.add(path)
+    options, requirements = [], []
+    for line in _logical_lines(path):
+        if line.startswith(("-r ", "-c ", "--requirement", "--constraint")):
+            include = re.split(r"[\s=]+", line, maxsplit=1)[1]
+            inc_options, inc_requirements = read_requirements(os.path.join(os.path.dirname(path), include), _seen)
+            options += inc_options
+            requirements += inc_requirements
+        elif line.startswith("-"):
+            if line.startswith(_KEPT_OPTIONS):
+                options.append(line)
+            else:
+                log.debug("Requirement option skipped", option=line, file=path)
+        elif line.startswith((".", "/", "file:")) or re.match(r"^[\w.-]+\s*@\s*file:", line):
+            log.debug("Local requirement skipped", requirement=line, file=path)
+        else:
+            requirements.append(_normalize(line))
+    return options, requirements
+
+
+def _project_name(requirement: str) -> str:
+    name = re.match(r"^[A-Za-z0-9][A-Za-z0-9._-]*", requirement)
+    return re.sub(r"[-_.]+", "-", name.group(0)).lower() if name else requirement
+
+
+def _normalize(requirement: str) -> str:
+    # same requirement, same line (PEP 503 name, single spaces)
+    requirement = re.sub(r"\s+", " ", requirement)
+    name = re.match(r"^[A-Za-z0-9][A-Za-z0-9._-]*", requirement)
+    return _project_name(requirement) + requirement[name.end():] if name else requirement
+
+
+def merge_requirements(files: typing.Iterable[str]) -> str:
+    """
+    Merges the requirements files (missing ones are ignored) in a single one, sorted by project name and
+    without duplicates, so that its content changes only when the dependencies do
+    """
+    options, requirements = [], []
+    for path in files:
+        if not os.path.isfile(path):
+            continue
+        file_options, file_requirements = read_requirements(path)
+        options += file_options
+        requirements += file_requirements
+    requirements = sorted(set(requirements), key=lambda r: (_project_name(r), r))
+    names = [_project_name(r) for r in requirements]
+    for name in sorted({n for n in names if names.count(n) > 1}):
+        log.warning("Requirement specified more than once, all the constraints apply", name=name)
+    return "".join(f"{line}\n" for line in [*dict.fromkeys(options), *requirements])
+
+
+def write_merged_requirements(out_dir: str, files: typing.Iterable[str],
+                              merged_file: str = MERGED_REQUIREMENTS) -> str:
+    """
+    Writes the merged requirements in out_dir (untouched if unchanged, see write_if_changed).
+    It is not a lock file: versions are pinned only as far as the merged files pin them.
+    Returns the sha256 digest of its content
+    """
+    content = merge_requirements(files)
+    os.makedirs(out_dir, exist_ok=True)
+    write_if_changed(os.path.join(out_dir, merged_file), content)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class MergedRequirementsDigest:
+    """
+    sha256 digest of the merged requirements in out_dir, read whenever it is rendered (str): template contexts
+    are computed once per process (see make_render_resource_recipes) while the merged file is rewritten by its
+    own recipe (see make_merge_requirements_recipe)
+    """
+
+    def __init__(self, out_dir: str, merged_file: str = MERGED_REQUIREMENTS):
+        self.path = os.path.join(out_dir, merged_file)
+
+    def __str__(self) -> str:
+        try:
+            with open(self.path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return ""
+
+    def __repr__(self) -> str:
+        return f"MergedRequirementsDigest({self.path!r})"
@@ -0,0 +1,219 @@
+import json
+import os
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import sh
+import structlog
+
+from krules_dev.sane_utils.cache import get_cache_dir
+from krules_dev.sane_utils.nested import get_child_env
+from krules_dev.sane_utils.templating import write_if_changed
+
+log = structlog.get_logger()
+
+
+class ImageBuildSpec:
+    """
+    An image built (and pushed) by running recipe in the make.py within build_dir, after the images it
+    depends_on. Dependents receive its digest in the env_var environment variable, if any
+    (see get_buildable_image environ_override)
+    """
+
+    def __init__(self,
+                 name: str,
+                 build_dir: str,
+                 depends_on: typing.Sequence[str] = (),
+                 recipe: str = "push",
+                 out_dir: str = ".build",
+                 digest_file: str = ".digest",
+                 env_var: str = None,
+                 env: dict = None):
+        self.name = name
+        self.build_dir = os.path.abspath(build_dir)
+        self.depends_on = list(depends_on)
+        self.recipe = recipe
+        self.out_dir = out_dir
+        self.digest_file = digest_file
+        self.env_var = env_var
+        self.env = dict(env or {})
+
+
+class BuildFailed(Exception):
+
+    def __init__(self, failed: dict[str, int], skipped: list[str]):
+        super().__init__(f"failed: {', '.join(failed)}" + (f", skipped: {', '.join(skipped)}" if skipped else ""))
+        self.failed = failed
+        self.skipped = skipped
+
+
+class _Durations:
+    """
+    Last build time of each image (<cache dir>/build_times.json), to find the critical path
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(get_cache_dir(), "build_times.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.durations = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.durations = {}
+
+    def get(self, build_dir: str, default: float = 1.) -> float:
+        return self.durations.get(build_dir, default)
+
+    def record(self, build_dir: str, duration: float):
+        with self._lock:
+            self.durations[build_dir] = round(duration, 3)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_if_changed(self.path, json.dumps(self.durations, indent=1, sort_keys=True))
+
+
+def _priorities(specs: dict[str, ImageBuildSpec], dependents: dict[str, list[str]],
+                durations: _Durations) -> dict[str, float]:
+    # expected time from the start of a build to the end of everything built on it
+    priorities = {}
+
+    def _priority(name):
+        if name not in priorities:
+            priorities[name] = durations.get(specs[name].build_dir) + max(
+                (_priority(d) for d in dependents[name]), default=0.
+            )
+        return priorities[name]
+
+    for name in specs:
+        _priority(name)
+    return priorities
+
+
+def _check_graph(specs: dict[str, ImageBuildSpec]):
+    for spec in specs.values():
+        for dep in spec.depends_on:
+            if dep not in specs:
+                log.error("Unknown image dependency", image=spec.name, depends_on=dep)
+                sys.exit(-1)
+    done = set()
+
+    def _visit(name, path):
+        if name in path:
+            log.error("Cyclic image dependencies", cycle=" > ".join([*path, name]))
+            sys.exit(-1)
+        if name in done:
+            return
+        for dep in specs[name].depends_on:
+            _visit(dep, [*path, name])
+        done.add(name)
+
+    for name in specs:
+        _visit(name, [])
+
+
+def _run_build(spec: ImageBuildSpec, digests: dict[str, str], specs: dict[str, ImageBuildSpec],
+               print_lock: threading.Lock) -> str:
+    env = get_child_env()
+    for dep in spec.depends_on:
+        if specs[dep].env_var is not None:
+            env[specs[dep].env_var] = digests[dep]
+    env.update(spec.env)
+
+    def _print(line):
+        with print_lock:
+            sys.stdout.write(f"[{spec.name}] {line}" if line.endswith("\n") else f"[{spec.name}] {line}\n")
+            sys.stdout.flush()
+
+    sh.Command(sys.executable)(
+        os.path.join(spec.build_dir, "make.py"), spec.recipe,
+        _env=env, _cwd=spec.build_dir, _out=_print, _err_to_out=True,
+    )
+    with open(os.path.join(spec.build_dir, spec.out_dir, spec.digest_file)) as f:
+        return f.read().strip()
+
+
+def build_images(specs: typing.Iterable[ImageBuildSpec], jobs: int = None,
+                 on_built: typing.Callable[[ImageBuildSpec, str], None] = None) -> dict[str, str]:
+    """
+    Builds the images as soon as the images they depend on are built, up to jobs (or SANE_BUILD_JOBS, default 4)
+    at a time. Among the ready ones, the builds on the longest path (by the last known durations) start first.
+    Each build runs its make.py in a python process, output lines are prefixed with the image name.
+    on_built is called with each built image and its digest.
+    Returns the image digests by name, raises BuildFailed when any build fails (its dependents are skipped,
+    independent builds complete anyway)
+    """
+    specs = {spec.name: spec for spec in specs}
+    _check_graph(specs)
+    if jobs is None:
+        jobs = int(os.environ.get("SANE_BUILD_JOBS", "4"))
+    dependents = {name: [] for name in specs}
+    for spec in specs.values():
+        for dep in spec.depends_on:
+            dependents[dep].append(spec.name)
+    durations = _Durations()
+    priorities = _priorities(specs, dependents, durations)
+    waiting = {name: set(spec.depends_on) for name, spec in specs.items()}
+    ready = [name for name, deps in waiting.items() if not deps]
+    digests: dict[str, str] = {}
+    failed: dict[str, int] = {}
+    skipped: list[str] = []
+    print_lock = threading.Lock()
+
+    def _build(spec):
+        started = time.monotonic()
+        digest = _run_build(spec, digests, specs, print_lock)
+        durations.record(spec.build_dir, time.monotonic() - started)
+        if on_built is not None:
+            on_built(spec, digest)
+        return digest
+
+    def _skip(name):
+        for d in dependents[name]:
+            if d not in skipped:
+                skipped.append(d)
+                _skip(d)
+
+    log.info("Building images", images=len(specs), jobs=jobs)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+
+        def _submit_ready():
+            # no queue within the pool: priorities are applied at each submission
+            ready.sort(key=lambda n: priorities[n], reverse=True)
+            while ready and len(futures) < jobs:
+                name = ready.pop(0)
+                log.debug("Starting build", image=name, priority=round(priorities[name], 3))
+                futures[pool.submit(_build, specs[name])] = name
+
+        _submit_ready()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    digests[name] = future.result()
+                except sh.ErrorReturnCode as ex:
+                    log.error("Image build failed", image=name, exit_code=ex.exit_code)
+                    failed[name] = ex.exit_code
+                    _skip(name)
+                    continue
+                except Exception as ex:
+                    # eg: no digest file written or a failing on_built, the other builds go on anyway
+                    log.exception("Image build failed", image=name, ex=str(ex))
+                    failed[name] = -1
+                    _skip(name)
+                    continue
+                log.info("Image built", image=name, digest=digests[name])
+                for d in dependents[name]:
+                    waiting[d].discard(name)
+                    if not waiting[d] and d not in skipped:
+                        ready.append(d)
+            _submit_ready()
+    log.info("Images built", built=len(digests), failed=len(failed), skipped=len(skipped),
+             elapsed=round(time.monotonic() - started, 3))
+    if failed:
+        raise BuildFailed(failed, skipped)
+    return digests
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import structlog
+
+log = structlog.get_logger()
+
+_environments = {}
+_lock = threading.Lock()
+
+PACKAGE_TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+
+def get_template_dirs(base_dir: str) -> list[str]:
+    """
+    Template search path: the project (app) directory first, then the shared templates
+    in $KRULES_PROJECT_DIR/base/templates and last the ones shipped with sane_utils (eg: macros.j2)
+    """
+    dirs = [base_dir]
+    if "KRULES_PROJECT_DIR" in os.environ:
+        base_templates = os.path.join(os.environ["KRULES_PROJECT_DIR"], "base", "templates")
+        if os.path.isdir(base_templates):
+            dirs.append(base_templates)
+    dirs.append(PACKAGE_TEMPLATES_DIR)
+    return dirs
+
+
+def get_jinja_env(base_dir: str, cache_dir: str = ".build/.jinja-cache"):
+    """
+    Returns the shared jinja Environment of the project in base_dir.
+    Compiled templates are kept in a bytecode cache within cache_dir (relative to base_dir)
+    so that unchanged templates are not compiled again across runs
+    """
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+    with _lock:
+        env = _environments.get(base_dir)
+        if env is None:
+            cache_dir = os.path.join(base_dir, cache_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+            env = Environment(
+                loader=FileSystemLoader(get_template_dirs(base_dir)),
+                bytecode_cache=FileSystemBytecodeCache(cache_dir),
+                trim_blocks=True,
+                lstrip_blocks=True,
+            )
+            _environments[base_dir] = env
+    return env
+
+
+def get_template(j2_template: str, base_dir: str):
+    """
+    Loads a template through the shared Environment, by its path relative to base_dir.
+    Templates outside the search path are compiled from their source (without bytecode cache)
+    """
+    env = get_jinja_env(base_dir)
+    path = os.path.join(base_dir, j2_template)
+    for template_dir in env.loader.searchpath:
+        rel_path = os.path.relpath(path, template_dir)
+        if not rel_path.startswith(os.pardir) and os.path.exists(os.path.join(template_dir, rel_path)):
+            return env.get_template(rel_path.replace(os.sep, "/"))
+    log.debug("Template outside of the search path", template=j2_template)
+    with open(path) as f:
+        return env.from_string(f.read())
+
+
+def template_fingerprint(j2_template: str, base_dir: str, context: dict) -> str | None:
+    """
+    Digest of the template source, of the templates it imports/includes/extends and of the context.
+    None when it cannot be computed (eg: dynamically named includes)
+    """
+    from jinja2 import meta, TemplateNotFound
+
+    env = get_jinja_env(base_dir)
+    h = hashlib.sha256()
+    with open(os.path.join(base_dir, j2_template)) as f:
+        sources = [f.read()]
+    seen = set()
+    while sources:
+        source = sources.pop()
+        h.update(source.encode())
+        for name in sorted(meta.find_referenced_templates(env.parse(source)), key=str):
+            if name is None:
+                return None
+            if name in seen:
+                continue
+            seen.add(name)
+            try:
+                sources.append(env.loader.get_source(env, name)[0])
+            except TemplateNotFound:
+                return None
+    h.update(json.dumps(context, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """
+    Atomically replaces path with content, only if the content differs. Returns True if written
+    """
+    data = content.encode()
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+class RenderLedger:
+    """
+    Records, for each file rendered in a directory, the fingerprint it was rendered from
+    and the digest of the output, in <out_dir>/.render.ledger
+    """
+
+    def __init__(self, out_dir: str):
+        self.ledger_file = os.path.join(out_dir, ".render.ledger")
+        self._lock = threading.Lock()
+        try:
+            with open(self.ledger_file) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def is_fresh(self, resource_file: str, fingerprint: str | None) -> bool:
+        entry = self.entries.get(os.path.basename(resource_file))
+        if fingerprint is None or entry is None or entry["fingerprint"] != fingerprint:
+            return False
+        try:
+            with open(resource_file, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest() == entry["digest"]
+        except FileNotFoundError:
+            return False
+
+    def record(self, resource_file: str, fingerprint: str | None, content: str):
+        with self._lock:
+            self.entries[os.path.basename(resource_file)] = {
+                "fingerprint": fingerprint,
+                "digest": hashlib.sha256(content.encode()).hexdigest(),
+            }
+            write_if_changed(self.ledger_file, json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+_ledgers = {}
+
+
+def get_render_ledger(out_dir: str) -> RenderLedger:
+    out_dir = os.path.abspath(out_dir)
+    with _lock:
+        if out_dir not in _ledgers:
+            _ledgers[out_dir] = RenderLedger(out_dir)
+        return _ledgers[out_dir]
@@ -0,0 +1,225 @@
+import os
+import re
+from fnmatch import fnmatchcase
+
+import structlog
+
+log = structlog.get_logger()
+
+DEFAULT_EXCLUDES = (
+    "__pycache__", "*.py[cod]", ".venv", "venv", "node_modules", ".build", ".git",
+    ".mypy_cache", ".pytest_cache", ".ruff_cache", ".tox", ".nox", "*.egg-info",
+)
+IGNORE_FILES = (".dockerignore", ".gitignore")
+
+
+def _translate(pattern: str) -> str:
+    # gitignore style pattern to regex (`*` and `?` never match "/", `**` spans directories)
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        if pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            res.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            res.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            res.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            j = pattern.index("]", i + 2)
+            chars = pattern[i + 1:j]
+            if chars[0] in "!^":
+                chars = "^" + chars[1:]
+            res.append(f"[{chars.replace(chr(92), chr(92) * 2)}]")
+            i = j + 1
+        elif pattern[i] == "\\" and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            res.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(res)
+
+
+class IgnoreRules:
+    """
+    A list of .gitignore/.dockerignore style rules relative to a base directory.
+    The last matching rule wins, "!" re-includes, a trailing "/" restricts the rule to directories
+    and patterns without an inner "/" match at any depth
+    """
+
+    def __init__(self, base: str, patterns=()):
+        self.base = base
+        self.rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str):
+        pattern = pattern.rstrip("\n").rstrip()
+        if not pattern or pattern.startswith("#"):
+            return
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if "/" in pattern:
+            regex = _translate(pattern.lstrip("/"))
+        else:
+            regex = "(?:.*/)?" + _translate(pattern)
+        self.rules.append((re.compile(regex, re.S), negate, dir_only))
+
+    @classmethod
+    def from_file(cls, path: str) -> "IgnoreRules":
+        with open(path, "r") as f:
+            return cls(os.path.dirname(path), f.readlines())
+
+    def match(self, path: str, is_dir: bool) -> bool | None:
+        if path.startswith(self.base + os.sep):
+            rel_path = path[len(self.base) + 1:]
+        else:
+            rel_path = os.path.relpath(path, self.base)
+        rel_path = rel_path.replace(os.sep, "/")
+        matched = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(rel_path):
+                matched = not negate
+        return matched
+
+
+class Walker:
+    """
+    os.scandir based tree walker that skips well known junk (caches, virtualenvs, .build, ...)
+    and honours the ignore files (.dockerignore, .gitignore) found in each walked directory.
+    Output is sorted, so that it can be used to compute stable digests
+    """
+
+    def __init__(self, excludes=None, ignore_files=None):
+        if excludes is None:
+            excludes = DEFAULT_EXCLUDES
+        if ignore_files is None:
+            ignore_files = [f for f in os.environ.get("SANE_IGNORE_FILES", ",".join(IGNORE_FILES)).split(",") if f]
+        self.excludes = tuple(excludes)
+        self.ignore_files = tuple(ignore_files)
+
+    def _dir_rules(self, dir_path: str, parent_rules: list, is_root: bool = False) -> list:
+        rules = list(parent_rules)
+        if is_root:
+            rules.append(IgnoreRules(dir_path, self.excludes))
+        for ignore_file in self.ignore_files:
+            p = os.path.join(dir_path, ignore_file)
+            if os.path.isfile(p):
+                rules.append(IgnoreRules.from_file(p))
+        return rules
+
+    @staticmethod
+    def _ignored(rules: list, path: str, is_dir: bool) -> bool:
+        ignored = False
+        for r in rules:
+            matched = r.match(path, is_dir)
+            if matched is not None:
+                ignored = matched
+        return ignored
+
+    def _scan(self, dir_path: str, rules: list):
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as ex:
+            log.debug("Cannot scan directory", path=dir_path, ex=str(ex))
+            return
+        for entry in entries:
+            is_dir = entry.is_dir()
+            if not self._ignored(rules, entry.path, is_dir):
+                yield entry, is_dir
+
+    def walk(self, root: str, dirs: bool = False):
+        """
+        Yields the files under root (and the directories too, if dirs), root itself if it is a file
+        """
+        if os.path.isfile(root):
+            yield root
+            return
+        stack = [(root, self._dir_rules(root, [], is_root=True))]
+        while stack:
+            dir_path, rules = stack.pop()
+            subdirs = []
+            for entry, is_dir in self._scan(dir_path, rules):
+                if is_dir:
+                    if dirs:
+                        yield entry.path
+                    subdirs.append(entry.path)
+                else:
+                    yield entry.path
+            stack.extend((d, self._dir_rules(d, rules)) for d in reversed(subdirs))
+
+    def glob(self, pattern: str, base_dir: str = None) -> list:
+        """
+        Like glob(pattern, recursive=True) but excluded entries are never matched nor walked.
+        Relative patterns are resolved against base_dir (default: cwd) and returned relative to it
+        """
+        if base_dir is None:
+            base_dir = os.getcwd()
+        full_pattern = os.path.join(base_dir, pattern)
+        parts = full_pattern.split(os.sep)
+        magic = [i for i, p in enumerate(parts) if re.search(r"[*?\[]", p)]
+        if not magic:
+            return [pattern] if os.path.lexists(full_pattern) else []
+        root = os.sep.join(parts[:magic[0]]) or os.sep
+        matches = []
+        seen = set()
+        self._glob(root, parts[magic[0]:], self._dir_rules(root, [], is_root=True), matches, seen)
+        if os.path.isabs(pattern):
+            return matches
+        return [os.path.relpath(m, base_dir) for m in matches]
+
+    def _glob(self, dir_path: str, parts: list, rules: list, matches: list, seen: set):
+        if not parts:
+            if dir_path not in seen:
+                seen.add(dir_path)
+                matches.append(dir_path)
+            return
+        head, rest = parts[0], parts[1:]
+        if head == "**":
+            self._glob(dir_path, rest, rules, matches, seen)
+            for entry, is_dir in self._scan(dir_path, rules):
+                if entry.name.startswith("."):
+                    continue
+                if is_dir:
+                    self._glob(entry.path, parts, self._dir_rules(entry.path, rules), matches, seen)
+                elif not rest and entry.path not in seen:
+                    seen.add(entry.path)
+                    matches.append(entry.path)
+        elif re.search(r"[*?\[]", head):
+            for entry, is_dir in self._scan(dir_path, rules):
+                if entry.name.startswith(".") and not head.startswith("."):
+                    continue
+                if not fnmatchcase(entry.name, head):
+                    continue
+                if not rest:
+                    self._glob(entry.path, rest, rules, matches, seen)
+                elif is_dir:
+                    self._glob(entry.path, rest, self._dir_rules(entry.path, rules), matches, seen)
+        else:
+            p = os.path.join(dir_path, head)
+            if not rest:
+                if os.path.lexists(p):
+                    self._glob(p, rest, rules, matches, seen)
+            elif os.path.isdir(p):
+                self._glob(p, rest, self._dir_rules(p, rules), matches, seen)
+
+
+def expand_globs(globs, base_dir: str = None, walker: Walker = None) -> list:
+    if walker is None:
+        walker = Walker()
+    files = []
+    for pattern in globs:
+        files.extend(walker.glob(pattern, base_dir))
+    return files
@@ -0,0 +1,201 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import time
+import typing
+
+import structlog
+
+from krules_dev.sane_utils.walker import Walker, IgnoreRules, DEFAULT_EXCLUDES, _translate
+
+log = structlog.get_logger()
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+class WatchRule:
+    """
+    Files (paths or globs, absolute) whose changes require running recipes,
+    after the before callables (eg: refreshing the code digest)
+    """
+
+    def __init__(self, paths: typing.Iterable[str], recipes: typing.Iterable[str] = (),
+                 before: typing.Iterable[typing.Callable] = ()):
+        self.paths = [os.path.normpath(p) for p in paths]
+        self.recipes = list(recipes)
+        self.before = list(before)
+        self._regexes = [re.compile(_translate(p) + "(?:/.*)?", re.S) for p in self.paths]
+
+    def roots(self) -> list[str]:
+        roots = []
+        for p in self.paths:
+            parts = p.split(os.sep)
+            magic = [i for i, part in enumerate(parts) if re.search(r"[*?\[]", part)]
+            root = os.sep.join(parts[:magic[0]]) if magic else p
+            roots.append(root or os.sep)
+        return roots
+
+    def matches(self, path: str) -> bool:
+        return any(regex.fullmatch(path) for regex in self._regexes)
+
+
+_rules: list[WatchRule] = []
+
+
+def add_watch(paths: typing.Iterable[str], recipes: typing.Iterable[str] = (),
+              before: typing.Iterable[typing.Callable] = (), base_dir: str = None) -> WatchRule:
+    """
+    Registers the recipes to run when any of paths (relative to base_dir) changes, see make_watch_recipe
+    """
+    if base_dir is not None:
+        paths = [os.path.join(base_dir, p) for p in paths]
+    rule = WatchRule(paths, recipes, before)
+    _rules.append(rule)
+    return rule
+
+
+def get_watch_rules() -> list[WatchRule]:
+    return list(_rules)
+
+
+class PollingWatcher:
+    """
+    Portable fallback: compares (mtime, size) snapshots of the watched trees
+    """
+
+    def __init__(self, roots: typing.Iterable[str], walker: Walker = None, interval: float = 0.5):
+        self.roots = list(roots)
+        self.walker = walker or Walker()
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self) -> dict:
+        snapshot = {}
+        for root in self.roots:
+            for f in self.walker.walk(root):
+                try:
+                    st = os.stat(f)
+                except FileNotFoundError:
+                    continue
+                snapshot[f] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def read(self, timeout: float = None) -> set:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._snapshot()
+            changed = {p for p in snapshot.keys() | self.snapshot.keys() if snapshot.get(p) != self.snapshot.get(p)}
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval if deadline is None else min(self.interval, max(0., deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Recursive watcher on linux inotify (through libc), new directories are watched as they appear
+    """
+
+    def __init__(self, roots: typing.Iterable[str], walker: Walker = None):
+        self.walker = walker or Walker()
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.wds: dict[int, str] = {}
+        self.excludes = IgnoreRules(os.sep, DEFAULT_EXCLUDES)
+        for root in roots:
+            if os.path.isdir(root):
+                self._add_tree(root)
+            elif os.path.exists(os.path.dirname(root)):
+                self._add(os.path.dirname(root))
+
+    def _add(self, path: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            log.debug("Cannot watch", path=path, errno=ctypes.get_errno())
+            return
+        self.wds[wd] = path
+
+    def _add_tree(self, root: str):
+        self._add(root)
+        for d in self.walker.walk(root, dirs=True):
+            if os.path.isdir(d):
+                self._add(d)
+
+    def read(self, timeout: float = None) -> set:
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size: offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Too many changes, some could be missed")
+                continue
+            base = self.wds.get(wd)
+            if base is None:
+                continue
+            path = os.path.join(base, os.fsdecode(name)) if name else base
+            if self.excludes.match(path, bool(mask & IN_ISDIR)):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(roots: typing.Iterable[str]):
+    roots = sorted(set(roots))
+    if sys.platform == "linux" and not int(os.environ.get("SANE_WATCH_POLL", "0")):
+        try:
+            return InotifyWatcher(roots)
+        except OSError as ex:
+            log.debug("inotify not available, polling", ex=str(ex))
+    return PollingWatcher(roots)
+
+
+def wait_changes(watcher, debounce: float = 0.3) -> set:
+    """
+    Blocks until something changes, then keeps collecting until nothing changes for debounce seconds
+    """
+    changed = set()
+    while not changed:
+        changed |= watcher.read(None)
+    while True:
+        more = watcher.read(debounce)
+        if not more:
+            return changed
+        changed |= more
@@ -0,0 +1,228 @@
+import base64
+import hashlib
+import json
+import re
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from krules_dev.sane_utils import registry
+
+
+def digest_of(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+class FakeRegistry:
+    """
+    In-process OCI distribution API (docker registry v2): manifests and blobs per repository,
+    anonymous, with basic auth or with bearer tokens issued by its /token endpoint
+    """
+
+    def __init__(self, auth: str = None, credentials: tuple[str, str] = ("user", "secret")):
+        self.auth = auth
+        self.credentials = credentials
+        self.manifests: dict[str, dict[str, tuple[str, bytes]]] = {}
+        self.blobs: dict[str, dict[str, bytes]] = {}
+        self.tokens: dict[str, set[tuple[str, str]]] = {}
+        self.token_requests: list[list[str]] = []
+        self.requests: list[tuple[str, str]] = []
+        # cross repository mounts answer 202 (a plain upload session) when disabled, as some registries do
+        self.mounts = True
+        # Docker-Content-Digest is optional in manifest responses
+        self.digest_header = True
+        self.uploads: dict[str, bytearray] = {}
+        self.patches: list[tuple[str, int]] = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), type("Handler", (_Handler,), {"registry": self}))
+        self.host = f"127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_blob(self, repository: str, data: bytes) -> str:
+        digest = digest_of(data)
+        self.blobs.setdefault(repository, {})[digest] = data
+        return digest
+
+    def add_manifest(self, repository: str, content: dict | bytes, tag: str = None,
+                     media_type: str = "application/vnd.oci.image.manifest.v1+json") -> str:
+        if isinstance(content, dict):
+            content = json.dumps(content).encode()
+        digest = digest_of(content)
+        manifests = self.manifests.setdefault(repository, {})
+        manifests[digest] = (media_type, content)
+        if tag is not None:
+            manifests[tag] = (media_type, content)
+        return digest
+
+    def add_image(self, repository: str, tag: str = None, layers: typing.Sequence[bytes] = (b"layer",),
+                  config: bytes = b'{"architecture": "amd64", "os": "linux"}') -> tuple[str, str]:
+        """
+        Pushes an image with its blobs, returns the manifest and the config digest
+        """
+        config_digest = self.add_blob(repository, config)
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {"mediaType": "application/vnd.oci.image.config.v1+json", "digest": config_digest,
+                       "size": len(config)},
+            "layers": [{"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip",
+                        "digest": self.add_blob(repository, layer), "size": len(layer)} for layer in layers],
+        }
+        return self.add_manifest(repository, manifest, tag), config_digest
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry: FakeRegistry
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: dict = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _authorized(self, required: set[tuple[str, str]]) -> bool:
+        reg = self.registry
+        header = self.headers.get("Authorization", "")
+        if reg.auth is None:
+            return True
+        if reg.auth == "basic":
+            if header == "Basic " + base64.b64encode(":".join(reg.credentials).encode()).decode():
+                return True
+            self._send(401, headers={"WWW-Authenticate": 'Basic realm="fake"'})
+            return False
+        granted = reg.tokens.get(header[len("Bearer "):], set()) if header.startswith("Bearer ") else set()
+        if required <= granted:
+            return True
+        scope = " ".join(f"repository:{repo}:{action}" for repo, action in sorted(required))
+        self._send(401, headers={
+            "WWW-Authenticate": f'Bearer realm="http://{reg.host}/token",service="fake",scope="{scope}"'})
+        return False
+
+    def _token(self, query: dict):
+        reg = self.registry
+        reg.token_requests.append(query.get("scope", []))
+        if self.headers.get("Authorization") != \
+                "Basic " + base64.b64encode(":".join(reg.credentials).encode()).decode():
+            self._send(401)
+            return
+        granted = set()
+        for scope in query.get("scope", []):
+            _, repo, actions = scope.split(":")
+            granted.update((repo, action) for action in actions.split(","))
+        token = f"token-{len(reg.tokens)}"
+        reg.tokens[token] = granted
+        self._send(200, json.dumps({"token": token}).encode(), {"Content-Type": "application/json"})
+
+    def _handle(self):
+        reg = self.registry
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        # the body is always consumed, so that the connection can be reused after a 401
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        reg.requests.append((self.command, self.path))
+        if url.path == "/token":
+            return self._token(query)
+        match = re.match(r"^/v2/(.+)/(manifests|blobs)/(.*)$", url.path)
+        if match is None:
+            return self._send(404)
+        repository, kind, reference = match.groups()
+        action = "pull" if self.command in ("GET", "HEAD") else "push"
+        required = {(repository, action)}
+        if "from" in query:
+            required.add((query["from"][0], "pull"))
+        if not self._authorized(required):
+            return
+        if kind == "manifests":
+            return self._manifest(repository, reference, body)
+        if reference.startswith("uploads/"):
+            return self._upload(repository, reference[len("uploads/"):], query, body)
+        return self._blob(repository, reference)
+
+    def _manifest(self, repository: str, reference: str, body: bytes):
+        manifests = self.registry.manifests.setdefault(repository, {})
+        if self.command == "PUT":
+            media_type = self.headers["Content-Type"]
+            digest = digest_of(body)
+            manifests[digest] = manifests[reference] = (media_type, body)
+            return self._send(201, headers=self._digest_header(body))
+        if reference not in manifests:
+            return self._send(404)
+        media_type, content = manifests[reference]
+        self._send(200, content, {"Content-Type": media_type, **self._digest_header(content)})
+
+    def _digest_header(self, content: bytes) -> dict:
+        return {"Docker-Content-Digest": digest_of(content)} if self.registry.digest_header else {}
+
+    def _blob(self, repository: str, reference: str):
+        blobs = self.registry.blobs.setdefault(repository, {})
+        if reference not in blobs:
+            return self._send(404)
+        self._send(200, blobs[reference], {"Docker-Content-Digest": reference})
+
+    def _upload(self, repository: str, session: str, query: dict, body: bytes):
+        reg = self.registry
+        blobs = reg.blobs.setdefault(repository, {})
+        if self.command == "POST":
+            if "mount" in query and reg.mounts:
+                digest, from_repository = query["mount"][0], query["from"][0]
+                if digest in reg.blobs.get(from_repository, {}):
+                    blobs[digest] = reg.blobs[from_repository][digest]
+                    return self._send(201, headers={"Location": f"/v2/{repository}/blobs/{digest}"})
+            session = str(len(reg.uploads))
+            reg.uploads[session] = bytearray()
+            return self._send(202, headers={"Location": f"/v2/{repository}/blobs/uploads/{session}"})
+        if session not in reg.uploads:
+            return self._send(404)
+        data = reg.uploads[session]
+        if self.command == "PATCH":
+            start = int(self.headers["Content-Range"].split("-")[0])
+            if start != len(data):
+                return self._send(416)
+            data += body
+            reg.patches.append((repository, len(body)))
+            return self._send(202, headers={"Location": f"/v2/{repository}/blobs/uploads/{session}"})
+        # PUT ?digest=, closing the session
+        data += body
+        digest = query["digest"][0]
+        if digest_of(bytes(data)) != digest:
+            return self._send(400)
+        blobs[digest] = bytes(reg.uploads.pop(session))
+        self._send(201, headers={"Location": f"/v2/{repository}/blobs/{digest}"})
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = _handle
+
+
+@pytest.fixture
+def fake_registry(monkeypatch, tmp_path):
+    """
+    Factory of fake registries, their clients are not shared with other tests.
+    The docker config (DOCKER_CONFIG) holds the credentials of every registry created
+    """
+    monkeypatch.setattr(registry, "_clients", {})
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path / "docker"))
+    (tmp_path / "docker").mkdir()
+    created = []
+
+    def _create(auth: str = None) -> FakeRegistry:
+        reg = FakeRegistry(auth)
+        created.append(reg)
+        auths = {r.host: {"auth": base64.b64encode(":".join(r.credentials).encode()).decode()} for r in created}
+        (tmp_path / "docker" / "config.json").write_text(json.dumps({"auths": auths}))
+        return reg
+
+    yield _create
+    for reg in created:
+        reg.close()
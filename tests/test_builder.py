@@ -0,0 +1,80 @@
+import pulumi
+import pytest
+
+from krules_dev.sane_utils.pulumi.components.builder import _ContentImageProvider
+
+
+@pytest.fixture
+def props(fake_registry):
+    target, shared = fake_registry(), fake_registry()
+    return target, shared, {
+        "image_name": f"{target.host}/app",
+        "content_tag": "code-1",
+        "shared_image": f"{shared.host}/app:code-1",
+        "context": "/nonexistent",
+        "dockerfile": "/nonexistent/Dockerfile",
+        "platform": "linux/amd64",
+        "args": {},
+        "inline_cache": False,
+        "source_date_epoch": None,
+    }
+
+
+def test_content_image_in_target(props):
+    target, _, props = props
+    digest, _ = target.add_image("app", "code-1")
+    outs = _ContentImageProvider().create(props).outs
+    assert outs["repo_digest"] == f"{target.host}/app@{digest}"
+    assert outs["built"] is False
+
+
+def test_content_image_from_shared(props):
+    target, shared, props = props
+    digest, _ = shared.add_image("app", "code-1")
+    outs = _ContentImageProvider().create(props).outs
+    assert outs["repo_digest"] == f"{target.host}/app@{digest}"
+    # copied with the same digest
+    assert target.manifests["app"]["code-1"] == shared.manifests["app"][digest]
+
+
+def test_content_image_diff(props):
+    target, _, props = props
+    provider = _ContentImageProvider()
+    # not in the registry (any more)
+    assert provider.diff("id", props, props).changes
+    target.add_image("app", "code-1")
+    assert not provider.diff("id", props, props).changes
+    assert provider.diff("id", props, {**props, "content_tag": "code-2"}).changes
+
+
+class _Mocks(pulumi.runtime.Mocks):
+    def __init__(self):
+        self.created = []
+
+    def new_resource(self, args):
+        self.created.append(args.typ)
+        return [f"{args.name}_id", {**args.inputs, "repo_digest": "registry/app@sha256:1"}]
+
+    def call(self, args):
+        return {}
+
+
+@pytest.mark.parametrize("content_tags", ["0", "1"])
+def test_sane_docker_image_resources(monkeypatch, tmp_path, content_tags):
+    monkeypatch.setenv("CONTENT_TAGS", content_tags)
+    (tmp_path / ".code.digest").write_text("abc")
+    (tmp_path / "Dockerfile").write_text("FROM python\n")
+    mocks = _Mocks()
+    pulumi.runtime.set_mocks(mocks, preview=True)
+    from krules_dev.sane_utils.pulumi.components.builder import SaneDockerImage
+
+    @pulumi.runtime.test
+    def _program():
+        image = SaneDockerImage("app", image_name="registry/app", context=str(tmp_path))
+        assert image.image is not None
+        return image.repo_digest
+
+    _program()
+    # registered whatever the registry holds, no lookup at program evaluation
+    assert mocks.created == ["sane:SaneDockerImage",
+                             "pulumi-python:dynamic:Resource" if content_tags == "1" else "docker:index/image:Image"]
@@ -0,0 +1,75 @@
+import pytest
+from structlog.testing import capture_logs
+
+from krules_dev.sane_utils.affected import write_manifest
+from krules_dev.sane_utils.cache import CacheSpec, LocalCache, ImageDigestCache, run_cached
+
+
+@pytest.fixture
+def local_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("SANE_REMOTE_CACHE", raising=False)
+    return LocalCache(str(tmp_path / "cache"))
+
+
+def _recipe(base_dir, runs: list):
+    def fn():
+        runs.append(1)
+        (base_dir / "out.txt").write_text((base_dir / "src.txt").read_text().upper())
+    return fn
+
+
+def test_run_cached(tmp_path, local_cache):
+    base_dir = tmp_path / "app"
+    base_dir.mkdir()
+    (base_dir / "src.txt").write_text("hello")
+    (base_dir / ".upstream.digest").write_text("abc\n")
+    spec = CacheSpec(inputs=["src.txt"], digests=[".upstream.digest"], outputs=["out.txt"], out_dir="out")
+    runs = []
+    run_cached("r", _recipe(base_dir, runs), spec, str(base_dir), local_cache)
+    (base_dir / "out.txt").unlink()
+    run_cached("r", _recipe(base_dir, runs), spec, str(base_dir), local_cache)
+    assert runs == [1]
+    assert (base_dir / "out.txt").read_text() == "HELLO"
+    # the input index is in the recipe out_dir
+    assert (base_dir / "out" / ".cache.index").exists()
+    assert not (base_dir / ".build").exists()
+    (base_dir / ".upstream.digest").write_text("abd\n")
+    run_cached("r", _recipe(base_dir, runs), spec, str(base_dir), local_cache)
+    assert runs == [1, 1]
+
+
+def test_run_cached_missing_digest(tmp_path, local_cache):
+    # clean checkout: the upstream recipe did not produce its digest yet
+    (tmp_path / "src.txt").write_text("hello")
+    spec = CacheSpec(inputs=["src.txt"], digests=[".upstream.digest"], outputs=["out.txt"])
+    assert spec.key("r", str(tmp_path)) is None
+    runs = []
+    run_cached("r", _recipe(tmp_path, runs), spec, str(tmp_path), local_cache)
+    run_cached("r", _recipe(tmp_path, runs), spec, str(tmp_path), local_cache)
+    assert runs == [1, 1]
+    assert not (tmp_path / "cache").exists()
+
+
+def test_image_digest_cache_key(tmp_path):
+    app_dir, lib_dir = tmp_path / "app", tmp_path / "lib"
+    app_dir.mkdir()
+    lib_dir.mkdir()
+    (app_dir / "main.py").write_text("print()")
+    (lib_dir / "lib.py").write_text("x = 1")
+    write_manifest(str(app_dir), ".build", [str(lib_dir)])
+    key_args = (str(app_dir), ".build", "registry", "amd64")
+    key = ImageDigestCache.key(*key_args)
+    assert key is not None and ImageDigestCache.key(*key_args) == key
+    (lib_dir / "lib.py").write_text("x = 2")
+    assert ImageDigestCache.key(*key_args) != key
+    key = ImageDigestCache.key(*key_args)
+    # the rendered Dockerfile, whatever it is rendered from
+    (app_dir / ".build" / "Dockerfile").write_text("FROM python")
+    assert ImageDigestCache.key(*key_args) != key
+
+
+def test_image_digest_cache_key_unknown_inputs(tmp_path):
+    # no manifest and no make.py to discover it from
+    with capture_logs() as logs:
+        assert ImageDigestCache.key(str(tmp_path), ".build", "registry", "amd64") is None
+    assert [e for e in logs if e["log_level"] == "warning"]
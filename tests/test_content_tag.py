@@ -0,0 +1,23 @@
+from krules_dev.sane_utils import get_content_tag
+
+
+def test_content_tag_inputs(tmp_path, monkeypatch):
+    digest_file, dockerfile = tmp_path / ".code.digest", tmp_path / "Dockerfile"
+    digest_file.write_text("abc")
+    dockerfile.write_text("FROM python\n")
+    assert get_content_tag(str(digest_file)) is None
+    monkeypatch.setenv("CONTENT_TAGS", "1")
+
+    def _tag(**kwargs):
+        return get_content_tag(str(digest_file), **{"dockerfile": str(dockerfile), **kwargs})
+
+    tag = _tag()
+    assert tag.startswith("code-")
+    # same platform, build args in any order
+    assert _tag(platform="linux/amd64") == tag
+    assert _tag(build_args={"A": 1, "B": "2"}) == _tag(build_args={"B": "2", "A": "1"})
+    assert len({tag, _tag(platform="arm64"), _tag(build_args={"A": "1"}), _tag(dockerfile=None)}) == 4
+    dockerfile.write_text("FROM python:slim\n")
+    assert _tag() != tag
+    digest_file.write_text("")
+    assert _tag() is None
@@ -0,0 +1,106 @@
+import io
+import os
+import tarfile
+
+from krules_dev.sane_utils.context import BuildContext, normalize_context, sync_tree
+
+
+def _write(path, content="x"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_build_context_artifacts(tmp_path):
+    src, out_dir = tmp_path / "app", tmp_path / ".build"
+    _write(src / "main.py")
+    _write(out_dir / "Dockerfile")
+    _write(out_dir / "requirements.merged.txt")
+    _write(out_dir / "conf" / "settings.yaml")
+    # bookkeeping, stale copy of an entry and resources rendered for something else
+    _write(out_dir / ".render.ledger")
+    _write(out_dir / ".jinja-cache" / "tmpl.cache")
+    _write(out_dir / "app" / "stale.py")
+    _write(out_dir / "k8s" / "dev" / "deployment.yaml")
+    context = BuildContext(artifacts_dir=str(out_dir), exclude=[str(out_dir / "k8s" / "dev"), str(out_dir)])
+    context.add(str(src), "app")
+    assert [arcname for _, arcname in context.members()] == [
+        "Dockerfile", "app/main.py", "conf/settings.yaml", "requirements.merged.txt",
+    ]
+    tar = tarfile.open(fileobj=io.BytesIO(b"".join(context.iter_tar(mtime=0))))
+    assert [m.name for m in tar.getmembers()] == [arcname for _, arcname in context.members()]
+
+
+def test_normalize_context(tmp_path):
+    src, out_dir = tmp_path / "app", tmp_path / ".build"
+    _write(src / "pkg" / "main.py")
+    # the copy of src, as the copy recipes leave it
+    _write(out_dir / "app" / "pkg" / "main.py")
+    _write(out_dir / "app" / "pkg" / "__pycache__" / "main.cpython-311.pyc")
+    _write(out_dir / "Dockerfile")
+    _write(out_dir / ".build.success")
+    _write(out_dir / "k8s" / "dev" / "deployment.yaml")
+    (out_dir / "Dockerfile").chmod(0o600)
+    context = BuildContext(artifacts_dir=str(out_dir), exclude=[str(out_dir / "k8s" / "dev")])
+    context.add(str(src), "app")
+    assert normalize_context(context, str(out_dir), 315532800) == 5
+    for path in ["app", "app/pkg", "app/pkg/main.py", "Dockerfile"]:
+        assert os.lstat(out_dir / path).st_mtime == 315532800
+    assert (out_dir / "Dockerfile").stat().st_mode & 0o777 == 0o644
+    assert not (out_dir / "app" / "pkg" / "__pycache__").exists()
+    # bookkeeping and resources rendered for something else keep their mtimes
+    for path in [".build.success", "k8s", "k8s/dev/deployment.yaml"]:
+        assert os.lstat(out_dir / path).st_mtime != 315532800
+    assert normalize_context(context, str(out_dir), 315532800) == 0
+
+
+def test_sync_tree(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _write(src / "a.py", "a")
+    _write(src / "pkg" / "b.py", "b")
+    _write(src / "__pycache__" / "a.cpython-311.pyc")
+    assert sync_tree(str(src), str(dst), link="copy") == \
+        {"unchanged": 0, "copy": 2, "reflink": 0, "hardlink": 0, "deleted": 0}
+    assert (dst / "pkg" / "b.py").read_text() == "b"
+    assert not (dst / "__pycache__").exists()
+    # copies keep the source mtime, unchanged files are left alone
+    assert os.stat(dst / "a.py").st_mtime_ns == os.stat(src / "a.py").st_mtime_ns
+    inode = os.stat(dst / "a.py").st_ino
+    _write(src / "pkg" / "b.py", "bb")
+    (src / "a.py").unlink()
+    _write(src / "c.py", "c")
+    stats = sync_tree(str(src), str(dst), link="copy")
+    assert (stats["unchanged"], stats["copy"], stats["deleted"]) == (0, 2, 1)
+    assert sorted(str(p.relative_to(dst)) for p in dst.rglob("*")) == ["c.py", "pkg", "pkg/b.py"]
+    assert (dst / "pkg" / "b.py").read_text() == "bb"
+    assert sync_tree(str(src), str(dst), link="copy")["unchanged"] == 2
+    assert inode != os.stat(dst / "c.py").st_ino
+
+
+def test_sync_tree_replaces_kinds(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _write(src / "conf" / "a.yaml")
+    _write(src / "data")
+    # a file where a directory is wanted and the other way round
+    _write(dst / "conf")
+    _write(dst / "data" / "stale.csv")
+    sync_tree(str(src), str(dst), link="copy")
+    assert (dst / "conf" / "a.yaml").is_file()
+    assert (dst / "data").is_file()
+
+
+def test_sync_tree_hardlink_and_mtime(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _write(src / "a.py")
+    (src / "a.py").chmod(0o600)
+    assert sync_tree(str(src), str(dst), link="hardlink")["hardlink"] == 1
+    assert os.stat(dst / "a.py").st_ino == os.stat(src / "a.py").st_ino
+    # normalizing hardlinks would touch the sources: copied instead
+    dst = tmp_path / "dst2"
+    assert sync_tree(str(src), str(dst), link="hardlink", mtime=315532800)["hardlink"] == 0
+    assert os.stat(dst / "a.py").st_mtime == 315532800
+    assert os.stat(dst / "a.py").st_mode & 0o777 == 0o644
+    assert os.stat(src / "a.py").st_mode & 0o777 == 0o600
+    assert sync_tree(str(src), str(dst), mtime=315532800)["unchanged"] == 1
+    _write(src / "a.py", "changed")
+    assert sync_tree(str(src), str(dst), mtime=315532800)["unchanged"] == 0
+    assert (dst / "a.py").read_text() == "changed"
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import krules_dev
+
+# each make.py runs in its own process: sane keeps the recipes in a global state
+ENV = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(krules_dev.__file__)))}
+
+MAKE_FILE = """
+import time
+from krules_dev import sane_utils
+from krules_dev.sane_utils import recipe
+
+
+def _run(name, seconds=0.0, fail=False):
+    with open("events", "a") as f:
+        f.write(f"start {name} {time.monotonic()}\\n")
+    time.sleep(seconds)
+    if fail:
+        raise RuntimeError(name)
+    with open("events", "a") as f:
+        f.write(f"end {name} {time.monotonic()}\\n")
+
+
+@recipe()
+def a():
+    _run("a", 0.5, fail={fail})
+
+
+@recipe()
+def b():
+    _run("b", 0.5)
+
+
+@recipe(conditions=[lambda: False])
+def skipped():
+    _run("skipped")
+
+
+@recipe(recipe_deps=["a", "b", "skipped"])
+def c():
+    _run("c")
+
+
+sane_utils.sane_run("c")
+"""
+
+
+def _make(tmp_path, jobs: int, fail: bool = False) -> tuple[subprocess.CompletedProcess, dict]:
+    (tmp_path / "make.py").write_text(textwrap.dedent(MAKE_FILE.replace("{fail}", str(fail))))
+    result = subprocess.run([sys.executable, "make.py"], cwd=tmp_path, capture_output=True, text=True,
+                            env={**ENV, "SANE_JOBS": str(jobs)})
+    events = {}
+    if (tmp_path / "events").exists():
+        for line in (tmp_path / "events").read_text().splitlines():
+            kind, name, t = line.split()
+            events[(kind, name)] = float(t)
+    return result, events
+
+
+def test_recipes_run_concurrently(tmp_path):
+    result, events = _make(tmp_path, jobs=4)
+    assert result.returncode == 0, result.stderr
+    # independent recipes overlap, dependents start once all their active dependencies are done
+    assert events[("start", "b")] < events[("end", "a")] and events[("start", "a")] < events[("end", "b")]
+    assert events[("start", "c")] >= max(events[("end", "a")], events[("end", "b")])
+    assert ("start", "skipped") not in events
+
+
+def test_recipes_run_sequentially(tmp_path):
+    result, events = _make(tmp_path, jobs=1)
+    assert result.returncode == 0, result.stderr
+    assert sorted(events, key=events.get) == [("start", "a"), ("end", "a"), ("start", "b"), ("end", "b"),
+                                              ("start", "c"), ("end", "c")]
+
+
+def test_failed_recipe_stops_dependents(tmp_path):
+    result, events = _make(tmp_path, jobs=4, fail=True)
+    assert result.returncode != 0
+    assert "RuntimeError: a" in result.stderr
+    # already running recipes complete, dependents never start
+    assert ("end", "b") in events
+    assert ("start", "c") not in events
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import subprocess
+
+from krules_dev.sane_utils.hashing import FileDigestIndex, GitIndexFingerprint, file_digest, get_fingerprint
+
+
+def _set_mtime(path, mtime_ns: int):
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_file_digest_index(tmp_path):
+    src = tmp_path / "a.txt"
+    src.write_text("one")
+    index_file = str(tmp_path / "index.json")
+    _set_mtime(src, 10 ** 18)
+    index = FileDigestIndex(index_file)
+    assert index.digest(str(src)) == hashlib.md5(b"one").hexdigest()
+    index.save()
+    _set_mtime(index_file, 2 * 10 ** 18)
+    index = FileDigestIndex(index_file)
+    assert index.digest(str(src)) == hashlib.md5(b"one").hexdigest()
+    assert (index.hits, index.misses) == (1, 0)
+    # same size and mtime, replaced by another inode
+    (tmp_path / "b.txt").write_text("two")
+    _set_mtime(tmp_path / "b.txt", 10 ** 18)
+    os.replace(tmp_path / "b.txt", src)
+    assert index.digest(str(src)) == hashlib.md5(b"two").hexdigest()
+    assert (index.hits, index.misses) == (1, 1)
+
+
+def test_file_digest_index_racy(tmp_path):
+    src = tmp_path / "a.txt"
+    src.write_text("one")
+    mtime_ns = os.stat(src).st_mtime_ns
+    index_file = str(tmp_path / "index.json")
+    index = FileDigestIndex(index_file)
+    index.digest(str(src))
+    index.save()
+    # the index written within the mtime granularity src was modified in, then src modified again:
+    # same size, mtime and inode, the entry cannot be trusted
+    _set_mtime(index_file, mtime_ns)
+    src.write_text("two")
+    _set_mtime(src, mtime_ns)
+    index = FileDigestIndex(index_file)
+    assert index.digest(str(src)) == hashlib.md5(b"two").hexdigest()
+    assert (index.hits, index.misses, index.racy) == (0, 1, 1)
+    # saved again even if no entry changed, so that the index gets newer than them
+    index.save()
+    assert os.stat(index_file).st_mtime_ns != mtime_ns
+    index = FileDigestIndex(index_file)
+    assert index.digest(str(src)) == hashlib.md5(b"two").hexdigest()
+    assert (index.hits, index.racy) == (1, 0)
+
+
+def _git(cwd, *args):
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                   cwd=cwd, check=True, capture_output=True)
+
+
+def test_git_index_fingerprint(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    _git(repo, "init", "-q")
+    for name, content in [("tracked.txt", "tracked"), ("modified.txt", "before")]:
+        (repo / name).write_text(content)
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "init")
+    (repo / "modified.txt").write_text("after")
+    (repo / "untracked.txt").write_text("untracked")
+    fingerprint = get_fingerprint(str(tmp_path / "index.json"), base_dir=str(repo))
+    assert isinstance(fingerprint, GitIndexFingerprint)
+    paths = [str(repo / name) for name in ("tracked.txt", "modified.txt", "untracked.txt")]
+    # blob ids, from the git index or hashed from disk alike
+    assert fingerprint.digest_many(paths) == [file_digest(p, "git") for p in paths]
+    assert fingerprint.index.misses == 2
+    assert str(repo / "tracked.txt") in fingerprint.blobs
+
+
+def test_git_index_fingerprint_conversions(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    _git(repo, "init", "-q")
+    (repo / ".gitattributes").write_text("*.txt text eol=crlf\n")
+    (repo / "a.txt").write_text("a\n")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "init")
+    fingerprint = GitIndexFingerprint(str(repo), FileDigestIndex(str(tmp_path / "index.json"), algorithm="git"))
+    # the bytes on disk are hashed, not the normalized blobs
+    assert fingerprint.blobs == {}
+    assert fingerprint.digest(str(repo / "a.txt")) == file_digest(str(repo / "a.txt"), "git")
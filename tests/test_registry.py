@@ -0,0 +1,209 @@
+import functools
+import json
+import os
+
+import pytest
+
+from krules_dev.sane_utils.registry import RegistryClient, RegistryError, find_pushed_image, parse_push_digest, \
+    copy_image, find_image, get_base_images
+from tests.conftest import digest_of
+
+INDEX_TYPE = "application/vnd.oci.image.index.v1+json"
+
+
+def test_bearer_token_auth(fake_registry):
+    reg = fake_registry("bearer")
+    digest, _ = reg.add_image("team/app", "1.0")
+    client = RegistryClient(reg.host)
+    assert client.get_manifest("team/app", "1.0")[0] == digest
+    assert reg.token_requests == [["repository:team/app:pull"]]
+    # the token is reused for the same scope
+    assert client.get_manifest("team/app", digest)[0] == digest
+    assert len(reg.token_requests) == 1
+    assert client.get_manifest("team/app", "2.0") is None
+
+
+def test_bearer_token_refused(fake_registry, tmp_path):
+    reg = fake_registry("bearer")
+    reg.add_image("team/app", "1.0")
+    # no credentials for the token endpoint
+    (tmp_path / "docker" / "config.json").write_text("{}")
+    with pytest.raises(RegistryError, match="401"):
+        RegistryClient(reg.host).get_manifest("team/app", "1.0")
+
+
+def test_basic_auth(fake_registry):
+    reg = fake_registry("basic")
+    digest, _ = reg.add_image("app", "latest")
+    assert RegistryClient(reg.host).get_manifest("app", "latest")[0] == digest
+    assert reg.token_requests == []
+
+
+def test_get_image_digests(fake_registry):
+    reg = fake_registry()
+    digest, config_digest = reg.add_image("app", "manifest")
+    assert RegistryClient(reg.host).get_image_digests("app", "manifest") == {
+        "digest": digest, "platform_digest": digest, "config_digest": config_digest,
+    }
+    arm_digest, _ = reg.add_image("app", config=b'{"architecture": "arm64", "os": "linux"}')
+    index = {
+        "schemaVersion": 2,
+        "mediaType": INDEX_TYPE,
+        "manifests": [
+            {"digest": arm_digest, "platform": {"os": "linux", "architecture": "arm64"}},
+            {"digest": digest, "platform": {"os": "linux", "architecture": "amd64"}},
+        ],
+    }
+    index_digest = reg.add_manifest("app", index, "index", INDEX_TYPE)
+    client = RegistryClient(reg.host)
+    assert client.get_image_digests("app", "index", "amd64") == {
+        "digest": index_digest, "platform_digest": digest, "config_digest": config_digest,
+    }
+    assert client.get_image_digests("app", "index", "linux/arm64")["platform_digest"] == arm_digest
+    assert client.get_image_digests("app", "index", "linux/s390x") == {
+        "digest": index_digest, "platform_digest": None, "config_digest": None,
+    }
+    assert client.get_image_digests("app", "missing") is None
+
+
+def test_find_pushed_image(fake_registry):
+    reg = fake_registry("bearer")
+    digest, config_digest = reg.add_image("team/app", "1.0")
+    image = f"{reg.host}/team/app:1.0"
+    # image id is the config digest, or the manifest digest with the containerd image store
+    assert find_pushed_image(image, config_digest) == digest
+    assert find_pushed_image(image, digest) == digest
+    assert find_pushed_image(image, "sha256:" + "0" * 64) is None
+    assert find_pushed_image(f"{reg.host}/team/app:2.0", config_digest) is None
+
+
+def test_parse_push_digest():
+    digest = "sha256:" + "a" * 64
+    output = "\n".join([
+        "The push refers to repository [europe-docker.pkg.dev/project/repo/app]",
+        "5f70bf18a086: Layer already exists",
+        f"latest: digest: sha256:{'b' * 64} size: 528",
+        f"1.0: digest: {digest} size: 1570",
+    ])
+    assert parse_push_digest(output) == digest
+    assert parse_push_digest("5f70bf18a086: Pushed") is None
+
+
+def _image(reg, repository: str, layers=(b"layer",), arch: str = "amd64", indent: int = None) -> str:
+    config = json.dumps({"architecture": arch, "os": "linux"}).encode()
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+        "config": {"mediaType": "application/vnd.oci.image.config.v1+json",
+                   "digest": reg.add_blob(repository, config), "size": len(config)},
+        "layers": [{"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip",
+                    "digest": reg.add_blob(repository, layer), "size": len(layer)} for layer in layers],
+    }
+    return json.dumps(manifest, indent=indent).encode()
+
+
+def test_copy_image_between_registries(fake_registry):
+    src, dst = fake_registry("bearer"), fake_registry("bearer")
+    # the digest is computed over the exact bytes, whatever their formatting
+    content = _image(src, "dev/app", layers=(b"one", b"two"), indent=3)
+    digest = src.add_manifest("dev/app", content, "1.0")
+    assert copy_image(f"{src.host}/dev/app:1.0", f"{dst.host}/prod/app:1.0") == digest
+    assert dst.manifests["prod/app"]["1.0"][1] == content
+    assert dst.manifests["prod/app"][digest][1] == content
+    assert dst.blobs["prod/app"] == src.blobs["dev/app"]
+    assert find_image(f"{dst.host}/prod/app:1.0") == f"{dst.host}/prod/app@{digest}"
+    # nothing moves when the tag already holds the image
+    requests = len(dst.requests)
+    assert copy_image(f"{src.host}/dev/app:1.0", f"{dst.host}/prod/app:1.0") == digest
+    assert [r for r in dst.requests[requests:] if r[0] != "GET"] == []
+
+
+def test_copy_image_without_digest_header(fake_registry):
+    src, dst = fake_registry(), fake_registry()
+    src.digest_header = dst.digest_header = False
+    content = _image(src, "app", indent=2)
+    digest = src.add_manifest("app", content, "1.0")
+    assert find_image(f"{src.host}/app:1.0") == f"{src.host}/app@{digest}"
+    assert copy_image(f"{src.host}/app:1.0", f"{dst.host}/app:1.0") == digest
+    assert dst.manifests["app"][digest][1] == content
+
+
+def test_copy_image_mount(fake_registry):
+    reg = fake_registry("bearer")
+    digest = reg.add_manifest("dev/app", _image(reg, "dev/app"), "1.0")
+    assert copy_image(f"{reg.host}/dev/app:1.0", f"{reg.host}/prod/app:1.0") == digest
+    assert reg.blobs["prod/app"] == reg.blobs["dev/app"]
+    assert reg.patches == []
+    assert ["repository:prod/app:pull,push", "repository:dev/app:pull"] in reg.token_requests
+
+
+def test_copy_image_mount_fallback(fake_registry):
+    reg = fake_registry()
+    reg.mounts = False
+    digest = reg.add_manifest("dev/app", _image(reg, "dev/app"), "1.0")
+    assert copy_image(f"{reg.host}/dev/app:1.0", f"{reg.host}/prod/app") == digest
+    # uploaded within the session opened by the refused mount
+    assert reg.blobs["prod/app"] == reg.blobs["dev/app"]
+    assert len([r for r in reg.requests if r[0] == "POST"]) == 2
+    assert len(reg.patches) == 2
+    # untagged destination, by digest only
+    assert list(reg.manifests["prod/app"]) == [digest]
+
+
+def test_copy_image_chunked(fake_registry, monkeypatch):
+    monkeypatch.setattr(RegistryClient, "read_blob",
+                        functools.partialmethod(RegistryClient.read_blob, chunk_size=1024 * 1024))
+    src, dst = fake_registry(), fake_registry()
+    layer = os.urandom(1024 * 1024 * 5 // 2)
+    digest = src.add_manifest("app", _image(src, "app", layers=(layer,)), "1.0")
+    assert copy_image(f"{src.host}/app:1.0", f"{dst.host}/app:1.0") == digest
+    assert dst.blobs["app"][digest_of(layer)] == layer
+    assert [size for _, size in dst.patches if size > 100] == [1024 * 1024, 1024 * 1024, 1024 * 1024 // 2]
+
+
+def test_upload_blob_chunks(fake_registry):
+    reg = fake_registry("bearer")
+    client = RegistryClient(reg.host)
+    client.upload_blob("app", digest_of(b"abcde"), [b"ab", b"", b"cd", b"e"])
+    assert reg.blobs["app"][digest_of(b"abcde")] == b"abcde"
+    assert reg.patches == [("app", 2), ("app", 2), ("app", 1)]
+    assert client.blob_exists("app", digest_of(b"abcde"))
+    with pytest.raises(RegistryError):
+        client.upload_blob("app", digest_of(b"other"), [b"abcde"])
+
+
+def test_copy_image_index(fake_registry):
+    src, dst = fake_registry(), fake_registry("basic")
+    children = [(src.add_manifest("app", _image(src, "app", layers=(arch.encode(),), arch=arch)), arch)
+                for arch in ("amd64", "arm64")]
+    index = json.dumps({
+        "schemaVersion": 2,
+        "mediaType": INDEX_TYPE,
+        "manifests": [{"mediaType": "application/vnd.oci.image.manifest.v1+json", "digest": d,
+                       "platform": {"os": "linux", "architecture": arch}} for d, arch in children],
+    }).encode()
+    digest = src.add_manifest("app", index, "1.0", INDEX_TYPE)
+    assert copy_image(f"{src.host}/app:1.0", f"{dst.host}/app:1.0") == digest
+    assert dst.manifests["app"]["1.0"] == (INDEX_TYPE, index)
+    for child, _ in children:
+        assert dst.manifests["app"][child] == src.manifests["app"][child]
+    assert dst.blobs["app"] == src.blobs["app"]
+    assert RegistryClient(dst.host).get_image_digests("app", "1.0", "arm64")["platform_digest"] == children[1][0]
+
+
+def test_get_base_images(fake_registry, tmp_path):
+    reg = fake_registry()
+    digest, _ = reg.add_image("base/python", "3.11")
+    pinned = f"{reg.host}/base/other@sha256:{'1' * 64}"
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text("\n".join([
+        f"FROM --platform=$BUILDPLATFORM {reg.host}/base/python:3.11 AS builder",
+        "FROM builder AS test",
+        f"from {pinned}",
+        "FROM ${BASE_IMAGE}",
+        "FROM scratch",
+        f"FROM {reg.host}/base/missing:1",
+    ]))
+    assert get_base_images(str(dockerfile)) == [
+        f"{reg.host}/base/python@{digest}", pinned, "${BASE_IMAGE}", f"{reg.host}/base/missing:1",
+    ]
@@ -0,0 +1,105 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from krules_dev.sane_utils.remote_cache import RemoteCache, DirectoryRemoteCache, HttpRemoteCache, \
+    FailSafeRemoteCache, get_remote_cache, image_entry_name
+
+
+class _StoreHandler(BaseHTTPRequestHandler):
+    # GET/HEAD/PUT blob store, like nginx with webdav
+    store: dict
+
+    def do_GET(self):
+        data = self.store.get(self.path)
+        self.send_response(200 if data is not None else 404)
+        self.send_header("Content-Length", str(len(data or b"")))
+        self.end_headers()
+        if data is not None and self.command == "GET":
+            self.wfile.write(data)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self.store[self.path] = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_store():
+    handler = type("Handler", (_StoreHandler,), {"store": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/cache", handler.store
+    server.shutdown()
+    server.server_close()
+
+
+def _roundtrip(cache: RemoteCache):
+    assert cache.get("images/a.json") is None
+    assert not cache.exists("images/a.json")
+    cache.put_json("images/a.json", {"digest": "sha256:1"})
+    assert cache.exists("images/a.json")
+    assert cache.get_json("images/a.json") == {"digest": "sha256:1"}
+    cache.put("images/a.json", b"not json")
+    assert cache.get_json("images/a.json") is None
+
+
+def test_directory_remote_cache(tmp_path):
+    _roundtrip(DirectoryRemoteCache(str(tmp_path)))
+    assert (tmp_path / "images" / "a.json").read_bytes() == b"not json"
+
+
+def test_http_remote_cache(http_store):
+    url, store = http_store
+    _roundtrip(HttpRemoteCache(url))
+    assert store["/cache/images/a.json"] == b"not json"
+
+
+def test_get_remote_cache(tmp_path, http_store, monkeypatch):
+    monkeypatch.delenv("SANE_REMOTE_CACHE", raising=False)
+    assert get_remote_cache() is None
+    monkeypatch.setenv("SANE_REMOTE_CACHE", f"file://{tmp_path}")
+    assert isinstance(get_remote_cache().cache, DirectoryRemoteCache)
+    assert isinstance(get_remote_cache(http_store[0]).cache, HttpRemoteCache)
+    with pytest.raises(ValueError):
+        get_remote_cache("ftp://example.com/cache")
+
+
+def test_unreachable_cache_is_a_miss():
+    with ThreadingHTTPServer(("127.0.0.1", 0), _StoreHandler) as server:
+        port = server.server_port
+    # nothing listens on port anymore
+    cache = FailSafeRemoteCache(HttpRemoteCache(f"http://127.0.0.1:{port}"))
+    cache.cache.http.connection_pool_kw["retries"] = 0
+    assert cache.get_json("images/a.json") is None
+    assert not cache.exists("images/a.json")
+    cache.put_json("images/a.json", {})
+
+
+def test_remote_cache_is_abstract():
+    with pytest.raises(TypeError):
+        RemoteCache()
+
+
+def test_image_entry_name():
+    name = image_entry_name("reg/app", "abc", "amd64", {"A": "1", "B": "2"})
+    assert name == image_entry_name("reg/app", "abc", "amd64", {"B": "2", "A": "1"})
+    assert name != image_entry_name("reg/app", "abc", "arm64", {"A": "1", "B": "2"})
+    assert name != image_entry_name("reg/app", "abc", "amd64", {"A": "1"})
+    assert name != image_entry_name("reg/app", "abd", "amd64", {"A": "1", "B": "2"})
+
+
+def test_image_entry_name_build_inputs(tmp_path):
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text("FROM python:3.11\n")
+    name = image_entry_name("reg/app", "abc", "amd64", {}, str(dockerfile), ["python@sha256:1"])
+    assert name != image_entry_name("reg/app", "abc", "amd64", {}, str(dockerfile), ["python@sha256:2"])
+    dockerfile.write_text("FROM python:3.12\n")
+    assert name != image_entry_name("reg/app", "abc", "amd64", {}, str(dockerfile), ["python@sha256:1"])
@@ -0,0 +1,19 @@
+import pytest
+
+from krules_dev.sane_utils import get_source_date_epoch, get_reproducible_build_args
+
+
+@pytest.mark.parametrize("value", ["", "0", "false", "No"])
+def test_reproducible_build_off(monkeypatch, value):
+    monkeypatch.setenv("REPRODUCIBLE_BUILD", value)
+    assert get_source_date_epoch() is None
+    assert get_reproducible_build_args() == []
+
+
+@pytest.mark.parametrize("value", ["1", "true", "yes"])
+def test_reproducible_build_on(monkeypatch, value):
+    monkeypatch.setenv("REPRODUCIBLE_BUILD", value)
+    assert get_source_date_epoch() == 315532800
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    assert get_source_date_epoch() == 1700000000
+    assert "SOURCE_DATE_EPOCH=1700000000" in get_reproducible_build_args()
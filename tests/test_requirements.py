@@ -0,0 +1,41 @@
+import hashlib
+
+from krules_dev.sane_utils.requirements import merge_requirements, write_merged_requirements, \
+    MergedRequirementsDigest
+
+
+def test_merge_requirements(tmp_path):
+    (tmp_path / "base.txt").write_text("Requests>=2.0\n--index-url https://pypi.example/simple\n")
+    (tmp_path / "app.txt").write_text("\n".join([
+        "-r base.txt",
+        "# comment",
+        "pyyaml==6.0  # inline comment",
+        "-e ./lib",
+        "./local.whl",
+        "--no-binary :all:",
+        "structlog \\",
+        "  ==24.1",
+        "requests>=2.0",
+    ]))
+    (tmp_path / "lib.txt").write_text("requests<3\n")
+    assert merge_requirements([str(tmp_path / "app.txt"), str(tmp_path / "lib.txt"),
+                               str(tmp_path / "missing.txt")]) == "".join(f"{line}\n" for line in [
+        "--index-url https://pypi.example/simple",
+        "pyyaml==6.0",
+        "requests<3",
+        "requests>=2.0",
+        "structlog ==24.1",
+    ])
+
+
+def test_merged_requirements_digest(tmp_path):
+    (tmp_path / "requirements.txt").write_text("requests\n")
+    out_dir = tmp_path / "out"
+    digest = MergedRequirementsDigest(str(out_dir))
+    assert str(digest) == ""
+    written = write_merged_requirements(str(out_dir), [str(tmp_path / "requirements.txt")])
+    assert str(digest) == written
+    # follows the merged file, whenever the context holding it was computed
+    (tmp_path / "requirements.txt").write_text("requests\npyyaml\n")
+    write_merged_requirements(str(out_dir), [str(tmp_path / "requirements.txt")])
+    assert str(digest) == hashlib.sha256(b"pyyaml\nrequests\n").hexdigest()
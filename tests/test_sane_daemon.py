@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+import pytest
+
+import krules_dev
+from krules_dev.sane_daemon import run_in_daemon
+
+# krules_dev importable from the daemon and the client, whatever their cwd
+ENV = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(krules_dev.__file__)))}
+
+
+@pytest.fixture
+def daemon():
+    # unix socket paths are short, tmp_path may be too long
+    socket_dir = tempfile.mkdtemp(prefix="sane-")
+    socket_path = os.path.join(socket_dir, "daemon", "daemon.sock")
+    proc = subprocess.Popen([sys.executable, "-m", "krules_dev.sane_daemon", "serve", socket_path],
+                            cwd=socket_dir, env=ENV, stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    else:
+        proc.kill()
+        pytest.fail("the daemon did not start")
+    yield socket_path
+    proc.terminate()
+    proc.wait()
+
+
+def _run(socket_path: str, make_file, *argv) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "-m", "krules_dev.sane_daemon", "run", str(make_file), *argv],
+                          env={**ENV, "SANE_DAEMON_SOCKET": socket_path}, cwd=make_file.parent,
+                          capture_output=True, text=True)
+
+
+def test_make_file_in_daemon(daemon, tmp_path):
+    make_file = tmp_path / "make.py"
+    make_file.write_text(textwrap.dedent("""
+        from krules_dev import sane_utils
+        import krules_dev.sane_utils
+        from krules_dev.sane_utils import recipe
+
+        # the daemon preloads sane_utils, make.py gets a fresh one whatever the import style
+        print("root_dir", sane_utils.root_dir, sane_utils is krules_dev.sane_utils)
+
+        @recipe()
+        def c():
+            print("c done")
+
+        sane_utils.sane_run("c")
+    """))
+    for _ in range(2):
+        result = _run(daemon, make_file, "c")
+        assert result.returncode == 0, result.stderr
+        assert f"root_dir {tmp_path} True" in result.stdout
+        assert "c done" in result.stdout
+
+
+def test_daemon_child_killed(daemon, tmp_path):
+    make_file = tmp_path / "make.py"
+    make_file.write_text(textwrap.dedent("""
+        import os, signal
+        with open("runs", "a") as f:
+            f.write("run\\n")
+        os.kill(os.getpid(), signal.SIGKILL)
+    """))
+    result = _run(daemon, make_file)
+    assert result.returncode != 0
+    # not run again locally
+    assert (tmp_path / "runs").read_text() == "run\n"
+
+
+def test_no_daemon(tmp_path):
+    assert run_in_daemon(str(tmp_path / "make.py"), [], socket_path=str(tmp_path / "missing.sock")) is None
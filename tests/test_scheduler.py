@@ -0,0 +1,86 @@
+import json
+import textwrap
+
+import pytest
+
+from krules_dev.sane_utils.scheduler import BuildFailed, ImageBuildSpec, build_images
+
+MAKE_FILE = """
+import os
+import sys
+
+with open(os.environ["BUILD_LOG"], "a") as f:
+    f.write(f"{os.path.basename(os.getcwd())} {sys.argv[1]} {os.environ.get('BASE_IMAGE', '')}\\n")
+if os.environ.get("FAIL"):
+    sys.exit(3)
+os.makedirs(".build", exist_ok=True)
+with open(".build/.digest", "w") as f:
+    f.write(f"registry/{os.path.basename(os.getcwd())}@sha256:1\\n")
+"""
+
+
+@pytest.fixture
+def make_image(tmp_path, monkeypatch):
+    monkeypatch.setenv("KRULES_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("BUILD_LOG", str(tmp_path / "build.log"))
+
+    def _make_image(name: str, duration: float = None, **kwargs) -> ImageBuildSpec:
+        build_dir = tmp_path / name
+        build_dir.mkdir()
+        (build_dir / "make.py").write_text(textwrap.dedent(MAKE_FILE))
+        if duration is not None:
+            times_file = tmp_path / "cache" / "build_times.json"
+            times_file.parent.mkdir(exist_ok=True)
+            times = json.loads(times_file.read_text()) if times_file.exists() else {}
+            times_file.write_text(json.dumps({**times, str(build_dir): duration}))
+        return ImageBuildSpec(name, str(build_dir), **kwargs)
+
+    return _make_image
+
+
+def _log(tmp_path) -> list[list[str]]:
+    return [line.split(" ") for line in (tmp_path / "build.log").read_text().splitlines()]
+
+
+def test_build_images_critical_path(tmp_path, make_image):
+    specs = [
+        make_image("quick", 1),
+        make_image("base", 10, env_var="BASE_IMAGE"),
+        make_image("other", 2),
+        make_image("app", 10, depends_on=["base"]),
+    ]
+    built = []
+    digests = build_images(specs, jobs=1, on_built=lambda spec, digest: built.append((spec.name, digest)))
+    assert digests == {name: f"registry/{name}@sha256:1" for name in ("quick", "base", "other", "app")}
+    # base and app are on the longest path, the dependent gets the base digest
+    assert _log(tmp_path) == [
+        ["base", "push", ""],
+        ["app", "push", "registry/base@sha256:1"],
+        ["other", "push", ""],
+        ["quick", "push", ""],
+    ]
+    assert [name for name, _ in built] == ["base", "app", "other", "quick"]
+    # durations are recorded for the next builds
+    times = json.loads((tmp_path / "cache" / "build_times.json").read_text())
+    assert times[specs[0].build_dir] < 1
+
+
+def test_build_images_failure(tmp_path, make_image):
+    specs = [
+        make_image("base", env={"FAIL": "1"}),
+        make_image("app", depends_on=["base"]),
+        make_image("tool", depends_on=["app"], recipe="build"),
+        make_image("other"),
+    ]
+    with pytest.raises(BuildFailed) as ex:
+        build_images(specs, jobs=2)
+    assert ex.value.failed == {"base": 3}
+    assert ex.value.skipped == ["app", "tool"]
+    # independent builds complete anyway
+    assert sorted(line[0] for line in _log(tmp_path)) == ["base", "other"]
+    assert (tmp_path / "other" / ".build" / ".digest").exists()
+
+
+def test_build_images_unknown_dependency(make_image):
+    with pytest.raises(SystemExit):
+        build_images([make_image("app", depends_on=["missing"])])
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from krules_dev.sane_utils.walker import IgnoreRules, Walker
+
+
+def _tree(base, *paths):
+    for path in paths:
+        path = base / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(path.name)
+
+
+def _walk(walker, root):
+    return sorted(os.path.relpath(f, root) for f in walker.walk(str(root)))
+
+
+@pytest.mark.parametrize("pattern, path, is_dir, matched", [
+    ("*.log", "a.log", False, True),
+    ("*.log", "sub/dir/a.log", False, True),
+    ("/*.log", "sub/a.log", False, None),
+    ("sub/*.log", "sub/a.log", False, True),
+    ("sub/*.log", "sub/deeper/a.log", False, None),
+    ("**/cache", "a/b/cache", True, True),
+    ("docs/**", "docs/a/b.md", False, True),
+    ("build/", "build", False, None),
+    ("build/", "build", True, True),
+    ("!keep.log", "keep.log", False, False),
+])
+def test_ignore_rules(tmp_path, pattern, path, is_dir, matched):
+    assert IgnoreRules(str(tmp_path), [pattern]).match(str(tmp_path / path), is_dir) is matched
+
+
+def test_walker_negation(tmp_path):
+    _tree(tmp_path, "a.log", "keep.log", "main.py", "logs/x.log", "logs/keep.log",
+          "data/skip.csv", "data/keep.csv")
+    (tmp_path / ".dockerignore").write_text("\n".join([
+        "# comment",
+        "*.log",
+        "!keep.log",
+        "data/*",
+        "!data/keep.csv",
+    ]))
+    assert _walk(Walker(ignore_files=[".dockerignore"]), tmp_path) == [
+        ".dockerignore", "data/keep.csv", "keep.log", "logs/keep.log", "main.py",
+    ]
+
+
+def test_walker_nested_ignore_files(tmp_path):
+    _tree(tmp_path, "a.tmp", "sub/a.tmp", "sub/b.tmp", "other/b.tmp", "__pycache__/m.pyc", ".build/Dockerfile")
+    (tmp_path / ".gitignore").write_text("*.tmp\n")
+    # the last matching rule wins, rules of a directory apply to its subtree only
+    (tmp_path / "sub" / ".gitignore").write_text("!b.tmp\n")
+    assert _walk(Walker(ignore_files=[".gitignore"]), tmp_path) == [".gitignore", "sub/.gitignore", "sub/b.tmp"]
+
+
+def test_walker_glob(tmp_path):
+    _tree(tmp_path, "k8s/a.yaml.j2", "k8s/.hidden.j2", "k8s/sub/b.yaml.j2", "node_modules/c.j2", "skip/d.j2")
+    (tmp_path / ".gitignore").write_text("skip/\n")
+    walker = Walker(ignore_files=[".gitignore"])
+    assert walker.glob("k8s/*.j2", str(tmp_path)) == ["k8s/a.yaml.j2"]
+    assert walker.glob("**/*.j2", str(tmp_path)) == ["k8s/a.yaml.j2", "k8s/sub/b.yaml.j2"]